@@ -7,11 +7,18 @@ __email__ = 'sergio.maffioletti@uzh.ch'
 __version__ = '0.1.0'
 
 import os
+import re
 import json
-import zipfile
+import itertools
+import shlex
+import hashlib
+import tarfile
+import threading
 import gc3apps
 import gc3libs
+from collections import namedtuple, OrderedDict
 from gc3libs import Application
+from gc3apps.utils import zipscan
 from gc3apps.utils.h5parse import CPparser
 
 #####################
@@ -33,43 +40,154 @@ class Default(object):
     DEFAULT_BBSERVER_MOUNT_POINT = "/mnt/bbvolume"
     DEFAULT_FILE_CHECK_MARKER = "done.txt"
     DEFAULT_EXPERIMENT_FILE_CHECK_MARKER = ".zip"
+    # Container launcher used by all command templates; point it to
+    # `etc/docker_standin.py` to run pipelines locally without docker
+    DOCKER_RUN = os.environ.get("GC3APPS_DOCKER_RUN", "sudo docker run")
+    # Data daemon: seconds without events before a folder is processed
+    DAEMON_QUIET_WINDOW = 30
+    # Data daemon: seconds after which a folder without marker is forgotten
+    DAEMON_MARKER_TIMEOUT = 7 * 24 * 3600
+    DAEMON_CLASSIFIER_WORKERS = 4
+    DAEMON_CLASSIFIER_QUEUE = 16
+    DAEMON_INBOX_EVENTS = "events"
+    DAEMON_INBOX_SCAN = "scan"
+    DAEMON_INBOX_BACKENDS = [DAEMON_INBOX_EVENTS, DAEMON_INBOX_SCAN]
+    DAEMON_SCAN_STATE = "inbox_scan.json"
+    DAEMON_METRICS_JSON = "daemon_metrics.json"
+    DAEMON_METRICS_PROMETHEUS = "daemon_metrics.prom"
+    # Timing and I/O report, written in the session directory
+    PROFILE_REPORT = "profile"
+    # Resource sampling of the containers run by a job
+    RESOURCE_SAMPLER_FILE = "resource_sampler.sh"
+    RESOURCE_SAMPLES = "resources.tsv"
+    RESOURCE_CID_PREFIX = ".gc3apps_cid."
+    # Image pre-pull: once per host, before the job's own command
+    IMAGE_PULL_FILE = "docker_prepull.sh"
+    IMAGE_PULL_TIMES = "pull.tsv"
+    # Image prefetch to the job's local scratch folder
+    PREFETCH_FILE = "prefetch.sh"
+    PREFETCH_LIST = "prefetch.txt"
+    PREFETCH_DIR = "scratch"
+    # Job results written to local scratch, returned as one archive
+    OUTPUT_PACK_FILE = "pack_outputs.sh"
+    OUTPUT_DIR = "results"
+    OUTPUT_ARCHIVE = "results.tar.gz"
+    # Sizing suggestions: memory headroom and target chunk runtime
+    RESOURCE_MEMORY_HEADROOM = 1.2
+    RESOURCE_TARGET_RUNTIME = 3600
+    # Archive entries identifying the analysis type, by precedence:
+    # an archive with both .fcs and .mcd files is sMC
+    DATASET_TYPES = [(".fcs", "sMC"), (".mcd", "IMC")]
+    DATASET_INFO_CACHE_SIZE = 256
     # GQTL
-    QTL_COMMAND = "sudo docker run -v {data}:/data -v {output}:/output bblab/qtl:{version} {phenotype} /data /output -b {batches} -p {permutations} -i {imputations} -t {trees} -m {mafthres} -l {last}"
+    QTL_COMMAND = DOCKER_RUN + " -v {data}:/data{data_mode} -v {output}:/output bblab/qtl:{version} {phenotype} /data /output -b {batches} -p {permutations} -i {imputations} -t {trees} -m {mafthres} -l {last}"
+    # How genotype/phenotype data reaches the jobs:
+    # copy:  staged in and out with every job
+    # mount: read-only from a path shared with the execution hosts
+    # cache: copied once per host from the shared path into QTL_CACHE_DIR
+    QTL_STAGING_COPY = "copy"
+    QTL_STAGING_MOUNT = "mount"
+    QTL_STAGING_CACHE = "cache"
+    QTL_STAGING_MODES = [QTL_STAGING_COPY, QTL_STAGING_MOUNT, QTL_STAGING_CACHE]
+    QTL_OUTPUT = "output"
+    # Exit status of each phenotype of a packed job, one "name code" per line
+    QTL_PHENOTYPE_STATUS = "phenotypes.txt"
+    QTL_PERMUTATION_PATTERN = "{phenotype}*perm*"
+    # Rough calibration of the QTL cost model: runtime of one tree,
+    # so that a batch costs permutations * imputations * trees of them
+    # (10000s with the default 100 x 10 x 1000). Calibrate it for the
+    # execution hosts from a finished job: its run time divided by
+    # batches * permutations * imputations * trees * packed phenotypes
+    # (the `run_time` of the `--profile` report), or give the value
+    # with `gqtl_pipeline --seconds-per-tree`.
+    QTL_SECONDS_PER_TREE = 0.01
+    QTL_CACHE_DIR = "/var/tmp/gc3apps/qtl"
+    QTL_CACHE_COMMAND = 'mkdir -p {cache_root} && flock {cache}.lock sh -c "test -d {cache} || (rm -rf {cache}.part && cp -a {source} {cache}.part && mv {cache}.part {cache})"'
 
     # CellProfiler
     CELLPROFILER_DONEFILE = "cp.done"
     CELLPROFILER_GROUPFILE = "cpgroups.json"
     DEFAULT_CELLPROFILER_DOCKER = "bblab/cellprofiler:3.1.8"
     CELLPROFILER_COMMAND = "cellprofiler -c -r -p {batch_file} -f {start} -l {end} --do-not-write-schema --plugins-directory={plugins} -o {output_folder} --done-file="+CELLPROFILER_DONEFILE
-    CELLPROFILER_DOCKER_COMMAND = "sudo docker run -v {batch_file}:{batch_file} -v {data_mount_point}:{data_mount_point} -v {output_folder}:/output {docker_image} -c -r -p {batch_file} -f {start} -l {end} --do-not-write-schema --plugins-directory={plugins} -o /output --done-file=/output/"+CELLPROFILER_DONEFILE
-    CELLPROFILER_GETGROUPS_COMMAND = "sudo docker run -v {batch_file}:{batch_file} {docker_image} -c --print-groups={batch_file}"
+    CELLPROFILER_DOCKER_COMMAND = DOCKER_RUN + " -v {batch_file}:{batch_file} -v {data_source}:{data_mount_point} -v {output_folder}:/output {docker_image} -c -r -p {batch_file} -f {start} -l {end} --do-not-write-schema --plugins-directory={plugins} -o /output --done-file=/output/"+CELLPROFILER_DONEFILE
+    CELLPROFILER_GETGROUPS_COMMAND = DOCKER_RUN + " -v {batch_file}:{batch_file} {docker_image} -c --print-groups={batch_file}"
 
     GET_CP_GROUPS_FILE = "cp_pipeline_get_groups.sh"
     GET_CP_GROUPS_CMD = "./" + GET_CP_GROUPS_FILE + " -o {output} -p {pipeline} -i {image_data} -w {cp_plugins} -d {docker_image}"
 
     # Ilastik
     DEFAULT_ILASTIK_DOCKER = "ilastik/ilastik-from-binary:1.3.2b3"
-    ILASTIK_DOCKER_COMMAND = 'sudo docker run -v {project_file}:{project_file} -v {data_mount_point}:{data_mount_point} -v {output_folder}:/output ' \
-            '{docker_image} ' \
-            './run_ilastik.sh ' \
-            '--headless --project=/{project_file} ' \
+    ILASTIK_OPTIONS = '--headless --project={project} ' \
             '--output_format=tiff '\
             '--output_filename_format=/output/{output_filename} '\
             '--export_source {export_source} '\
             '--export_dtype {export_dtype} ' \
-            '--pipeline_result_drange="(0.0, 1.0)" '\
+            '--pipeline_result_drange="(0.0, 1.0)" '
+    ILASTIK_DOCKER_COMMAND = DOCKER_RUN + ' -v {project_file}:{project_file} -v {data_source}:{data_mount_point} -v {output_folder}:/output ' \
+            '{docker_image} ' \
+            './run_ilastik.sh ' + ILASTIK_OPTIONS + \
             '{input_files}'
+    # Chunk inputs read from a staged file list instead of the command line;
+    # only lines `start` to `end` (1-based, inclusive) are processed.
+    ILASTIK_INPUT_LIST = "ilastik_inputs.txt"
+    ILASTIK_PROJECT = "/tmp/project.ilp"
+    ILASTIK_DOCKER_FILELIST_COMMAND = DOCKER_RUN + ' -v {project_file}:' + ILASTIK_PROJECT + ' -v {data_source}:{data_mount_point} -v {output_folder}:/output ' \
+            '-v {input_list}:/tmp/' + ILASTIK_INPUT_LIST + ':ro ' \
+            '{docker_image} ' \
+            '/bin/sh -c \'sed -n "{start},{end}p" /tmp/' + ILASTIK_INPUT_LIST + ' | tr "\\n" "\\0" | ' \
+            'xargs -0 -r ./run_ilastik.sh ' + ILASTIK_OPTIONS + '\''
+    # Persistent worker: load the project once and drain a work queue
+    ILASTIK_WORKER_FILE = "ilastik_worker.py"
+    ILASTIK_WORKER_COMMAND = DOCKER_RUN + ' -v {project_file}:' + ILASTIK_PROJECT + ' -v {data_mount_point}:{data_mount_point} -v {output_folder}:/output ' \
+            '-v {queue}:/queue -v {worker_dir}:/tmp/worker:ro ' \
+            '{docker_image} ' \
+            '/bin/sh -c \'PYTHONPATH=ilastik-meta/lazyflow:ilastik-meta/volumina:ilastik-meta/ilastik ' \
+            './bin/python /tmp/worker/' + ILASTIK_WORKER_FILE + ' --queue /queue --worker {worker} -- ' + ILASTIK_OPTIONS + '\''
+
+    # Compact chunk tasks: settings shared by all chunks of a run
+    CHUNK_CONFIG_FILE = "chunks.json"
+    ILASTIK_INPUT_LIST_ALL = "all.txt"
 
 #####################
 # Utilities
 #
 
+DatasetInfo = namedtuple('DatasetInfo', ['analysis_type', 'instrument',
+                                         'first_entry', 'entries'])
+
+_dataset_info_cache = OrderedDict()
+_dataset_info_lock = threading.Lock()
+
 def get_instrument(location):
     """
     makes strong assumptions on foldername
     folder containing filename identifies instrument
     """
-    return os.path.dirname(fd.filename).split(os.path.sep)[-1]
+    return os.path.basename(os.path.dirname(os.path.abspath(location)))
+
+def _classify_dataset(location):
+    """
+    Walk the central directory of the .zip archive `location` and
+    return the analysis type of the entry with the highest precedence
+    in `Default.DATASET_TYPES`; the walk stops as soon as an entry of
+    the first type is found.
+    """
+    analysis_type = None
+    rank = len(Default.DATASET_TYPES)
+    first_entry = None
+    with open(location, 'rb') as fd:
+        entries, _ = zipscan.read_entries_count(fd)
+        for filename, _ in zipscan.iter_central_directory(fd):
+            if first_entry is None:
+                first_entry = filename
+            for n, (suffix, kind) in enumerate(Default.DATASET_TYPES[:rank]):
+                if filename.lower().endswith(suffix):
+                    analysis_type, rank = kind, n
+                    break
+            if rank == 0:
+                break
+    return DatasetInfo(analysis_type, get_instrument(location),
+                       first_entry, entries)
 
 def get_dataset_info(location):
     """
@@ -78,20 +196,228 @@ def get_dataset_info(location):
     * if .fcs file then analysis type sMC
     * if .mcd file then analysis type IMC
     @param: location of raw data in .zip format
-    @ return: [IMC, sMC, None]
+    @ return: DatasetInfo; `analysis_type` is one of [IMC, sMC, None]
+
+    Results are cached by (location, size, mtime), so repeated
+    events on an unchanged archive do not read it again.
+    """
+    stat = os.stat(location)
+    key = (os.path.abspath(location), stat.st_size, stat.st_mtime)
+    with _dataset_info_lock:
+        if key in _dataset_info_cache:
+            info = _dataset_info_cache.pop(key)
+            _dataset_info_cache[key] = info
+            return info
+
+    info = _classify_dataset(location)
+
+    with _dataset_info_lock:
+        _dataset_info_cache[key] = info
+        while len(_dataset_info_cache) > Default.DATASET_INFO_CACHE_SIZE:
+            _dataset_info_cache.popitem(last=False)
+    return info
+
+def _count_lines(location):
+    """
+    Return number of lines in text file `location`
+    """
+    with open(location) as fd:
+        return sum(1 for _ in fd)
+
+def _get_qtl_cache(location):
+    """
+    Return the host-local cache folder for QTL data at `location`.
+    The folder name changes whenever `location` is modified, so
+    stale copies are never reused.
+    """
+    key = "{0}:{1}".format(location, os.stat(location).st_mtime)
+    return os.path.join(gc3apps.Default.QTL_CACHE_DIR,
+                        "{0}-{1}".format(os.path.basename(location.rstrip(os.path.sep)),
+                                         hashlib.md5(key.encode('utf-8')).hexdigest()[:12]))
+
+def _sh_command(commands):
     """
+    Chain `commands` with `&&` into a single command line.
+    GC3Pie quotes every argument of an application, so shell
+    operators only work within a shell of their own.
+    """
+    if len(commands) == 1:
+        return commands[0]
+    return "/bin/sh -c '{0}'".format(" && ".join(commands))
 
-    instrument = get_instrument(location)
+def _sample_resources(command, inputs, outputs, extra_args):
+    """
+    If `extra_args['sample_resources']` is set (sampling interval in
+    seconds), wrap `command` with the resource sampler: every
+    container launch (`Default.DOCKER_RUN`, at the start of `command`
+    or of one of its shell commands) writes a cid file the sampler
+    uses to poll the container, and the samples are returned with the
+    job outputs.
+    Return the (possibly wrapped) command and the executables to stage.
+    """
+    interval = extra_args.get('sample_resources', None)
+    if not interval:
+        return (command, [])
+    runs = itertools.count()
+    command = re.sub(r"(^|[;&|{{(]\s*|-c '){0}(?= )".format(re.escape(gc3apps.Default.DOCKER_RUN)),
+                     lambda match: "{0}{1} --cidfile $PWD/{2}{3}".format(
+                         match.group(1), gc3apps.Default.DOCKER_RUN,
+                         gc3apps.Default.RESOURCE_CID_PREFIX, next(runs)),
+                     command)
+    inputs[os.path.join(whereami,
+                        "etc",
+                        gc3apps.Default.RESOURCE_SAMPLER_FILE)] = gc3apps.Default.RESOURCE_SAMPLER_FILE
+    outputs.append(gc3apps.Default.RESOURCE_SAMPLES)
+    command = "./{0} {1} {2} {3}".format(gc3apps.Default.RESOURCE_SAMPLER_FILE,
+                                         interval,
+                                         gc3apps.Default.RESOURCE_SAMPLES,
+                                         command)
+    return (command, ["./{0}".format(gc3apps.Default.RESOURCE_SAMPLER_FILE)])
+
+def _prepull(command, image, inputs, outputs, extra_args):
+    """
+    If `extra_args['prepull']` is set, wrap `command` with the image
+    pre-pull script: `image` is pulled unless the host already has it,
+    and the time spent is returned with the job outputs, so that it is
+    not accounted as run time of the job.
+    Return the (possibly wrapped) command and the executables to stage.
+    """
+    if not extra_args.get('prepull', False):
+        return (command, [])
+    inputs[os.path.join(whereami,
+                        "etc",
+                        gc3apps.Default.IMAGE_PULL_FILE)] = gc3apps.Default.IMAGE_PULL_FILE
+    outputs.append(gc3apps.Default.IMAGE_PULL_TIMES)
+    command = "./{0} {1} {2} {3}".format(gc3apps.Default.IMAGE_PULL_FILE,
+                                         image,
+                                         gc3apps.Default.IMAGE_PULL_TIMES,
+                                         command)
+    return (command, ["./{0}".format(gc3apps.Default.IMAGE_PULL_FILE)])
+
+def _data_source(data_mount_point, prefetch=None):
+    """
+    Return the host folder to mount at `data_mount_point`: the copy
+    in the job's scratch folder if its images are prefetched.
+    """
+    if prefetch:
+        return "$PWD/{0}{1}".format(gc3apps.Default.PREFETCH_DIR, data_mount_point)
+    return data_mount_point
 
-    # list content of .zip data and return analysis type
-    with zipfile.ZipFile(location) as data:
-        dataset = namelist()
-        # get analysis type
-        if [dd for dd in dataset if dd.lower().endswith("fcs")]:
-            return ("sMC",dataset[0])
-        if [dd for dd in dataset if dd.lower().endswith("mcd")]:
-            return ("IMC",dataset[0])
-    return None,None
+def _prefetch(command, inputs, extra_args):
+    """
+    If `extra_args['prefetch']` is set (a file listing the job's
+    images), wrap `command` with the prefetch script, which copies the
+    images to the job's scratch folder first; the command must mount
+    `_data_source()` instead of the data mount point.
+    Return the (possibly wrapped) command and the executables to stage.
+    """
+    location = extra_args.get('prefetch', None)
+    if not location:
+        return (command, [])
+    inputs.setdefault(location, gc3apps.Default.PREFETCH_LIST)
+    inputs[os.path.join(whereami,
+                        "etc",
+                        gc3apps.Default.PREFETCH_FILE)] = gc3apps.Default.PREFETCH_FILE
+    command = "./{0} {1} {2} {3}".format(gc3apps.Default.PREFETCH_FILE,
+                                         inputs[location],
+                                         gc3apps.Default.PREFETCH_DIR,
+                                         command)
+    return (command, ["./{0}".format(gc3apps.Default.PREFETCH_FILE)])
+
+def _output_target(output_folder, pack_outputs=False):
+    """
+    Return the host folder the job writes its results to: a folder
+    in its working directory if they are returned packed.
+    """
+    if pack_outputs:
+        return "$PWD/{0}".format(gc3apps.Default.OUTPUT_DIR)
+    return output_folder
+
+def _pack_outputs(command, inputs, outputs, extra_args):
+    """
+    If `extra_args['pack_outputs']` is set, wrap `command` with the
+    output pack script: the results the command writes to
+    `_output_target()` are returned as a single compressed archive
+    with the job outputs, see `unpack_results`.
+    Return the (possibly wrapped) command and the executables to stage.
+    """
+    if not extra_args.get('pack_outputs', False):
+        return (command, [])
+    inputs[os.path.join(whereami,
+                        "etc",
+                        gc3apps.Default.OUTPUT_PACK_FILE)] = gc3apps.Default.OUTPUT_PACK_FILE
+    outputs.append(gc3apps.Default.OUTPUT_ARCHIVE)
+    command = "./{0} {1} {2} {3}".format(gc3apps.Default.OUTPUT_PACK_FILE,
+                                         gc3apps.Default.OUTPUT_DIR,
+                                         gc3apps.Default.OUTPUT_ARCHIVE,
+                                         command)
+    return (command, ["./{0}".format(gc3apps.Default.OUTPUT_PACK_FILE)])
+
+def unpack_results(output_dir, destination):
+    """
+    Unpack the results archive returned in the job folder `output_dir`
+    (see `_pack_outputs`) into `destination` and remove it, so that it
+    is unpacked only once. Entries that would land outside of
+    `destination` are skipped.
+    Return the number of files unpacked, or None if there was no archive.
+    """
+    location = os.path.join(output_dir, gc3apps.Default.OUTPUT_ARCHIVE)
+    if not os.path.isfile(location):
+        return None
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    root = os.path.realpath(destination)
+    with tarfile.open(location, 'r:gz') as archive:
+        members = [member for member in archive.getmembers()
+                   if (member.isfile() or member.isdir())
+                   and os.path.realpath(os.path.join(root, member.name)).startswith(root)]
+        archive.extractall(destination, members)
+    os.remove(location)
+    return len([member for member in members if member.isfile()])
+
+_chunk_configs = dict()
+_chunk_configs_lock = threading.Lock()
+
+def write_chunk_config(location, command, inputs, output_folder, sample_resources=None,
+                       prepull=False, prefetch=None, pack_outputs=False, **fields):
+    """
+    Write the settings shared by all `CompactChunk` tasks of a run
+    into the .json file `location` and return `location`.
+    `command` is a template with `{start}`, `{end}` and `{output_folder}`
+    placeholders, the others are filled in from `fields`;
+    `output_folder` and the local paths in `inputs` may themselves
+    contain `{start}` and `{end}`. With `prepull`, the image
+    `fields['docker_image']` is pulled first (see `_prepull`);
+    `prefetch` is the list of images of a chunk to copy to local
+    scratch (see `_prefetch`), with `{start}` and `{end}` too. With
+    `pack_outputs`, the results are returned as one archive to unpack
+    into the chunk's `output_folder` (see `_pack_outputs`).
+    """
+    folder = os.path.dirname(location)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(location, 'w') as fd:
+        json.dump(dict(command=command,
+                       inputs=inputs,
+                       output_folder=output_folder,
+                       sample_resources=sample_resources,
+                       prepull=prepull,
+                       prefetch=prefetch,
+                       pack_outputs=pack_outputs,
+                       fields=fields), fd, indent=2)
+    return location
+
+def _load_chunk_config(location):
+    """
+    Return the chunk settings stored at `location`; they are read
+    once per process and shared by all tasks referring to them.
+    """
+    key = (location, os.stat(location).st_mtime)
+    with _chunk_configs_lock:
+        if key not in _chunk_configs:
+            with open(location) as fd:
+                _chunk_configs[key] = json.load(fd)
+        return _chunk_configs[key]
 
 whereami = os.path.dirname(os.path.abspath(__file__))
 
@@ -184,24 +510,74 @@ class QTLApplication(Application):
         """
         Crate GC3Pie application object by specifying the dictionary with
         command line argument, input/output requirements.
+        `phenotype` is either a single phenotype name or a list of them.
         """
 
         inputs = dict()
         outputs = []
 
-        inputs[path] = os.path.basename(path)
-        outputs.append(inputs[path])
-
-        cmd = gc3apps.Default.QTL_COMMAND.format(version=version,
-                                                 phenotype=phenotype,
-                                                 data="$PWD/{0}".format(inputs[path]),
-                                                 output="$PWD/{0}".format(inputs[path]),
-                                                 batches=batches,
-                                                 permutations=permutations,
-                                                 imputations=imputations,
-                                                 trees=trees,
-                                                 mafthres=mafthres,
-                                                 last=last)
+        staging = kwargs.get('staging', None) or gc3apps.Default.QTL_STAGING_COPY
+        assert staging in gc3apps.Default.QTL_STAGING_MODES, \
+            "Unknown staging mode {0}.".format(staging)
+        self.staging = staging
+        commands = []
+
+        if staging == gc3apps.Default.QTL_STAGING_COPY:
+            inputs[path] = os.path.basename(path)
+            outputs.append(inputs[path])
+            data = "$PWD/{0}".format(inputs[path])
+            data_mode = ""
+            self.results = inputs[path]
+        else:
+            # Only this job's own results are retrieved
+            data_mode = ":ro"
+            self.results = gc3apps.Default.QTL_OUTPUT
+            outputs.append(self.results)
+            commands.append("mkdir -p {0}".format(self.results))
+            if staging == gc3apps.Default.QTL_STAGING_MOUNT:
+                data = path
+            else:
+                data = _get_qtl_cache(path)
+                commands.append(gc3apps.Default.QTL_CACHE_COMMAND.format(cache_root=gc3apps.Default.QTL_CACHE_DIR,
+                                                                         cache=data,
+                                                                         source=path))
+
+        # Several phenotypes can be packed in one job: they share
+        # staging and scheduling, and run one after the other. Each
+        # one runs regardless of the others and records its exit
+        # status, so that a failure only affects its own results.
+        if isinstance(phenotype, basestring):
+            phenotype = [phenotype]
+        self.phenotypes = list(phenotype)
+        self.failed_phenotypes = []
+
+        runs = []
+        for name in self.phenotypes:
+            runs.append(gc3apps.Default.QTL_COMMAND.format(version=version,
+                                                           phenotype=name,
+                                                           data=data,
+                                                           data_mode=data_mode,
+                                                           output="$PWD/{0}".format(self.results),
+                                                           batches=batches,
+                                                           permutations=permutations,
+                                                           imputations=imputations,
+                                                           trees=trees,
+                                                           mafthres=mafthres,
+                                                           last=last))
+        if len(runs) == 1:
+            commands.extend(runs)
+        else:
+            status = gc3apps.Default.QTL_PHENOTYPE_STATUS
+            outputs.append(status)
+            # backends pass arguments to the job's shell in double
+            # quotes: escape `$?` so that it expands within `/bin/sh -c`
+            commands.append("{{ {0}; }}".format("; ".join(
+                '{0}; echo "{1} \\$?" >> {2}'.format(run, name, status)
+                for name, run in zip(self.phenotypes, runs))))
+            commands.append('! grep -qv " 0$" {0}'.format(status))
+        cmd, executables = _sample_resources(_sh_command(commands),
+                                             inputs, outputs, kwargs)
+
         Application.__init__(
             self,
             arguments = cmd,
@@ -209,9 +585,74 @@ class QTLApplication(Application):
             outputs = outputs,
             stdout = 'log',
             join=True,
-            executables=[],
+            executables=executables,
             **kwargs)
 
+    def terminated(self):
+        """
+        Record the phenotypes that failed: those with a non-zero
+        exit status in a packed job, or all of them if the job
+        did not report any.
+        """
+        status = dict()
+        location = os.path.join(self.output_dir or '', gc3apps.Default.QTL_PHENOTYPE_STATUS)
+        if len(self.phenotypes) > 1 and os.path.isfile(location):
+            with open(location) as fd:
+                for line in fd:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        status[fields[0]] = fields[1]
+        if status:
+            self.failed_phenotypes = [name for name in self.phenotypes
+                                      if status.get(name, None) != '0']
+        elif self.execution.returncode != 0:
+            self.failed_phenotypes = list(self.phenotypes)
+        else:
+            self.failed_phenotypes = []
+        if self.failed_phenotypes and self.failed_phenotypes != self.phenotypes:
+            gc3libs.log.error("Job {0}: phenotypes {1} failed, the others"
+                              " completed.".format(self.jobname,
+                                                   ', '.join(self.failed_phenotypes)))
+
+    @staticmethod
+    def estimated_runtime(batches, permutations, imputations, trees,
+                          seconds_per_tree=None):
+        """
+        Estimate runtime in seconds of a job computing `batches`
+        permutation batches: each permutation fits `imputations`
+        forests of `trees` trees.
+        """
+        if seconds_per_tree is None:
+            seconds_per_tree = gc3apps.Default.QTL_SECONDS_PER_TREE
+        return batches * permutations * imputations * trees * seconds_per_tree
+
+class PullImage(Application):
+    """
+    Pull docker `image` on the execution host unless it is already
+    there (see `_prepull`). Runs as `application_name`, so that it is
+    placed on the same kind of host as the jobs using the image; which
+    host it lands on is up to the backend, so warming up is best effort.
+    """
+
+    def __init__(self, image, application_name='generic', **extra_args):
+
+        inputs = dict()
+        outputs = []
+
+        self.application_name = application_name
+        self.docker_image = image
+        command, executables = _prepull('', image, inputs, outputs, dict(prepull=True))
+
+        Application.__init__(
+            self,
+            arguments = command,
+            inputs = inputs,
+            outputs = outputs,
+            stdout = 'log',
+            join=True,
+            executables=executables,
+            **extra_args)
+
 class RunCellprofiler(Application):
     """
     Run Cellprofiler in batch mode
@@ -234,20 +675,27 @@ class RunCellprofiler(Application):
 
         command = gc3apps.Default.CELLPROFILER_DOCKER_COMMAND.format(batch_file="$PWD/{0}".format(inputs[batch_file]),
                                                                      data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                                                     data_source=_data_source(gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                                                                              extra_args.get('prefetch', None)),
                                                                      docker_image = self.docker_image,
                                                                      start=start_index,
                                                                      end=end_index,
-                                                                     output_folder=output_folder,
+                                                                     output_folder=_output_target(output_folder,
+                                                                                                  extra_args.get('pack_outputs', False)),
                                                                      plugins=cp_plugins)
+        command, executables = _sample_resources(command, inputs, outputs, extra_args)
+        command, pack_executables = _pack_outputs(command, inputs, outputs, extra_args)
+        command, prefetch_executables = _prefetch(command, inputs, extra_args)
+        command, pull_executables = _prepull(command, self.docker_image, inputs, outputs, extra_args)
 
         Application.__init__(
             self,
             arguments = command,
             inputs = inputs,
-            outputs = [],
+            outputs = outputs,
             stdout = 'log',
             join=True,
-            executables=[],
+            executables=executables + pack_executables + prefetch_executables + pull_executables,
             **extra_args)
 
     def terminated(self):
@@ -289,6 +737,7 @@ class RunCellprofilerGetGroups(Application):
                                                        docker_image=self.docker_image)
 
 	gc3libs.log.debug("In RunCellprofilerGetGroups running {0}.".format(cmd))
+        cmd, pull_executables = _prepull(cmd, self.docker_image, inputs, outputs, extra_args)
 
         Application.__init__(
             self,
@@ -298,7 +747,7 @@ class RunCellprofilerGetGroups(Application):
             stdout = "log.out",
             stderr = "log.err",
             join=False,
-            executables=["./{0}".format(gc3apps.Default.GET_CP_GROUPS_FILE)],
+            executables=["./{0}".format(gc3apps.Default.GET_CP_GROUPS_FILE)] + pull_executables,
             **extra_args)
 
 
@@ -386,6 +835,16 @@ class RunCellprofilerGetGroupsWithBatchFile(Application):
 class RunIlastik(Application):
     """
     Run Ilastik in batch mode
+
+    `input_files` can be either:
+    * a list of image paths, passed verbatim on the command line;
+    * the location of a text file with one image path per line; the
+      file is staged with the job and Ilastik only gets the lines
+      within `extra_args['input_range']` (1-based, inclusive;
+      default: the whole file). This keeps the command line short
+      regardless of the chunk size;
+    * a glob pattern, handed over quoted and expanded by Ilastik
+      itself within the container.
     """
 
     application_name = 'runilastik'
@@ -398,6 +857,7 @@ class RunIlastik(Application):
 
         self.docker_image = gc3apps.Default.DEFAULT_ILASTIK_DOCKER
         inputs[project_file] = os.path.basename(project_file)
+        output_target = _output_target(output_folder, extra_args.get('pack_outputs', False))
 
         if extra_args["docker_image"]:
             self.docker_image = extra_args["docker_image"]
@@ -407,26 +867,221 @@ class RunIlastik(Application):
             output_filename =  '{{nickname}}_{outtype}.tiff'.format(
                     outtype=outtype)
 
-        input_file_string = ' '.join(input_files)
+        if isinstance(input_files, basestring) and os.path.isfile(input_files):
+            inputs[input_files] = gc3apps.Default.ILASTIK_INPUT_LIST
+            start, end = extra_args.get('input_range', None) or \
+                         (1, _count_lines(input_files))
+            self.input_range = (start, end)
+
+            command = gc3apps.Default.ILASTIK_DOCKER_FILELIST_COMMAND.format(
+                project_file="$PWD/{0}".format(inputs[project_file]),
+                project=gc3apps.Default.ILASTIK_PROJECT,
+                data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                data_source=_data_source(gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                         extra_args.get('prefetch', None)),
+                docker_image = self.docker_image,
+                input_list="$PWD/{0}".format(inputs[input_files]),
+                start=start,
+                end=end,
+                output_folder=output_target,
+                export_source=export_source,
+                export_dtype=export_dtype,
+                output_filename=output_filename
+            )
+        else:
+            if isinstance(input_files, basestring):
+                # glob pattern: let Ilastik expand it
+                input_file_string = '"{0}"'.format(input_files)
+            else:
+                input_file_string = ' '.join(input_files)
+
+            command = gc3apps.Default.ILASTIK_DOCKER_COMMAND.format(
+                project_file="$PWD/{0}".format(inputs[project_file]),
+                project="/$PWD/{0}".format(inputs[project_file]),
+                data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                data_source=_data_source(gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                         extra_args.get('prefetch', None)),
+                docker_image = self.docker_image,
+                input_files=input_file_string,
+                output_folder=output_target,
+                export_source=export_source,
+                export_dtype=export_dtype,
+                output_filename=output_filename
+            )
+        command, executables = _sample_resources(command, inputs, outputs, extra_args)
+        command, pack_executables = _pack_outputs(command, inputs, outputs, extra_args)
+        command, prefetch_executables = _prefetch(command, inputs, extra_args)
+        command, pull_executables = _prepull(command, self.docker_image, inputs, outputs, extra_args)
+
+        Application.__init__(
+            self,
+            arguments = command,
+            inputs = inputs,
+            outputs = outputs,
+            stdout = 'log',
+            join=True,
+            executables=executables + pack_executables + prefetch_executables + pull_executables,
+             **extra_args)
+
+class RunIlastikWorker(Application):
+    """
+    Run Ilastik as a persistent worker: the project is loaded
+    once and chunks of images are pulled from the `FileWorkQueue`
+    at `queue` until it is drained.
+    `queue` must be reachable from every execution host.
+    """
+
+    application_name = 'runilastik'
+
+    def __init__(self, project_file, queue, output_folder, export_source,
+            export_dtype, output_filename, **extra_args):
+
+        inputs = dict()
+        outputs = []
+
+        self.docker_image = gc3apps.Default.DEFAULT_ILASTIK_DOCKER
+        self.queue = queue
+        inputs[project_file] = os.path.basename(project_file)
+        inputs[os.path.join(whereami,
+                            "etc",
+                            gc3apps.Default.ILASTIK_WORKER_FILE)] = gc3apps.Default.ILASTIK_WORKER_FILE
+        inputs[os.path.join(whereami, "utils", "workqueue.py")] = "workqueue.py"
+
+        if extra_args["docker_image"]:
+            self.docker_image = extra_args["docker_image"]
 
-        command = gc3apps.Default.ILASTIK_DOCKER_COMMAND.format(
+        if output_filename is None:
+            outtype = filter(str.isalnum, export_source)
+            output_filename =  '{{nickname}}_{outtype}.tiff'.format(
+                    outtype=outtype)
+
+        command = gc3apps.Default.ILASTIK_WORKER_COMMAND.format(
             project_file="$PWD/{0}".format(inputs[project_file]),
+            project=gc3apps.Default.ILASTIK_PROJECT,
             data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
             docker_image = self.docker_image,
-            input_files=input_file_string,
+            queue=queue,
+            worker_dir="$PWD",
+            worker=extra_args['jobname'],
             output_folder=output_folder,
             export_source=export_source,
             export_dtype=export_dtype,
             output_filename=output_filename
         )
+        command, executables = _sample_resources(command, inputs, outputs, extra_args)
+        command, pull_executables = _prepull(command, self.docker_image, inputs, outputs, extra_args)
 
         Application.__init__(
             self,
             arguments = command,
             inputs = inputs,
-            outputs = [],
+            outputs = outputs,
             stdout = 'log',
             join=True,
-            executables=[],
+            executables=executables + pull_executables,
              **extra_args)
 
+class CompactChunk(Application):
+    """
+    A chunk of image sets `start_index` to `end_index` (inclusive)
+    that only stores its range and the location of the settings
+    shared by all chunks of the run (see `write_chunk_config`).
+    The command line is built from them whenever the backend asks
+    for it, so it is neither kept in memory nor saved with the session.
+    """
+
+    def __init__(self, chunk_config, start_index, end_index, **extra_args):
+
+        self.chunk_config = chunk_config
+        self.start_index = start_index
+        self.end_index = end_index
+        config = _load_chunk_config(chunk_config)
+
+        inputs = self._inputs(config)
+        outputs = []
+        _, executables = _sample_resources('', inputs, outputs, config)
+        _, pack_executables = _pack_outputs('', inputs, outputs, config)
+        _, prefetch_executables = _prefetch('', inputs, self._prefetch_args(config))
+        _, pull_executables = _prepull('', config['fields'].get('docker_image'),
+                                       inputs, outputs, config)
+
+        Application.__init__(
+            self,
+            arguments = [],
+            inputs = inputs,
+            outputs = outputs,
+            stdout = 'log',
+            join=True,
+            executables=executables + pack_executables + prefetch_executables + pull_executables,
+            **extra_args)
+
+    def _inputs(self, config):
+        return dict((local.format(start=self.start_index, end=self.end_index), remote)
+                    for local, remote in config['inputs'].items())
+
+    def _prefetch_args(self, config):
+        prefetch = config.get('prefetch', None)
+        if prefetch:
+            prefetch = prefetch.format(start=self.start_index, end=self.end_index)
+        return dict(prefetch=prefetch)
+
+    @property
+    def output_folder(self):
+        config = _load_chunk_config(self.chunk_config)
+        return config['output_folder'].format(start=self.start_index,
+                                              end=self.end_index)
+
+    @property
+    def arguments(self):
+        config = _load_chunk_config(self.chunk_config)
+        fields = dict(config['fields'])
+        fields.update(self._command_range())
+        prefetch_args = self._prefetch_args(config)
+        fields.setdefault('data_source', _data_source(fields.get('data_mount_point', None),
+                                                      prefetch_args['prefetch']))
+        command = config['command'].format(output_folder=_output_target(self.output_folder,
+                                                                        config.get('pack_outputs', False)),
+                                           **fields)
+        command, _ = _sample_resources(command, dict(), [], config)
+        command, _ = _pack_outputs(command, dict(), [], config)
+        command, _ = _prefetch(command, self._inputs(config), prefetch_args)
+        command, _ = _prepull(command, fields.get('docker_image'), dict(), [], config)
+        return shlex.split(gc3libs.utils.to_str(command, 'filesystem'))
+
+    @arguments.setter
+    def arguments(self, value):
+        # built from the chunk settings, see above
+        pass
+
+    def _command_range(self):
+        """
+        Return the `start` and `end` fields of the command.
+        """
+        return dict(start=self.start_index, end=self.end_index)
+
+class CellprofilerChunk(CompactChunk):
+    """
+    Compact `RunCellprofiler`: run CellProfiler in batch mode on
+    the image sets of one chunk.
+    """
+
+    application_name = 'runcellprofiler'
+
+    def terminated(self):
+        """
+        Check if results have been generated
+        create list of .csv files in case
+        """
+        self.csv_results = [data for data in os.listdir(self.output_folder) if data.endswith(gc3apps.Default.CSV_SUFFIX)]
+
+class IlastikChunk(CompactChunk):
+    """
+    Compact `RunIlastik`: run Ilastik on images `start_index` to
+    `end_index` of the run. The image list staged with the chunk
+    only holds the images of the chunk.
+    """
+
+    application_name = 'runilastik'
+
+    def _command_range(self):
+        return dict(start=1, end=self.end_index - self.start_index + 1)
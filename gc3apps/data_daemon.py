@@ -29,12 +29,23 @@ import os
 import sys
 import gc3apps
 import gc3libs
+import gc3libs.exceptions
 import gc3apps.pipelines
+from collections import deque
 from fnmatch import fnmatch
 from os.path import basename
 from gc3libs import Application, Run, Task
+from gc3apps.utils.pathindex import PathPrefixIndex
+from gc3apps.utils.events import FolderEventCoalescer
+from gc3apps.utils.threadpool import BoundedThreadPool
+from gc3apps.utils.markerscan import MarkerScanner, is_completion_marker
+from gc3apps.utils.fairshare import hierarchical_fill
+from gc3apps.workflow import ThrottledParallelTaskCollection
+from gc3apps.utils import metrics
+from gc3apps.utils.metrics import DaemonMetrics
+from gc3libs.workflow import TaskCollection
 from gc3libs.cmdline import SessionBasedDaemon, \
-    existing_file, existing_directory
+    existing_file, existing_directory, positive_int
 from gc3libs.quantity import Memory, kB, MB, MiB, \
     GB, Duration, hours, minutes, seconds
 
@@ -50,6 +61,24 @@ class InboxProcessingDaemon(SessionBasedDaemon):
     # `SessionBasedDaemon` class
     version = '1.1'
 
+    class Commands(SessionBasedDaemon.Commands):
+
+        def metrics(self, *opts):
+            """
+            Usage: metrics [json|prometheus]
+
+            Print experiment counters and latency histograms
+            (as last saved by the daemon's main loop).
+            """
+            if 'prometheus' in opts:
+                location = self._parent.params.metrics_file
+            else:
+                location = self._parent.metrics_json
+            if not os.path.isfile(location):
+                return "ERROR: no metrics recorded yet"
+            with open(location) as fd:
+                return fd.read()
+
 
     def setup_args(self):
         super(InboxProcessingDaemon, self).setup_args()
@@ -58,89 +87,380 @@ class InboxProcessingDaemon(SessionBasedDaemon):
                        type=existing_file,
                        help="Location of preprocessing pipeline "
                        "configuration file.")
-       
-    def _get_inbox_from_subject(self, subject):
-        """
-        Return the first inbox path corresponding to the location
-        of the subject
-        """
-        for inbox in self.params.inbox:
-            if inbox.path in subject.path:
-                return inbox.path
-        return None
+
+    def setup_options(self):
+        super(InboxProcessingDaemon, self).setup_options()
+
+        self.add_param("--quiet-window", metavar="SECONDS",
+                       type=float, dest="quiet_window",
+                       default=gc3apps.Default.DAEMON_QUIET_WINDOW,
+                       help="Process an experiment folder only once no event"
+                       " has been seen on it for this many seconds."
+                       " Default: %(default)s")
+
+        self.add_param("--marker-timeout", metavar="SECONDS",
+                       type=float, dest="marker_timeout",
+                       default=gc3apps.Default.DAEMON_MARKER_TIMEOUT,
+                       help="Stop tracking a folder whose completion marker"
+                       " has not shown up after this many seconds without"
+                       " events (e.g. an aborted upload); a later event"
+                       " starts tracking it again. Default: %(default)s")
+
+        self.add_param("--classifier-workers", metavar="[INT]",
+                       type=positive_int, dest="classifier_workers",
+                       default=gc3apps.Default.DAEMON_CLASSIFIER_WORKERS,
+                       help="Number of threads inspecting completed datasets."
+                       " Default: %(default)s")
+
+        self.add_param("--classifier-queue", metavar="[INT]",
+                       type=positive_int, dest="classifier_queue",
+                       default=gc3apps.Default.DAEMON_CLASSIFIER_QUEUE,
+                       help="Maximum number of datasets waiting for a"
+                       " classifier thread. Default: %(default)s")
+
+        self.add_param("--inbox-backend", metavar="[STRING]",
+                       choices=gc3apps.Default.DAEMON_INBOX_BACKENDS,
+                       dest="inbox_backend",
+                       default=gc3apps.Default.DAEMON_INBOX_EVENTS,
+                       help="How inboxes are watched: '{0}' uses the stock"
+                       " GC3Pie pollers; '{1}' periodically scans for completion"
+                       " markers, only listing directories that changed since the"
+                       " previous scan (use it on network filesystems, where"
+                       " inotify does not see remote writes)."
+                       " Default: %(default)s".format(
+                           *gc3apps.Default.DAEMON_INBOX_BACKENDS))
+
+        self.add_param("--max-running-chunks", metavar="[INT]",
+                       type=int, dest="max_running_chunks", default=0,
+                       help="Maximum number of chunks running at the same"
+                       " time across all pipelines, shared fairly between"
+                       " the top-level inbox folders (users or instruments)."
+                       " 0 means no limit. Default: %(default)s")
+
+        self.add_param("--share-weight", metavar="KEY=WEIGHT",
+                       action="append", dest="share_weight", default=[],
+                       help="Relative share of the running chunks given to"
+                       " inbox folder KEY (default weight 1)."
+                       " Can be repeated.")
+
+        self.add_param("--placeholder-pipelines", action="store_true",
+                       dest="placeholder_pipelines", default=False,
+                       help="Run the placeholder pipelines, one no-op task"
+                       " per data file, for analysis types without a real"
+                       " pipeline, e.g. to try out the scheduling. Without"
+                       " it, such experiments are classified and left alone.")
+
+        self.add_param("--metrics-file", metavar="[PATH]",
+                       dest="metrics_file", default=None,
+                       help="Write daemon metrics in Prometheus text format"
+                       " to this file (e.g. for the node exporter textfile"
+                       " collector). Default: '{0}' in the session"
+                       " directory.".format(gc3apps.Default.DAEMON_METRICS_PROMETHEUS))
 
     def parse_args(self):
         super(InboxProcessingDaemon, self).parse_args()
         self.params.config_file = os.path.abspath(self.params.config_file)
+        self.inbox_index = PathPrefixIndex((inbox.path, inbox.path)
+                                           for inbox in self.params.inbox)
+        self.share_weights = dict()
+        for item in self.params.share_weight:
+            try:
+                key, weight = item.rsplit('=', 1)
+                self.share_weights[key] = float(weight)
+            except ValueError:
+                raise gc3libs.exceptions.InvalidUsage(
+                    "Invalid share weight '{0}': expected KEY=WEIGHT".format(item))
+        session = os.path.abspath(self.params.session)
+        self.metrics_json = os.path.join(session,
+                                         gc3apps.Default.DAEMON_METRICS_JSON)
+        if not self.params.metrics_file:
+            self.params.metrics_file = os.path.join(
+                session, gc3apps.Default.DAEMON_METRICS_PROMETHEUS)
+        self.metrics = DaemonMetrics.load(self.metrics_json)
+        # experiment folder -> pipeline, until the pipeline terminates
+        self.pipelines = dict()
+        # analysis type -> pipeline class
+        self.pipeline_classes = dict(gc3apps.pipelines.DAEMON_PIPELINES)
+        if self.params.placeholder_pipelines:
+            for analysis_type, pipeline_class in gc3apps.pipelines.PLACEHOLDER_PIPELINES.items():
+                self.pipeline_classes.setdefault(analysis_type, pipeline_class)
+        self.scanner = None
+        self.scan_inboxes = []
+        if self.params.inbox_backend == gc3apps.Default.DAEMON_INBOX_SCAN:
+            # no stock pollers: inboxes are scanned from `every_main_loop`
+            self.scan_inboxes = [inbox.path for inbox in self.params.inbox]
+            self.params.inbox = []
+        self.events = FolderEventCoalescer(self.params.quiet_window,
+                                           self.params.marker_timeout)
+        # jobnames of the folders processed by this daemon
+        self.processed = set()
+        # completed folders waiting for a classifier thread
+        self.backlog = deque()
+        # folders being classified -> inbox
+        self.classifying = dict()
+        self.classifier = BoundedThreadPool(self._classify,
+                                            self.params.classifier_workers,
+                                            self.params.classifier_queue)
+
+    def _get_inbox(self, location):
+        """
+        Return the path of the innermost inbox containing location
+        """
+        return self.inbox_index.longest_prefix(location)
+
+    def _is_completion_marker(self, location):
+        """
+        Return True if `location` marks an experiment folder as complete.
+        """
+        return is_completion_marker(location)
 
-    def _get_inbox_from_subject(self, subject):
+    def _get_dataset(self, marker):
         """
-        Return the first inbox path corresponding to the location
-        of the subject
+        Return the archive to classify for completion `marker`: the
+        marker itself, or the first archive of its folder if it is a
+        folder marker (None if there is none).
         """
-        for inbox in self.params.inbox:
-            if inbox.path in subject.path:
-                return inbox.path
+        if os.path.basename(marker) != gc3apps.Default.DEFAULT_FILE_CHECK_MARKER:
+            return marker
+        folder = os.path.dirname(marker)
+        archives = sorted(name for name in os.listdir(folder)
+                          if name.endswith(gc3apps.Default.DEFAULT_EXPERIMENT_FILE_CHECK_MARKER))
+        if archives:
+            return os.path.join(folder, archives[0])
         return None
 
-    def _check_folder_completion_file(self, subject):
+    def _classify(self, experiment_folder, dataset):
         """
-        Check if subject is a folder; then in case check whether
-        the termination file has been written.
-        If so, return the subject_location as a valid folder
-        to process.
+        Return the `DatasetInfo` of archive `dataset` and the data
+        files its folder's pipeline is to process (an empty list if
+        there is no pipeline for its analysis type).
+        Runs in a classifier thread, as it reads the archives.
+        """
+        dataset_info = gc3apps.get_dataset_info(dataset)
+        pipeline_class = self.pipeline_classes.get(dataset_info.analysis_type, None)
+        if pipeline_class is None:
+            return (dataset_info, [])
+        return (dataset_info, gc3apps.pipelines.get_data_files(experiment_folder,
+                                                               pipeline_class.suffix))
+
+    def _record_event(self, location):
         """
-        gc3libs.log.info("Reacting to subject {0}".format(subject))
-        inbox = self._get_inbox_from_subject(subject)
+        Record an event on location against its experiment folder;
+        the folder is processed from `every_main_loop` once
+        events on it have settled.
+        """
+        inbox = self._get_inbox(location)
         if not inbox:
             gc3libs.log.error("Somehow a subject has been created and notified outside "
-                              "the monitored inboxes...".format(subject.path))
+                              "the monitored inboxes: {0}".format(location))
+            return
+        self.metrics.count('events')
+        marker = location if self._is_completion_marker(location) else None
+        if marker:
+            self.metrics.mark(os.path.dirname(location), metrics.DETECTED)
+        self.events.touch(os.path.dirname(location), inbox, marker)
+
+    def _done(self, experiment_folder):
+        """
+        Stop tracking the completion marker of a folder that has been
+        dispatched or rejected: a restarted daemon reports the
+        markers of the other folders again.
+        """
+        if self.scanner:
+            self.scanner.done(experiment_folder)
+
+    def _get_jobname(self, analysis_type, inbox, experiment_folder):
+        return "{0}_{1}".format(analysis_type,
+                                os.path.relpath(experiment_folder, inbox))
+
+    def _check_folder_completion_file(self, experiment_folder, inbox, dataset_info,
+                                      data_files):
+        """
+        Add the pipeline corresponding to the classified experiment
+        folder, processing `data_files`, unless a task with the same
+        jobname is already part of the session.
+        """
+        analysis_type = dataset_info.analysis_type
+        if not analysis_type:
+            gc3libs.log.error("No valid analysis type recognized "
+                              "for {0}".format(experiment_folder))
+            self.metrics.count('experiments_unrecognized')
+            self.metrics.experiments.pop(experiment_folder, None)
+            return
+
+        pipeline_class = self.pipeline_classes.get(analysis_type, None)
+        if pipeline_class is None:
+            gc3libs.log.warning("No pipeline for analysis type {0}: folder {1}"
+                                " not processed.".format(analysis_type,
+                                                         experiment_folder))
+            self.metrics.count('experiments_unsupported')
+            self.metrics.experiments.pop(experiment_folder, None)
+            return
+
+        jobname = self._get_jobname(analysis_type, inbox, experiment_folder)
+        if jobname in self.processed or jobname in self.session.list_names():
+            gc3libs.log.info("Folder {0} already processed as {1}. "
+                             "Ignoring.".format(experiment_folder, jobname))
+            self.metrics.count('experiments_duplicate')
+            self.metrics.experiments.pop(experiment_folder, None)
             return
+        self.processed.add(jobname)
+
+        extra = self.extra.copy()
+        extra['jobname'] = jobname
+        extra['dryrun'] = self.params.dryrun
+        extra['output_dir'] = os.path.join(self.session.path, '.compute', jobname)
 
-        if os.path.basename(subject.path) == gc3apps.Default.DEFAULT_EXPERIMENT_FILE_CHECK_MARKER:
-            experiment_folder = os.path.dirname(subject.path)
-            experiment_folder_name = os.path.dirname(os.path.relpath(subject.path,
-                                                                     inbox))
-
-            analysis_type = gc3apps.get_analysis_type(experiment_folder)
-            if not analysis_type:
-                gc3libs.log.error("No valid analysis type recognized")
-                return
-
-            extra = self.extra.copy()
-            extra['jobname'] = "{0}_{1}".format(analysis_type,
-                                                experiment_folder_name)
-            extra['dryrun'] = self.params.dryrun
-
-            if analysis_type == 'IMC':
-                self.add(
-                    gc3apps.pipelines.IMCPipeline(
-                        os.path.join(inbox,experiment_folder),
-                        self.params.config_file,
-                        **extra))
-            elif analysis_type == 'sMC':
-                self.add(
-                    gc3apps.pipelines.SMCPipeline(
-                        os.path.join(inbox,experiment_folder),
-                        self.params.config_file,
-                        **extra))
+        pipeline = pipeline_class(experiment_folder,
+                                  data_files,
+                                  self.params.config_file,
+                                  **extra)
+        pipeline.share_key = self._get_share_key(inbox, experiment_folder)
+        self.add(pipeline)
+        self.metrics.mark(experiment_folder, metrics.SUBMITTED)
+        self.pipelines[experiment_folder] = pipeline
+
+    def _update_metrics(self):
+        """
+        Record pipelines whose first chunk started running or which
+        terminated, then save and export the metrics.
+        """
+        for experiment_folder, pipeline in list(self.pipelines.items()):
+            if isinstance(pipeline, TaskCollection):
+                tasks = pipeline.iter_workflow()
             else:
-                gc3libs.log.error("No valid analysis type {0}.".format(analysis_type))
-                return
-            
+                tasks = [pipeline]
+            if any(isinstance(task, Application)
+                   and task.execution.state in [Run.State.RUNNING,
+                                                Run.State.TERMINATING,
+                                                Run.State.TERMINATED]
+                   for task in tasks):
+                self.metrics.mark(experiment_folder, metrics.RUNNING)
+            if pipeline.execution.state == Run.State.TERMINATED:
+                if pipeline.execution.returncode != 0:
+                    self.metrics.count('experiments_failed')
+                self.metrics.mark(experiment_folder, metrics.MERGED)
+                del self.pipelines[experiment_folder]
+        try:
+            self.metrics.save(self.metrics_json)
+            self.metrics.write_prometheus(self.params.metrics_file)
+        except (IOError, OSError) as err:
+            gc3libs.log.warning("Cannot write daemon metrics: {0}".format(err))
+
+    def _get_share_key(self, inbox, experiment_folder):
+        """
+        Return the fair-share queue of an experiment: the top-level
+        (user or instrument) folder it was uploaded to.
+        """
+        return os.path.relpath(experiment_folder, inbox).split(os.sep)[0]
+
+    def _share_chunks(self):
+        """
+        Split --max-running-chunks among the throttled chunk
+        collections of all pipelines: first among share keys
+        according to their weights, then evenly among the
+        collections of each key.
+        """
+        groups = dict()
+        collections = dict()
+        for pipeline in self.session.tasks.values():
+            if (not isinstance(pipeline, TaskCollection)
+                    or pipeline.execution.state == Run.State.TERMINATED):
+                continue
+            key = getattr(pipeline, 'share_key', pipeline.jobname)
+            for task in pipeline.iter_workflow():
+                if isinstance(task, ThrottledParallelTaskCollection):
+                    collections[id(task)] = task
+                    groups.setdefault(key, dict())[id(task)] = task.demand()
+        allocation = hierarchical_fill(groups,
+                                       self.params.max_running_chunks,
+                                       self.share_weights)
+        for ident, task in collections.items():
+            if task.max_running != allocation[ident]:
+                task.max_running = allocation[ident]
+                task.changed = True
+
+    def before_main_loop(self):
+        # threads do not survive daemonizing: start them from here
+        self.classifier.start()
+        if self.scan_inboxes:
+            self.scanner = MarkerScanner(
+                self.scan_inboxes,
+                os.path.join(self.session.path,
+                             gc3apps.Default.DAEMON_SCAN_STATE),
+                self._is_completion_marker)
+
+    def after_main_loop(self):
+        self.classifier.stop()
+
+    def every_main_loop(self):
+        """
+        Hand experiment folders whose events have settled over to
+        the classifier threads; add pipelines for the classified ones.
+        """
+        if self.params.max_running_chunks:
+            self._share_chunks()
+        if self.scanner:
+            for marker in self.scanner.scan():
+                self._record_event(marker)
+        for experiment_folder in self.events.expire():
+            gc3libs.log.warning("No completion marker in {0} after {1} seconds:"
+                                " folder ignored.".format(experiment_folder,
+                                                          self.params.marker_timeout))
+            self.metrics.count('folders_expired')
+        self.backlog.extend(self.events.ready())
+        while self.backlog:
+            experiment_folder, inbox, marker = self.backlog[0]
+            dataset = self._get_dataset(marker)
+            if dataset is None:
+                gc3libs.log.error("No dataset archive next to {0}".format(marker))
+                self.metrics.count('classification_errors')
+                self.metrics.experiments.pop(experiment_folder, None)
+                self.backlog.popleft()
+                self._done(experiment_folder)
+                continue
+            if not self.classifier.submit(experiment_folder, experiment_folder, dataset):
+                break
+            gc3libs.log.info("Classifying completed folder {0}".format(experiment_folder))
+            self.classifying[experiment_folder] = inbox
+            self.backlog.popleft()
+
+        dispatched = []
+        for experiment_folder, result in self.classifier.results():
+            inbox = self.classifying.pop(experiment_folder)
+            if isinstance(result, Exception):
+                gc3libs.log.error("Cannot classify {0}: {1}".format(experiment_folder,
+                                                                  result))
+                self.metrics.count('classification_errors')
+                self.metrics.experiments.pop(experiment_folder, None)
+                self._done(experiment_folder)
+                continue
+            dataset_info, data_files = result
+            self.metrics.mark(experiment_folder, metrics.CLASSIFIED)
+            self._check_folder_completion_file(experiment_folder, inbox,
+                                               dataset_info, data_files)
+            dispatched.append(experiment_folder)
+        if dispatched:
+            # record the new pipelines before their markers are forgotten
+            self.session.flush()
+            for experiment_folder in dispatched:
+                self._done(experiment_folder)
+
+        self._update_metrics()
+
     def created(self, inbox, subject):
         """
         Check whether folder has been completed with file_check marker.
         Add a new tast for each completed folder.
         """
-        self._check_folder_completion_file(subject)
+        self._record_event(subject.path)
 
     def modified(self, inbox, subject):
         """
         Check whether folder has been completed with file_check marker.
         Add a new tast for each completed folder.
         """
-        self._check_folder_completion_file(subject)
+        self._record_event(subject.path)
 
 
 ## main: run server
@@ -28,6 +28,9 @@ images=`realpath ./images`
 plugins=`realpath ./plugins`
 mode_list="get_groups run"
 dockerimage="bblab/cellprofiler:3.1.8"
+# overridable from the environment, e.g. to run locally without docker
+docker_run=${GC3APPS_DOCKER_RUN:-sudo docker run}
+mount_point=${GC3APPS_MOUNT_POINT-/mnt/bbvolume}
 
 ## helper functions
 
@@ -86,6 +89,11 @@ Usage:
 
 Run CellProfiler to generate group file.
 
+Environment:
+  GC3APPS_DOCKER_RUN    Container launcher (default: 'sudo docker run')
+  GC3APPS_MOUNT_POINT   Mount point to check (default: /mnt/bbvolume);
+                        set it empty to skip the check
+
 Options:
   -v            Enable verbose logging
   -h            Print this help text
@@ -104,7 +112,9 @@ __EOF__
 
 
 ## check mountpoint
-check_mount /mnt/bbvolume
+if [ -n "$mount_point" ]; then
+    check_mount $mount_point
+fi
 
 
 ## parse command-line
@@ -156,7 +166,7 @@ fi
 # create filelist.txt
 generate_file_list $images $output/filelist.txt
 
-cmd="sudo docker run -v ${output}:/output -v ${pipeline}:/tmp/pipeline.cppipe -v ${output}/filelist.txt:/tmp/filelist.txt -v ${plugins}:${plugins}:ro -v ${images}:${images}:ro ${dockerimage} -c -r --file-list=/tmp/filelist.txt --plugins-directory ${plugins} -p /tmp/pipeline.cppipe -o /output --done-file=/output/done.txt"
+cmd="${docker_run} -v ${output}:/output -v ${pipeline}:/tmp/pipeline.cppipe -v ${output}/filelist.txt:/tmp/filelist.txt -v ${plugins}:${plugins}:ro -v ${images}:${images}:ro ${dockerimage} -c -r --file-list=/tmp/filelist.txt --plugins-directory ${plugins} -p /tmp/pipeline.cppipe -o /output --done-file=/output/done.txt"
 echo -n "Generating CellProfiler Batch ... "
 $cmd 1>${output}/log 2>${output}/err
 
@@ -167,7 +177,7 @@ fi
 echo ["ok"]
 
 echo -n "Generating CellProfiler groups ... "
-cmd="sudo docker run -v ${output}:/output ${dockerimage} -c --print-groups=/output/Batch_data.h5"
+cmd="${docker_run} -v ${output}:/output ${dockerimage} -c --print-groups=/output/Batch_data.h5"
 $cmd 1>${output}/result.json 2>>${output}/err
 
 if ! [ -s ${output}/result.json ]; then
@@ -0,0 +1,79 @@
+#!/bin/bash
+
+#   Copyright (C) 2018, 2019 - bodenmillerlab, University of Zurich
+#
+#  This program is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 2 of the License, or (at your
+#  option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+# -*- coding: utf-8 -*-
+
+me=$(basename "$0")
+
+## usage info
+
+usage () {
+    cat <<__EOF__
+Usage:
+  $me IMAGE OUTPUT [COMMAND [ARGS ...]]
+
+Make sure docker IMAGE is present on this host, then run COMMAND.
+The image is pulled only if it is missing, and by one job at a time
+(lock file '${PULL_LOCK:-/tmp/.gc3apps_pull.lock}'), so that it is
+pulled once per host. Give IMAGE as 'NAME@sha256:DIGEST' to verify
+it by digest. The time spent is written to OUTPUT (tab-separated):
+
+  timestamp  host  image  seconds  status
+
+where status is 'present', 'pulled' or 'failed'; a failed pull is
+left to 'docker run'. The exit code is the one of COMMAND.
+__EOF__
+}
+
+if [ $# -lt 2 ]; then
+    usage
+    exit 1
+fi
+
+image=$1
+output=$2
+shift 2
+lock=${PULL_LOCK:-/tmp/.gc3apps_pull.lock}
+docker=${DOCKER:-sudo docker}
+
+pull () {
+    if $docker image inspect "$image" >/dev/null 2>&1; then
+        echo present
+    elif $docker pull "$image" >/dev/null 2>&1; then
+        echo pulled
+    else
+        echo failed
+    fi
+}
+
+start=$(date +%s)
+if command -v flock >/dev/null 2>&1; then
+    # waiting for another job's pull is part of the pull time
+    status=$( (flock 9; pull) 9>>"$lock" )
+else
+    status=$(pull)
+fi
+end=$(date +%s)
+
+printf "timestamp\thost\timage\tseconds\tstatus\n" > $output
+printf "%s\t%s\t%s\t%s\t%s\n" $end "$(hostname)" "$image" $((end - start)) $status >> $output
+
+if [ $# -gt 0 ]; then
+    "$@"
+fi
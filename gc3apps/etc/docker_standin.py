@@ -0,0 +1,319 @@
+#! /usr/bin/env python
+#
+#   docker_standin.py -- Fake `docker run` for local pipeline runs
+#
+#   Copyright (c) 2018, 2019 S3IT, University of Zurich, http://www.s3it.uzh.ch/
+#
+#   This program is free software: you can redistribute it and/or
+#   modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Stand-in for `docker run` with the CellProfiler, Ilastik and QTL
+images: instead of running the tool, sleep for a configurable time
+and write fake outputs of realistic size and layout, so that the
+pipelines can be driven on a single host without docker or cloud.
+
+Usage (set in the environment of the pipeline script):
+  GC3APPS_DOCKER_RUN="python /path/to/docker_standin.py"
+
+The docker options are parsed for their volumes (`-v HOST:CONTAINER`)
+and container paths in the arguments are mapped back to host paths.
+The image name selects the tool:
+
+  cellprofiler  batch file creation (`--file-list`), `--print-groups`
+                and batch runs (`-r -f START -l END`)
+  ilastik       `./run_ilastik.sh` directly or within `/bin/sh -c`
+  qtl           `PHENOTYPE DATA OUTPUT -b BATCHES -p PERMUTATIONS ...`
+
+`pull IMAGE` and `image inspect IMAGE` are emulated too, with marker
+files standing for the images present on the host; set `DOCKER` to
+the stand-in for `etc/docker_prepull.sh`.
+
+Environment:
+  GC3APPS_STANDIN_SECONDS  seconds per item (image set, image or
+                           permutation batch); default: 0.1
+  GC3APPS_STANDIN_SIZE     bytes of each fake image; default: 1 MiB
+  GC3APPS_STANDIN_ROWS     CellProfiler objects per image set; default: 10
+  GC3APPS_STANDIN_PULL     seconds per image pull; default: 0
+  GC3APPS_STANDIN_IMAGES   folder of the image markers;
+                           default: <tmp>/gc3apps_standin_images
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import random
+import tempfile
+import subprocess
+
+SECONDS = float(os.environ.get('GC3APPS_STANDIN_SECONDS', 0.1))
+SIZE = int(os.environ.get('GC3APPS_STANDIN_SIZE', 1024 * 1024))
+ROWS = int(os.environ.get('GC3APPS_STANDIN_ROWS', 10))
+PULL = float(os.environ.get('GC3APPS_STANDIN_PULL', 0))
+IMAGES = os.environ.get('GC3APPS_STANDIN_IMAGES',
+                        os.path.join(tempfile.gettempdir(), 'gc3apps_standin_images'))
+
+CELLPROFILER_VERSION = '3.1.8'
+
+# `docker run` options taking a value
+_DOCKER_OPTIONS = ['-v', '--volume', '--cidfile', '-e', '--env', '-w',
+                   '--workdir', '--name', '-u', '--user', '--entrypoint']
+_PATH = re.compile(r'/[^\s\'"|;&]*')
+
+
+def parse_docker_args(argv):
+    """
+    Return (mounts, image, args): `mounts` is a list of
+    (container path, host path), longest container path first.
+    """
+    mounts = []
+    n = 0
+    while n < len(argv) and argv[n].startswith('-'):
+        option = argv[n]
+        if option in _DOCKER_OPTIONS:
+            value = argv[n + 1]
+            n += 2
+            if option in ('-v', '--volume'):
+                fields = value.split(':')
+                mounts.append((fields[1].rstrip('/') or '/', fields[0]))
+        else:
+            n += 1
+    if n >= len(argv):
+        raise SystemExit("docker_standin: no image given")
+    mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+    return (mounts, argv[n], argv[n + 1:])
+
+
+def to_host(path, mounts):
+    """
+    Map container `path` to the host path it is mounted from.
+    """
+    for container, host in mounts:
+        if path == container or path.startswith(container + '/'):
+            return host + path[len(container):]
+    return path
+
+
+def translate(arg, mounts):
+    if arg.startswith('-') and '=' in arg:
+        option, value = arg.split('=', 1)
+        return "{0}={1}".format(option, to_host(value, mounts))
+    return to_host(arg, mounts)
+
+
+def _work(items):
+    time.sleep(SECONDS * max(items, 0))
+
+
+def _write_image(location):
+    folder = os.path.dirname(location)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(location, 'wb') as fd:
+        fd.write(b'\0' * SIZE)
+
+
+def _options(args, with_value):
+    """
+    Split `args` into a dictionary of options and a list of
+    positional arguments; `--opt=value` is also accepted.
+    """
+    options = dict()
+    positional = []
+    n = 0
+    while n < len(args):
+        arg = args[n]
+        if arg.startswith('-') and '=' in arg:
+            key, value = arg.split('=', 1)
+            options[key] = value
+        elif arg in with_value:
+            options[arg] = args[n + 1]
+            n += 1
+        elif arg.startswith('-'):
+            options[arg] = True
+        else:
+            positional.append(arg)
+        n += 1
+    return (options, positional)
+
+
+#####################
+# CellProfiler
+#
+
+def _count_image_sets(batch_file):
+    import h5py
+    with h5py.File(batch_file, 'r') as fd:
+        image = '/Measurements/{0}/Image'.format(list(fd['/Measurements'].keys())[0])
+        for field in fd[image].keys():
+            if field.startswith('FileName'):
+                return len(fd[image][field]['data'])
+    return 0
+
+
+def cellprofiler(args):
+    import numpy
+    options, _ = _options(args, ['-p', '-o', '-f', '-l', '--plugins-directory'])
+    if '--print-groups' in options:
+        sets = _count_image_sets(options['--print-groups'])
+        print(json.dumps([[{"Metadata_ImageSet": str(n)}, [n]]
+                          for n in range(1, sets + 1)]))
+        return 0
+
+    output = options['-o']
+    if '--file-list' in options:
+        import h5py
+        with open(options['--file-list']) as fd:
+            images = sorted(line.strip() for line in fd if line.strip())
+        _work(1)
+        if not images:
+            return 1
+        date = time.strftime('%Y-%m-%d-%H-%M-%S')
+        with h5py.File(os.path.join(output, 'Batch_data.h5'), 'w') as fd:
+            fd.create_dataset('/Measurements/{0}/Experiment/CellProfiler_Version/data'.format(date),
+                              data=numpy.array([CELLPROFILER_VERSION], dtype='S'))
+            fd.create_dataset('/Measurements/{0}/Image/PathName_Image/data'.format(date),
+                              data=numpy.array([os.path.dirname(image) for image in images],
+                                               dtype='S'))
+            fd.create_dataset('/Measurements/{0}/Image/FileName_Image/data'.format(date),
+                              data=numpy.array([os.path.basename(image) for image in images],
+                                               dtype='S'))
+        return 0
+
+    start, end = int(options['-f']), int(options['-l'])
+    _work(end - start + 1)
+    with open(os.path.join(output, 'Image.csv'), 'w') as image_fd:
+        with open(os.path.join(output, 'cell.csv'), 'w') as cell_fd:
+            image_fd.write("ImageNumber,Count_cell,FileName_Image\n")
+            cell_fd.write("ImageNumber,ObjectNumber,AreaShape_Area,Intensity_MeanIntensity\n")
+            for number in range(start, end + 1):
+                image_fd.write("{0},{1},image_{0}.tiff\n".format(number, ROWS))
+                for obj in range(1, ROWS + 1):
+                    cell_fd.write("{0},{1},{2},{3:.6f}\n".format(number, obj,
+                                                                 random.randint(50, 500),
+                                                                 random.random()))
+                _write_image(os.path.join(output, 'masks',
+                                          "image_{0}_mask.tiff".format(number)))
+    if '--done-file' in options:
+        with open(options['--done-file'], 'w') as fd:
+            fd.write("Done\n")
+    return 0
+
+
+#####################
+# Ilastik
+#
+
+def ilastik(args):
+    options, inputs = _options(args, ['--export_source', '--export_dtype'])
+    output_format = options['--output_filename_format']
+    images = []
+    for pattern in inputs:
+        images.extend(sorted(glob.glob(pattern)) or [pattern])
+    for image in images:
+        _work(1)
+        nickname = os.path.splitext(os.path.basename(image))[0]
+        _write_image(output_format.replace('{nickname}', nickname))
+    return 0
+
+
+def ilastik_shell(script, mounts):
+    """
+    Run the `/bin/sh -c` command line of the Ilastik templates on
+    the host, with `./run_ilastik.sh` replaced by this stand-in.
+    """
+    if 'run_ilastik.sh' not in script:
+        raise SystemExit("docker_standin: only `./run_ilastik.sh` is emulated")
+    script = _PATH.sub(lambda match: to_host(match.group(0), mounts), script)
+    script = script.replace('./run_ilastik.sh',
+                            "{0} {1} --ilastik".format(sys.executable,
+                                                       os.path.abspath(__file__)))
+    return subprocess.call(['/bin/sh', '-c', script])
+
+
+#####################
+# QTL
+#
+
+def qtl(args):
+    options, positional = _options(args, ['-b', '-p', '-i', '-t', '-m', '-l'])
+    phenotype, _, output = positional[:3]
+    batches = int(options.get('-b', 1))
+    permutations = int(options.get('-p', 1))
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    for batch in range(batches):
+        _work(1)
+        location = os.path.join(output, "{0}_perm_{1}_{2}.txt".format(phenotype,
+                                                                      options.get('-l', 0),
+                                                                      batch))
+        with open(location, 'w') as fd:
+            fd.write("permutation\tstatistic\n")
+            for permutation in range(permutations):
+                fd.write("{0}\t{1:.6f}\n".format(permutation, random.random()))
+    return 0
+
+
+#####################
+# Images
+#
+
+def _image_marker(image):
+    return os.path.join(IMAGES, re.sub(r'[^\w.-]', '_', image))
+
+
+def pull(image):
+    time.sleep(PULL)
+    if not os.path.isdir(IMAGES):
+        os.makedirs(IMAGES)
+    open(_image_marker(image), 'w').close()
+    return 0
+
+
+def inspect(image):
+    return 0 if os.path.exists(_image_marker(image)) else 1
+
+
+def main(argv):
+    if argv and argv[0] == 'pull':
+        return pull(argv[1])
+    if argv[:2] == ['image', 'inspect']:
+        return inspect(argv[2])
+    if argv and argv[0] == '--ilastik':
+        return ilastik(argv[1:])
+    if argv and argv[0] == 'run':
+        argv = argv[1:]
+    mounts, image, args = parse_docker_args(argv)
+    name = image.split('/')[-1].split(':')[0].lower()
+    if 'ilastik' in name:
+        if args[:2] in (['/bin/sh', '-c'], ['sh', '-c']):
+            return ilastik_shell(args[2], mounts)
+        if args and args[0].endswith('run_ilastik.sh'):
+            args = args[1:]
+        return ilastik([translate(arg, mounts) for arg in args])
+    args = [translate(arg, mounts) for arg in args]
+    if 'cellprofiler' in name:
+        return cellprofiler(args)
+    if 'qtl' in name:
+        return qtl(args)
+    raise SystemExit("docker_standin: no stand-in for image '{0}'".format(image))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+#
+#   ilastik_worker.py -- Process chunks of images with one Ilastik session
+#
+#   Copyright (c) 2018, 2019 S3IT, University of Zurich, http://www.s3it.uzh.ch/
+#
+#   This program is free software: you can redistribute it and/or
+#   modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Runs within the Ilastik container with Ilastik's own python.
+Load the project once, then pull chunks of images from a
+`FileWorkQueue` and export them until the queue is drained.
+
+Usage:
+  ilastik_worker.py --queue DIR --worker NAME -- [ilastik headless options]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import traceback
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from workqueue import FileWorkQueue
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue", required=True,
+                        help="Location of the work queue.")
+    parser.add_argument("--worker", required=True,
+                        help="Unique name of this worker.")
+    args, ilastik_args = parser.parse_known_args(argv)
+    if ilastik_args and ilastik_args[0] == '--':
+        ilastik_args = ilastik_args[1:]
+
+    import ilastik_main
+    parsed_args, workflow_args = ilastik_main.parser.parse_known_args(ilastik_args)
+    parsed_args.headless = True
+    # Export settings (format, filename, source, dtype) are consumed
+    # from `workflow_args` by the workflow when the project is loaded.
+    shell = ilastik_main.main(parsed_args, workflow_args)
+    workflow = shell.projectManager.workflow
+    role_name = workflow.ROLE_NAMES[0]
+
+    queue = FileWorkQueue(args.queue)
+    failures = 0
+    while True:
+        item = queue.claim(args.worker)
+        if item is None:
+            break
+        name, images = item
+        print("[{0}] processing chunk {1} ({2} images)".format(args.worker,
+                                                              name,
+                                                              len(images)))
+        sys.stdout.flush()
+        try:
+            workflow.batchProcessingApplet.run_export(
+                OrderedDict([(role_name, images)]),
+                export_to_array=False)
+            queue.complete(args.worker, name)
+        except Exception:
+            traceback.print_exc()
+            queue.fail(args.worker, name)
+            failures += 1
+
+    print("[{0}] queue drained, {1} failed chunks".format(args.worker,
+                                                          failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
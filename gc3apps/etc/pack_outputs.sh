@@ -0,0 +1,59 @@
+#!/bin/bash
+
+#   Copyright (C) 2018, 2019 - bodenmillerlab, University of Zurich
+#
+#  This program is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 2 of the License, or (at your
+#  option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+# -*- coding: utf-8 -*-
+
+me=$(basename "$0")
+
+## usage info
+
+usage () {
+    cat <<__EOF__
+Usage:
+  $me FOLDER ARCHIVE COMMAND [ARGS ...]
+
+Create FOLDER (on local disk), run COMMAND, which is expected to
+write its results there, then pack the contents of FOLDER into the
+compressed tar archive ARCHIVE, to be returned in one transfer.
+The exit code is the one of COMMAND, or 1 if the archive could not
+be written.
+__EOF__
+}
+
+if [ $# -lt 3 ]; then
+    usage
+    exit 1
+fi
+
+folder=$1
+archive=$2
+shift 2
+
+mkdir -p "$folder"
+# containers may not run as the job's user
+chmod 777 "$folder"
+
+"$@"
+rc=$?
+
+if ! tar -C "$folder" -czf "$archive" .; then
+    echo "$me: could not pack $folder into $archive" >&2
+    exit 1
+fi
+exit $rc
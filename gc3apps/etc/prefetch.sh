@@ -0,0 +1,62 @@
+#!/bin/bash
+
+#   Copyright (C) 2018, 2019 - bodenmillerlab, University of Zurich
+#
+#  This program is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 2 of the License, or (at your
+#  option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+# -*- coding: utf-8 -*-
+
+me=$(basename "$0")
+
+## usage info
+
+usage () {
+    cat <<__EOF__
+Usage:
+  $me LIST SCRATCH COMMAND [ARGS ...]
+
+Copy the files listed in LIST (one absolute path per line) to
+SCRATCH, keeping their paths (/a/b.tiff goes to SCRATCH/a/b.tiff),
+in a single sequential stream; then run COMMAND, which is expected
+to read the copies. The exit code is the one of COMMAND, or 1 if
+the files could not be copied.
+__EOF__
+}
+
+if [ $# -lt 3 ]; then
+    usage
+    exit 1
+fi
+
+list=$1
+scratch=$2
+shift 2
+
+mkdir -p "$scratch"
+start=$(date +%s)
+# fail when any stage fails, e.g. on a missing or unreadable file
+set -o pipefail
+sed -e 's|^/||' -e '/^$/d' "$list" \
+    | tar -C / -cf - --files-from=- \
+    | tar -C "$scratch" -xf -
+if [ $? -ne 0 ]; then
+    echo "$me: could not copy the files in $list to $scratch" >&2
+    exit 1
+fi
+set +o pipefail
+echo "$me: copied $(grep -c . "$list") files ($(du -sh "$scratch" | cut -f1)) in $(($(date +%s) - start))s"
+
+"$@"
@@ -0,0 +1,72 @@
+#!/bin/bash
+
+#   Copyright (C) 2018, 2019 - bodenmillerlab, University of Zurich
+#
+#  This program is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 2 of the License, or (at your
+#  option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along
+#  with this program; if not, write to the Free Software Foundation, Inc.,
+#  59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+
+# -*- coding: utf-8 -*-
+
+me=$(basename "$0")
+
+## usage info
+
+usage () {
+    cat <<__EOF__
+Usage:
+  $me INTERVAL OUTPUT COMMAND [ARGS ...]
+
+Run COMMAND and, every INTERVAL seconds, append the resource usage
+of the containers it started to OUTPUT (tab-separated):
+
+  timestamp  container  cpu_percent  memory_usage  block_io
+
+Containers are found through the '--cidfile' files named
+'${CID_PREFIX:-.gc3apps_cid.}*' in the current directory.
+The exit code is the one of COMMAND.
+__EOF__
+}
+
+if [ $# -lt 3 ]; then
+    usage
+    exit 1
+fi
+
+interval=$1
+output=$2
+shift 2
+cid_prefix=${CID_PREFIX:-.gc3apps_cid.}
+docker=${DOCKER:-sudo docker}
+
+printf "timestamp\tcontainer\tcpu_percent\tmemory_usage\tblock_io\n" > $output
+
+"$@" &
+pid=$!
+
+while kill -0 $pid 2>/dev/null; do
+    for cidfile in ${cid_prefix}*; do
+        [ -s "$cidfile" ] || continue
+        cid=$(cat $cidfile)
+        $docker stats --no-stream \
+            --format "{{.CPUPerc}}\t{{.MemUsage}}\t{{.BlockIO}}" $cid 2>/dev/null \
+            | sed "s|^|$(date +%s)\t${cid:0:12}\t|" >> $output
+    done
+    sleep $interval
+done
+
+wait $pid
+rc=$?
+rm -f ${cid_prefix}*
+exit $rc
@@ -0,0 +1,89 @@
+"""
+Pipelines started by the data daemon (`gc3apps.data_daemon`) for
+every completed experiment folder.
+
+`DAEMON_PIPELINES` maps each analysis type to the pipeline the daemon
+runs for it. The IMC and sMC pre-processing steps are not part of
+gc3apps yet, so it is empty: the placeholder pipelines below only run
+one no-op `NotifyApplication` per data file, and the daemon uses them
+only when asked to (``--placeholder-pipelines``), e.g. to try out its
+scheduling.
+"""
+
+import os
+import gc3apps
+from gc3apps import NotifyApplication
+from gc3apps.utils import zipscan
+from gc3apps.workflow import ThrottledParallelTaskCollection
+
+
+def get_data_files(experiment_folder, suffix):
+    """
+    Return the (archive, entry) pairs of the entries ending with
+    `suffix` in the .zip archives of `experiment_folder`.
+    This reads every archive's central directory: call it off the
+    daemon's main loop.
+    """
+    files = []
+    for name in sorted(os.listdir(experiment_folder)):
+        if not name.endswith(gc3apps.Default.DEFAULT_EXPERIMENT_FILE_CHECK_MARKER):
+            continue
+        archive = os.path.join(experiment_folder, name)
+        with open(archive, 'rb') as fd:
+            for entry, _ in zipscan.iter_central_directory(fd):
+                if entry.lower().endswith(suffix):
+                    files.append((archive, entry))
+    return files
+
+
+class PlaceholderPipeline(ThrottledParallelTaskCollection):
+    """
+    Stand-in for the pre-processing of an experiment folder: one
+    `NotifyApplication` (which does nothing) per data file, as listed
+    by `get_data_files`. Tasks are released at most `max_running` at a
+    time; the daemon adjusts `max_running` to share the running chunks
+    between pipelines.
+    """
+
+    analysis_type = None
+    suffix = None
+
+    def __init__(self, experiment_folder, data_files, config_file, **extra_args):
+        self.experiment_folder = experiment_folder
+        self.config_file = config_file
+        self.data_files = list(data_files)
+        output_dir = extra_args.pop('output_dir', os.path.join(os.getcwd(),
+                                                               extra_args['jobname']))
+        tasks = []
+        for n, (archive, entry) in enumerate(self.data_files):
+            extra = extra_args.copy()
+            extra['jobname'] = "{0}_{1}".format(extra_args['jobname'], n)
+            extra['output_dir'] = os.path.join(output_dir, str(n))
+            tasks.append(NotifyApplication(archive,
+                                           self.analysis_type,
+                                           config_file,
+                                           **extra))
+        ThrottledParallelTaskCollection.__init__(self, tasks, **extra_args)
+
+
+class IMCPlaceholderPipeline(PlaceholderPipeline):
+    """
+    Placeholder pipeline with one task per .mcd acquisition.
+    """
+    analysis_type = 'IMC'
+    suffix = '.mcd'
+
+
+class SMCPlaceholderPipeline(PlaceholderPipeline):
+    """
+    Placeholder pipeline with one task per .fcs sample.
+    """
+    analysis_type = 'sMC'
+    suffix = '.fcs'
+
+
+# analysis type -> pipeline class
+DAEMON_PIPELINES = dict()
+PLACEHOLDER_PIPELINES = dict((pipeline.analysis_type, pipeline)
+                             for pipeline in [IMCPlaceholderPipeline,
+                                              SMCPlaceholderPipeline])
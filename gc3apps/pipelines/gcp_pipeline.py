@@ -42,19 +42,28 @@ import os
 import shutil
 import json
 import glob
+import time
+import itertools
 import pandas as pd
 import gc3apps
 import gc3libs
 import gc3apps.utils
+from gc3apps.utils.profiling import ProfileOptions
+from gc3apps.utils.locality import locality_key, split_runs, write_file_list
+from gc3apps.utils.h5parse import CPparser
+from gc3apps.submission import SubmissionOptions
 from gc3libs import Application
 from gc3apps import RunCellprofiler, \
-    RunCellprofilerGetGroups
+    RunCellprofilerGetGroups, CellprofilerChunk, PullImage, write_chunk_config, \
+    unpack_results
+from gc3apps.workflow import ThrottledParallelTaskCollection, \
+    GroupedTaskCollection, LocalityTaskCollection, iter_summaries, with_preflight
 from gc3libs.workflow import StagedTaskCollection, \
     ParallelTaskCollection, SequentialTaskCollection
 from gc3libs.quantity import Memory, kB, MB, MiB, GB, \
     Duration, hours, minutes, seconds
 from gc3libs.cmdline import SessionBasedScript, existing_file, \
-    positive_int, existing_directory
+    positive_int, existing_directory, nonnegative_int
 
 #####################
 # Utilities
@@ -88,11 +97,31 @@ def __csv_handler(source, destination):
                 data = pd.read_csv(csv_file_source)
                 gc3libs.log.debug("Appending content of '{0}' to '{1}'".format(csv_file_source, csv_file_dest))
                 with open(csv_file_dest, 'a') as f:
-                    data.to_csv(csv_file_dest, mode='a', header=f.tell()==0)
+                    data.to_csv(csv_file_dest, mode='a', header=f.tell()==0, index=False)
         return True
     return False
 
 
+def _copytree(source, destination):
+    """
+    Copy the files below `source` into `destination`, keeping the
+    subfolder structure. Existing files are not overwritten.
+    """
+    for path, _, files in os.walk(source):
+        target = os.path.normpath(os.path.join(destination,
+                                               os.path.relpath(path, source)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            target_file = os.path.join(target, name)
+            if os.path.exists(target_file):
+                # .csv files have been merged already
+                if not name.endswith(gc3apps.Default.CSV_SUFFIX):
+                    gc3libs.log.warning("File '{0}' exists already. Not overwritten.".format(target_file))
+                continue
+            shutil.copy2(os.path.join(path, name), target_file)
+
+
 def _combine_cp_directory(source, destination):
     """
     Copies files from a source folder to destination folder, preserving the subfolder
@@ -102,7 +131,7 @@ def _combine_cp_directory(source, destination):
     # check for csv files
     __csv_handler(source, destination)
     # Copy all data from source to destination
-    gc3libs.utils.copytree(source, destination, overwrite=False)
+    _copytree(source, destination)
     #shutil.rmtree(source)
 
 def __group_by_limit(li, limit):
@@ -135,6 +164,17 @@ def _get_chunks(data, chunk_size):
     for chunk in chunks_list:
         yield(chunk[0],chunk[-1])
 
+def _get_locality_chunks(data, chunk_size, keys):
+    """
+    Like `_get_chunks`, but chunks never span image sets with
+    different storage keys (`keys[n]` is the key of image set n+1).
+    Yield (key, first image set, last image set).
+    """
+    images_list = [element[1] for element in data]
+    for key, run in split_runs(images_list, lambda image_sets: keys[image_sets[0] - 1]):
+        for chunk in __group_by_limit(run, chunk_size):
+            yield(key, chunk[0], chunk[-1])
+
 
 #####################
 # StagedTaskCollection class
@@ -146,13 +186,24 @@ class GCellprofilerPipeline(StagedTaskCollection):
     Step1: Generate groups .json file, used to get index size of batch images
     Step2: generate batch and run cellprofiler in batch mode for each batch
     """
-    def __init__(self, cppipe, input_folder, output_folder, chunks, plugins, **extra_args):
+    def __init__(self, cppipe, input_folder, output_folder, chunks, plugins,
+                 compact_tasks=False, group_size=None, rate_limit=None,
+                 prepull_jobs=0, locality=False, locality_re=None,
+                 max_readers=None, prefetch=False, **extra_args):
 
         self.cppipe =  cppipe
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.chunks = chunks
         self.plugins = plugins
+        self.compact_tasks = compact_tasks
+        self.group_size = group_size
+        self.rate_limit = rate_limit
+        self.prepull_jobs = prepull_jobs
+        self.locality = locality
+        self.locality_re = locality_re
+        self.max_readers = max_readers
+        self.prefetch = prefetch
         self.extra = extra_args
 
         StagedTaskCollection.__init__(self)
@@ -189,40 +240,124 @@ class GCellprofilerPipeline(StagedTaskCollection):
             data = json.load(json_file)
 
         batch_file = self.tasks[0].batch_file
+        if self.compact_tasks:
+            chunk_config = self._write_chunk_config(batch_file)
+
+        if self.locality or self.prefetch:
+            image_files = CPparser(batch_file).image_files()
+        if self.locality:
+            chunks = _get_locality_chunks(data, self.chunks,
+                                          [locality_key(files[0], self.locality_re)
+                                           for files in image_files])
+        else:
+            chunks = ((None, start, end) for start, end in _get_chunks(data, self.chunks))
 
         tasks = []
-        for start,end in _get_chunks(data, self.chunks):
+        keys = []
+        for key,start,end in chunks:
             jobname = self.extra["jobname"]
             extra_args = self.extra.copy()
             extra_args['jobname'] = "cp_run_{0}-{1}".format(start,end)
             extra_args['output_dir'] = os.path.join(extra_args['output_dir'],
                                                     extra_args['jobname'])
+            if self.prefetch:
+                prefetch_list = write_file_list(itertools.chain(*image_files[start - 1:end]),
+                                                self._prefetch_list().format(start=start,
+                                                                             end=end))
+                if not self.compact_tasks:
+                    extra_args['prefetch'] = prefetch_list
+            keys.append(key)
             output_folder_batch = os.path.join(self.output_folder,"output_{0}-{1}".format(start,end))
             if not os.path.exists(output_folder_batch):
                 gc3libs.log.debug("Creating new batch folder at {0}.".format(output_folder_batch))
                 os.makedirs(output_folder_batch)
                 os.chmod(output_folder_batch, 0777)
-            tasks.append(RunCellprofiler(batch_file,
-                                         output_folder_batch,
-                                         start,
-                                         end,
-                                         self.plugins,
-                                         **extra_args))
-        return ParallelTaskCollection(tasks)
+            if self.compact_tasks:
+                tasks.append(CellprofilerChunk(chunk_config,
+                                               start,
+                                               end,
+                                               **extra_args))
+            else:
+                tasks.append(RunCellprofiler(batch_file,
+                                             output_folder_batch,
+                                             start,
+                                             end,
+                                             self.plugins,
+                                             **extra_args))
+        if self.locality:
+            chunks = LocalityTaskCollection(tasks, keys, self.max_readers,
+                                            self.group_size, self.rate_limit,
+                                            jobname="cp_run")
+        elif self.group_size:
+            chunks = GroupedTaskCollection(tasks, self.group_size,
+                                           rate_limit=self.rate_limit,
+                                           jobname="cp_run")
+        else:
+            chunks = ThrottledParallelTaskCollection(tasks, rate_limit=self.rate_limit)
+        return with_preflight(self._pull_tasks(), chunks, jobname="cp_run")
+
+    def _prefetch_list(self):
+        """
+        Return the location of the image lists of the chunks,
+        with `{start}` and `{end}` placeholders.
+        """
+        return os.path.join(self.extra['output_dir'], 'inputs', "{start}-{end}.txt")
+
+    def _pull_tasks(self):
+        """
+        Return `self.prepull_jobs` `PullImage` tasks, which warm up
+        the hosts the chunks will run on.
+        """
+        image = self.extra.get('docker_image', None) or \
+            gc3apps.Default.DEFAULT_CELLPROFILER_DOCKER
+        tasks = []
+        for n in range(self.prepull_jobs):
+            extra_args = self.extra.copy()
+            extra_args['jobname'] = "cp_prepull_{0}".format(n)
+            extra_args['output_dir'] = os.path.join(extra_args['output_dir'],
+                                                    extra_args['jobname'])
+            tasks.append(PullImage(image, CellprofilerChunk.application_name,
+                                   **extra_args))
+        return tasks
+
+    def _write_chunk_config(self, batch_file):
+        """
+        Write the settings shared by all `CellprofilerChunk` tasks,
+        the same `RunCellprofiler` would use.
+        """
+        return write_chunk_config(os.path.join(self.extra['output_dir'],
+                                               gc3apps.Default.CHUNK_CONFIG_FILE),
+                                  gc3apps.Default.CELLPROFILER_DOCKER_COMMAND,
+                                  {batch_file: os.path.basename(batch_file)},
+                                  os.path.join(self.output_folder, "output_{start}-{end}"),
+                                  self.extra.get('sample_resources', None),
+                                  self.extra.get('prepull', False),
+                                  self._prefetch_list() if self.prefetch else None,
+                                  self.extra.get('pack_outputs', False),
+                                  batch_file="$PWD/{0}".format(os.path.basename(batch_file)),
+                                  data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                  docker_image=self.extra.get('docker_image', None) or \
+                                      gc3apps.Default.DEFAULT_CELLPROFILER_DOCKER,
+                                  plugins=self.plugins)
 
     def stage2(self):
         """
         Take all results from stage1 that completed successfully,
         move them to `self.output_folder`
         merge .csv files into one in case
+        Results returned packed are unpacked into their chunk folder first.
         """
         rc = self.tasks[1].execution.returncode
-        for task in self.tasks[1].iter_tasks():
-            if isinstance(task, RunCellprofiler) and task.execution.returncode == 0:
+        start = time.time()
+        for task in iter_summaries(self.tasks[1]):
+            if task.output_folder and task.returncode == 0:
+                if task.output_dir:
+                    unpack_results(task.output_dir, task.output_folder)
                 _combine_cp_directory(task.output_folder,self.output_folder)
+        self.merge_time = time.time() - start
         return rc
 
-class GCellprofilerPipelineScript(SessionBasedScript):
+class GCellprofilerPipelineScript(ProfileOptions, SubmissionOptions, SessionBasedScript):
     """
     The ``gcp_pipeline`` command keeps a record of jobs (submitted, executed
     and pending) in a session file (set name with the ``-s`` option); at
@@ -272,6 +407,78 @@ class GCellprofilerPipelineScript(SessionBasedScript):
                        dest="docker_image",
                        help="Docker image that runs the gcp pipeline.")
 
+        self.add_param("--compact-tasks", action="store_true",
+                       dest="compact_tasks", default=False,
+                       help="Store only the image set range of each chunk in"
+                       " the session and build its command line at submission."
+                       " Use for runs with many thousands of chunks.")
+
+        self.add_param("--group-size", metavar="[INT]",
+                       type=positive_int,
+                       dest="group_size", default=None,
+                       help="Run chunks in groups of this size; finished groups"
+                       " are reduced to a summary and no longer polled."
+                       " Default: a single group.")
+
+        self.setup_submission_options()
+
+        self.add_param("--prepull", action="store_true",
+                       dest="prepull", default=False,
+                       help="Make sure the docker image is present on the"
+                       " execution host before each job starts: it is"
+                       " pulled once per host and the time spent is"
+                       " reported apart from the run time by '--profile'."
+                       " Give '--docker NAME@sha256:DIGEST' to verify the"
+                       " image by digest.")
+
+        self.add_param("--prepull-jobs", metavar="[INT]",
+                       type=nonnegative_int,
+                       dest="prepull_jobs", default=0,
+                       help="Before running the chunks, run this many jobs"
+                       " that only pull the docker image, to warm up the"
+                       " execution hosts; use with '--vm-idle-time' so that"
+                       " the VMs are kept for the chunks. Best effort: jobs"
+                       " are not pinned to hosts, so some hosts may get"
+                       " several of them and others none; use '--prepull'"
+                       " to be sure every host has the image."
+                       " Default: '%(default)s'.")
+
+        self.add_param("--locality", action="store_true",
+                       dest="locality", default=False,
+                       help="Plan chunks so that each reads images from a single"
+                       " directory (or '--locality-re' key) and run them per"
+                       " key, see '--max-readers'.")
+
+        self.add_param("--locality-re", metavar="[REGEXP]",
+                       type=str,
+                       dest="locality_re", default=None,
+                       help="With '--locality', key images by the first group"
+                       " of this regular expression in their path, e.g."
+                       " 'Plate_([0-9]+)' or '^(/mnt/bbvolume/[^/]+)'."
+                       " Default: their directory.")
+
+        self.add_param("--max-readers", metavar="[INT]",
+                       type=positive_int,
+                       dest="max_readers", default=None,
+                       help="With '--locality', run at most this many chunks"
+                       " reading from the same key at a time. Default: no limit.")
+
+        self.add_param("--prefetch", action="store_true",
+                       dest="prefetch", default=False,
+                       help="Copy the images of each chunk to the job's local"
+                       " scratch folder in one sequential transfer before"
+                       " CellProfiler starts.")
+
+        self.add_param("--pack-outputs", action="store_true",
+                       dest="pack_outputs", default=False,
+                       help="Write the results of each chunk to the job's"
+                       " local working directory instead of the output"
+                       " folder, and return them as a single compressed"
+                       " archive ('{0}') that is unpacked when merging."
+                       .format(gc3apps.Default.OUTPUT_ARCHIVE))
+
+        self.setup_profile_options()
+
     def parse_args(self):
 	"""
 	Declare command line arguments.
@@ -293,10 +500,21 @@ class GCellprofilerPipelineScript(SessionBasedScript):
                                                 '.compute',
                                                 extra_args['jobname'])
         extra_args['docker_image'] = self.params.docker_image
+        extra_args['sample_resources'] = self.params.sample_resources
+        extra_args['prepull'] = self.params.prepull
+        extra_args['pack_outputs'] = self.params.pack_outputs
 
         return [GCellprofilerPipeline(self.params.cppipe,
                                       self.params.input_folder,
                                       self.params.output_folder,
                                       self.params.chunks,
                                       self.params.plugins,
+                                      compact_tasks=self.params.compact_tasks,
+                                      group_size=self.params.group_size,
+                                      rate_limit=self._rate_limit(),
+                                      prepull_jobs=self.params.prepull_jobs,
+                                      locality=self.params.locality,
+                                      locality_re=self.params.locality_re,
+                                      max_readers=self.params.max_readers,
+                                      prefetch=self.params.prefetch,
                                       **extra_args)]
@@ -45,6 +45,9 @@ import gc3libs
 from gc3libs import Application
 from gc3apps import RunCellprofiler, \
     RunCellprofilerGetGroupsWithBatchFile
+from gc3apps.workflow import ThrottledParallelTaskCollection
+from gc3apps.utils.profiling import ProfileOptions
+from gc3apps.submission import SubmissionOptions
 from gc3libs.workflow import StagedTaskCollection, \
     ParallelTaskCollection, SequentialTaskCollection
 from gc3libs.quantity import Memory, kB, MB, MiB, GB, \
@@ -92,14 +95,17 @@ class GCellprofilerPipelineWithBatchFile(StagedTaskCollection):
     """
     Staged collection:
     Step1: Generate groups .json file, used to get index size of batch images
-    Step2: generate batch and run cellprofiler in batch mode for each batch
+    Step2: generate batch and run cellprofiler in batch mode for each batch,
+           releasing the chunks at most as fast as `rate_limit` allows
     """
-    def __init__(self, batch_file, output_folder, chunks, plugins, **extra_args):
+    def __init__(self, batch_file, output_folder, chunks, plugins, rate_limit=None,
+                 **extra_args):
 
         self.batch_file = batch_file
         self.output_folder = output_folder
         self.chunks = chunks
         self.plugins = plugins
+        self.rate_limit = rate_limit
         self.extra = extra_args
 
         StagedTaskCollection.__init__(self)
@@ -150,10 +156,10 @@ class GCellprofilerPipelineWithBatchFile(StagedTaskCollection):
                                          end,
                                          self.plugins,
                                          **extra_args))
-        return ParallelTaskCollection(tasks)
+        return ThrottledParallelTaskCollection(tasks, rate_limit=self.rate_limit)
 
 
-class GCellprofilerPipelineScriptWithBatchFile(SessionBasedScript):
+class GCellprofilerPipelineScriptWithBatchFile(ProfileOptions, SubmissionOptions, SessionBasedScript):
     """
     The ``gcp_pipeline`` command keeps a record of jobs (submitted, executed
     and pending) in a session file (set name with the ``-s`` option); at
@@ -200,6 +206,10 @@ class GCellprofilerPipelineScriptWithBatchFile(SessionBasedScript):
                        dest="docker_image",
                        help="Docker image that runs the gcp pipeline.")
 
+        self.setup_submission_options()
+
+        self.setup_profile_options()
+
     def parse_args(self):
 	"""
 	Declare command line arguments.
@@ -220,9 +230,11 @@ class GCellprofilerPipelineScriptWithBatchFile(SessionBasedScript):
                                                 '.compute',
                                                 extra_args['jobname'])
         extra_args['docker_image'] = self.params.docker_image
+        extra_args['sample_resources'] = self.params.sample_resources
 
         return [GCellprofilerPipelineWithBatchFile(self.params.batch_file,
                                       self.params.output_folder,
                                       self.params.chunks,
                                       self.params.plugins,
+                                      rate_limit=self._rate_limit(),
                                       **extra_args)]
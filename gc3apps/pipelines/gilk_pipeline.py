@@ -39,16 +39,26 @@ import os
 import re
 import json
 import shutil
+import time
 import gc3apps
 import gc3libs
 from gc3libs import Application
-from gc3apps.apps import RunIlastik
+from gc3libs import Run
+from gc3apps import RunIlastik, RunIlastikWorker, IlastikChunk, PullImage, \
+    write_chunk_config, unpack_results
+from gc3apps.utils.workqueue import FileWorkQueue
+from gc3apps.workflow import ThrottledParallelTaskCollection, \
+    GroupedTaskCollection, LocalityTaskCollection, with_preflight, \
+    iter_summaries
+from gc3apps.utils.locality import locality_key, split_runs
+from gc3apps.utils.profiling import ProfileOptions
+from gc3apps.submission import SubmissionOptions
 from gc3libs.workflow import StagedTaskCollection, \
-    ParallelTaskCollection, SequentialTaskCollection
+    ParallelTaskCollection, SequentialTaskCollection, TaskCollection
 from gc3libs.quantity import Memory, kB, MB, MiB, GB, \
     Duration, hours, minutes, seconds
 from gc3libs.cmdline import SessionBasedScript, existing_file, \
-    positive_int, existing_directory
+    positive_int, existing_directory, nonnegative_int
 
 #####################
 # StagedTaskCollection class
@@ -62,11 +72,23 @@ def _get_images(input_folder, input_re):
             ]
 
 def _get_chunks(seq, size):
-    for index in range(0, len(seq)-1):
-        if (index + size) > (len(seq)-1):
-            yield seq[index:]
-        else:
-            yield seq[index:index+size]
+    for index in range(0, len(seq), size):
+        yield seq[index:index+size]
+
+
+def _write_input_list(images, location):
+    """
+    Write one image path per line into `location`.
+    Used to hand a chunk over to Ilastik without passing
+    every image on the command line.
+    """
+    folder = os.path.dirname(location)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(location, 'w') as fd:
+        for image in images:
+            fd.write("{0}\n".format(image))
+    return location
 
 
 def _copy_ilastik_file(path_source, fol_source, fol_target):
@@ -161,7 +183,71 @@ def _combine_directories(fols_input, fol_out):
 #         return ParallelTaskCollection.__init__(self, self.tasks)
 
 
-class GIlastikPipelineScript(SessionBasedScript):
+class GIlastikWorkerPool(ParallelTaskCollection):
+    """
+    Runs a pool of `RunIlastikWorker` jobs draining a `FileWorkQueue`
+    of image chunks.
+    Per-chunk completion is tracked in `self.chunks`; chunks held by
+    a worker that terminated are put back into the queue so that
+    the remaining workers can pick them up. If no worker is left to
+    do so, a terminated one is resubmitted, at most `max_retries`
+    times over the life of the pool.
+    """
+    def __init__(self, queue, tasks, max_retries=3, **extra_args):
+        self.queue = queue
+        self.chunks = dict()
+        self.max_retries = max_retries
+        self.retries = 0
+        # workers whose chunks were requeued since they last terminated
+        self.requeued = set()
+        ParallelTaskCollection.__init__(self, tasks, **extra_args)
+
+    def update_state(self, **extra_args):
+        TaskCollection.update_state(self, **extra_args)
+        queue = FileWorkQueue(self.queue)
+        for task in self.tasks:
+            if task.execution.state == Run.State.TERMINATED \
+                    and task.jobname not in self.requeued:
+                self.requeued.add(task.jobname)
+                for chunk in queue.requeue(worker=task.jobname):
+                    gc3libs.log.warning("Worker {0} terminated while processing "
+                                        "chunk {1}: chunk queued again.".format(task.jobname,
+                                                                                chunk))
+        self.chunks = queue.status()
+        if self.tasks and 'pending' in self.chunks.values() \
+                and self.retries < self.max_retries \
+                and all(task.execution.state == Run.State.TERMINATED
+                        for task in self.tasks):
+            self._resubmit(self.tasks[self.retries % len(self.tasks)])
+        self.execution.state = self._state()
+        return self.execution.state
+
+    def _resubmit(self, task):
+        """
+        Run terminated worker `task` again to drain the queue.
+        """
+        gc3libs.log.warning("No worker left for the pending chunks:"
+                            " resubmitting worker {0}.".format(task.jobname))
+        self.retries += 1
+        self.requeued.discard(task.jobname)
+        # the engine resets the task with `redo()`
+        task.submit(resubmit=True)
+        self.changed = True
+
+    def terminated(self):
+        """
+        Fail if some chunks have not been processed.
+        """
+        ParallelTaskCollection.terminated(self)
+        self.chunks = FileWorkQueue(self.queue).status()
+        left = [chunk for chunk, state in self.chunks.items() if state != 'done']
+        if left:
+            gc3libs.log.error("{0} chunks not processed: {1}".format(len(left),
+                                                                    ' '.join(sorted(left))))
+            self.execution.returncode = (0, 1)
+
+
+class GIlastikPipelineScript(ProfileOptions, SubmissionOptions, SessionBasedScript):
     """
     The ``gilastik_pipeline`` command keeps a record of jobs (submitted, executed
     and pending) in a session file (set name with the ``-s`` option); at
@@ -203,7 +289,9 @@ class GIlastikPipelineScript(SessionBasedScript):
         self.add_param("-K", "--chunks", metavar="[INT]",
                        type=positive_int,
                        dest="chunks", default=30,
-                       help="Chunk size for each batch run. Default: '%(default)s'.")
+                       help="Chunk size for each batch run. Images are handed over " \
+                       "to Ilastik through a file list, so the chunk size is " \
+                       "not bound by the command line length. Default: '%(default)s'.")
 
         self.add_param("-dtype", "--export_dtype", metavar="[OUTPUT DTYPE]",
                        type=str,
@@ -229,6 +317,93 @@ class GIlastikPipelineScript(SessionBasedScript):
                        dest="docker_image",
                        help="Docker image that runs the gilk pipeline.")
 
+        self.add_param("-W", "--workers", metavar="[INT]",
+                       type=positive_int,
+                       dest="workers", default=None,
+                       help="Run this many persistent Ilastik workers that load "
+                       "the project once and pull chunks from a work queue, "
+                       "instead of one job per chunk. Default: one job per chunk.")
+
+        self.add_param("--queue", metavar="[PATH]",
+                       type=str,
+                       dest="queue", default=None,
+                       help="Location of the work queue used with '--workers'. "
+                       "Must be reachable from all execution hosts. "
+                       "Default: '<output_folder>/.queue'.")
+
+        self.add_param("--compact-tasks", action="store_true",
+                       dest="compact_tasks", default=False,
+                       help="Store only the image range of each chunk in the"
+                       " session and build its command line at submission."
+                       " Use for runs with many thousands of chunks.")
+
+        self.add_param("--group-size", metavar="[INT]",
+                       type=positive_int,
+                       dest="group_size", default=None,
+                       help="Run chunks in groups of this size; finished groups"
+                       " are reduced to a summary and no longer polled."
+                       " Default: every chunk on its own.")
+
+        self.setup_submission_options()
+
+        self.add_param("--prepull", action="store_true",
+                       dest="prepull", default=False,
+                       help="Make sure the docker image is present on the"
+                       " execution host before each job starts: it is"
+                       " pulled once per host and the time spent is"
+                       " reported apart from the run time by '--profile'."
+                       " Give '--docker NAME@sha256:DIGEST' to verify the"
+                       " image by digest.")
+
+        self.add_param("--prepull-jobs", metavar="[INT]",
+                       type=nonnegative_int,
+                       dest="prepull_jobs", default=0,
+                       help="Before running the chunks, run this many jobs"
+                       " that only pull the docker image, to warm up the"
+                       " execution hosts; use with '--vm-idle-time' so that"
+                       " the VMs are kept for the chunks. Best effort: jobs"
+                       " are not pinned to hosts, so some hosts may get"
+                       " several of them and others none; use '--prepull'"
+                       " to be sure every host has the image."
+                       " Default: '%(default)s'.")
+
+        self.add_param("--locality", action="store_true",
+                       dest="locality", default=False,
+                       help="Plan chunks so that each reads images from a single"
+                       " directory (or '--locality-re' key) and run them per"
+                       " key, see '--max-readers'. Not used with '--workers'.")
+
+        self.add_param("--locality-re", metavar="[REGEXP]",
+                       type=str,
+                       dest="locality_re", default=None,
+                       help="With '--locality', key images by the first group"
+                       " of this regular expression in their path, e.g."
+                       " 'Plate_([0-9]+)' or '^(/mnt/bbvolume/[^/]+)'."
+                       " Default: their directory.")
+
+        self.add_param("--max-readers", metavar="[INT]",
+                       type=positive_int,
+                       dest="max_readers", default=None,
+                       help="With '--locality', run at most this many chunks"
+                       " reading from the same key at a time. Default: no limit.")
+
+        self.add_param("--prefetch", action="store_true",
+                       dest="prefetch", default=False,
+                       help="Copy the images of each chunk to the job's local"
+                       " scratch folder in one sequential transfer before"
+                       " Ilastik starts. Not used with '--workers'.")
+
+        self.add_param("--pack-outputs", action="store_true",
+                       dest="pack_outputs", default=False,
+                       help="Write the results of each chunk to the job's"
+                       " local working directory instead of the output"
+                       " folder, and return them as a single compressed"
+                       " archive ('{0}') that is unpacked into the output"
+                       " folder. Not used with '--workers'."
+                       .format(gc3apps.Default.OUTPUT_ARCHIVE))
+
+        self.setup_profile_options()
+
     def parse_args(self):
 	"""
 	Declare command line arguments.
@@ -236,36 +411,202 @@ class GIlastikPipelineScript(SessionBasedScript):
 	self.params.project_file = os.path.abspath(self.params.project_file)
 	self.params.input_folder = os.path.abspath(self.params.input_folder)
 	self.params.output_folder = os.path.abspath(self.params.output_folder)
+	if self.params.queue is None:
+	    self.params.queue = os.path.join(self.params.output_folder, '.queue')
+	self.params.queue = os.path.abspath(self.params.queue)
 
     def new_tasks(self, extra):
         """
         Chunk initial input file
         For each chunked fule, generate a new GfittingaddmTask
         """
+        if self.params.workers:
+            return [self._new_worker_pool(extra)]
+        chunks = self._chunks()
+        keys = [key for key, images in chunks]
+        if self.params.compact_tasks:
+            return self._grouped(self._new_compact_tasks(extra, chunks), extra, keys)
+
         tasks = []
-        for images in _get_chunks(_get_images(self.params.input_folder,
-                                               self.params.input_re),
-                                   self.params.chunks):
+        jobname = os.path.basename(self.params.project_file)
+        compute_dir = os.path.join(os.path.abspath(self.session.path),
+                                   '.compute',
+                                   jobname)
+        for runnr, (key, images) in enumerate(chunks):
 
             extra_args = extra.copy()
-            extra_args['jobname'] = os.path.basename(self.params.project_file)
+            extra_args['jobname'] = "ilastik_run_{0}".format(runnr)
 
-            extra_args['output_dir'] = os.path.join(os.path.abspath(self.session.path),
-                                                    '.compute',
+            extra_args['output_dir'] = os.path.join(compute_dir,
                                                     extra_args['jobname'])
             extra_args['docker_image'] = self.params.docker_image
+            extra_args['sample_resources'] = self.params.sample_resources
+            extra_args['prepull'] = self.params.prepull
+            extra_args['pack_outputs'] = self.params.pack_outputs
+            input_list = _write_input_list(images,
+                                           os.path.join(compute_dir,
+                                                        'inputs',
+                                                        "{0}.txt".format(extra_args['jobname'])))
+            if self.params.prefetch:
+                extra_args['prefetch'] = input_list
             tasks.append(RunIlastik(self.params.project_file,
-                                    images,
+                                    input_list,
                                     self.params.output_folder,
                                     self.params.export_source,
                                     self.params.export_dtype,
                                     self.params.output_filename,
                                     **extra_args))
+        return self._grouped(tasks, extra, keys)
+
+    def _chunks(self):
+        """
+        Return the (storage key, images) pairs of all chunks; with
+        `--locality`, chunks do not span keys, else keys are None.
+        """
+        images = _get_images(self.params.input_folder, self.params.input_re)
+        if not self.params.locality:
+            return [(None, chunk) for chunk in _get_chunks(images, self.params.chunks)]
+        key = lambda image: locality_key(image, self.params.locality_re)
+        images.sort(key=key)
+        return [(value, chunk)
+                for value, run in split_runs(images, key)
+                for chunk in _get_chunks(run, self.params.chunks)]
+
+    def _grouped(self, tasks, extra, keys):
+        """
+        Return `tasks` as a single `LocalityTaskCollection` if
+        `--locality` is set, as a single `GroupedTaskCollection`
+        if `--group-size` is set, or as a single rate-limited
+        `ThrottledParallelTaskCollection` if `--submit-rate` is set,
+        preceded by the image pulls of `--prepull-jobs`.
+        """
+        rate_limit = self._rate_limit()
+        if self.params.locality:
+            chunks = LocalityTaskCollection(tasks, keys, self.params.max_readers,
+                                            self.params.group_size, rate_limit,
+                                            jobname="ilastik_run")
+        elif self.params.group_size:
+            chunks = GroupedTaskCollection(tasks, self.params.group_size,
+                                           rate_limit=rate_limit,
+                                           jobname="ilastik_run")
+        elif rate_limit or self.params.prepull_jobs:
+            chunks = ThrottledParallelTaskCollection(tasks, rate_limit=rate_limit,
+                                                     jobname="ilastik_run")
+        else:
+            return tasks
+        return [with_preflight(self._pull_tasks(extra), chunks, jobname="ilastik_run")]
+
+    def _pull_tasks(self, extra):
+        """
+        Return `--prepull-jobs` `PullImage` tasks, which warm up
+        the hosts the chunks will run on.
+        """
+        compute_dir = os.path.join(os.path.abspath(self.session.path),
+                                   '.compute',
+                                   os.path.basename(self.params.project_file))
+        tasks = []
+        for n in range(self.params.prepull_jobs):
+            extra_args = extra.copy()
+            extra_args['jobname'] = "ilastik_prepull_{0}".format(n)
+            extra_args['output_dir'] = os.path.join(compute_dir,
+                                                    extra_args['jobname'])
+            tasks.append(PullImage(self.params.docker_image or gc3apps.Default.DEFAULT_ILASTIK_DOCKER,
+                                   IlastikChunk.application_name,
+                                   **extra_args))
         return tasks
 
+    def _new_compact_tasks(self, extra, chunks):
+        """
+        Create one `IlastikChunk` per chunk of images, sharing
+        the settings `RunIlastik` would use.
+        """
+        jobname = os.path.basename(self.params.project_file)
+        compute_dir = os.path.join(os.path.abspath(self.session.path),
+                                   '.compute',
+                                   jobname)
+        output_filename = self.params.output_filename
+        if output_filename is None:
+            output_filename = '{{nickname}}_{outtype}.tiff'.format(
+                outtype=filter(str.isalnum, self.params.export_source))
+        input_list = os.path.join(compute_dir, 'inputs', "{start}-{end}.txt")
+        chunk_config = write_chunk_config(
+            os.path.join(compute_dir, gc3apps.Default.CHUNK_CONFIG_FILE),
+            gc3apps.Default.ILASTIK_DOCKER_FILELIST_COMMAND,
+            {self.params.project_file: os.path.basename(self.params.project_file),
+             input_list: gc3apps.Default.ILASTIK_INPUT_LIST},
+            self.params.output_folder,
+            self.params.sample_resources,
+            self.params.prepull,
+            input_list if self.params.prefetch else None,
+            self.params.pack_outputs,
+            project_file="$PWD/{0}".format(os.path.basename(self.params.project_file)),
+            project=gc3apps.Default.ILASTIK_PROJECT,
+            data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+            docker_image=self.params.docker_image or gc3apps.Default.DEFAULT_ILASTIK_DOCKER,
+            input_list="$PWD/{0}".format(gc3apps.Default.ILASTIK_INPUT_LIST),
+            export_source=self.params.export_source,
+            export_dtype=self.params.export_dtype,
+            output_filename=output_filename)
+
+        tasks = []
+        start = 1
+        for runnr, (key, images) in enumerate(chunks):
+            end = start + len(images) - 1
+            _write_input_list(images, input_list.format(start=start, end=end))
+            extra_args = extra.copy()
+            extra_args['jobname'] = "ilastik_run_{0}".format(runnr)
+            extra_args['output_dir'] = os.path.join(compute_dir,
+                                                    extra_args['jobname'])
+            tasks.append(IlastikChunk(chunk_config, start, end, **extra_args))
+            start = end + 1
+        return tasks
+
+    def _new_worker_pool(self, extra):
+        """
+        Fill the work queue with image chunks and
+        create the persistent workers draining it.
+        """
+        queue = FileWorkQueue(self.params.queue)
+        known = queue.status()
+        for runnr, images in enumerate(_get_chunks(_get_images(self.params.input_folder,
+                                                               self.params.input_re),
+                                                   self.params.chunks)):
+            chunk = "chunk_{0:06d}".format(runnr)
+            if chunk not in known:
+                queue.put(chunk, images)
+
+        compute_dir = os.path.join(os.path.abspath(self.session.path),
+                                   '.compute',
+                                   os.path.basename(self.params.project_file))
+        tasks = []
+        for worker in range(self.params.workers):
+            extra_args = extra.copy()
+            extra_args['jobname'] = "ilastik_worker_{0}".format(worker)
+            extra_args['output_dir'] = os.path.join(compute_dir,
+                                                    extra_args['jobname'])
+            extra_args['docker_image'] = self.params.docker_image
+            extra_args['sample_resources'] = self.params.sample_resources
+            extra_args['prepull'] = self.params.prepull
+            tasks.append(RunIlastikWorker(self.params.project_file,
+                                          self.params.queue,
+                                          self.params.output_folder,
+                                          self.params.export_source,
+                                          self.params.export_dtype,
+                                          self.params.output_filename,
+                                          **extra_args))
+        return GIlastikWorkerPool(self.params.queue, tasks,
+                                  jobname="ilastik_workers")
+
     def after_main_loop(self):
+        start = time.time()
+        for task in self.session.tasks.values():
+            for summary in iter_summaries(task):
+                if summary.output_dir:
+                    unpack_results(summary.output_dir, self.params.output_folder)
         glob_infols = 'output_*'
         fol_out = self.params.output_folder
         fol_input = fol_out
         dirs_input = glob.glob(os.path.join(fol_input, glob_infols))
         _combine_directories(dirs_input, fol_out)
+        if self.params.profile:
+            self._write_profile(time.time() - start)
@@ -38,17 +38,298 @@ if __name__ == "__main__":
 
 import os
 import json
+import glob
+import math
+import time
 import gc3apps
 import gc3libs
-from gc3libs import Application
+from gc3libs import Application, Run
 from gc3apps import QTLApplication
+from gc3apps.utils.profiling import ProfileOptions
+from gc3apps.submission import SubmissionOptions
+from gc3apps.utils.nullstore import NullDistributionStore, read_statistics, \
+    empirical_pvalue, wilson_interval
+from gc3libs.workflow import StagedTaskCollection, ParallelTaskCollection
+from gc3libs.quantity import Duration, seconds
 from gc3libs.cmdline import SessionBasedScript, existing_file, \
     positive_int, existing_directory, nonnegative_int
 
+# Permutation batches per job when no target walltime is given; not
+# derived from the cost model, see `Default.QTL_SECONDS_PER_TREE`
 BATCH_THRESHOLD = 1000
 
 
-class GQTLScript(SessionBasedScript):
+def _get_batch_size(permutations, imputations, trees, target, seconds_per_tree=None):
+    """
+    Return the number of permutation batches that fit in one
+    job running `target` seconds according to the
+    `QTLApplication` cost model (at least one: if a single batch
+    does not fit, a warning is logged).
+    """
+    cost = QTLApplication.estimated_runtime(1,
+                                            permutations,
+                                            imputations,
+                                            trees,
+                                            seconds_per_tree)
+    if cost > target:
+        gc3libs.log.warning("A single permutation batch is estimated to run {0:.0f}s,"
+                            " more than the {1:.0f}s available per job: jobs will"
+                            " overrun the target walltime. Reduce permutations,"
+                            " imputations or trees, or check '--seconds-per-tree'."
+                            .format(cost, target))
+    return max(1, int(target // cost))
+
+
+def _get_requested_walltime(batches, phenotypes, permutations, imputations, trees,
+                            target, seconds_per_tree=None):
+    """
+    Return the walltime to request for a job computing `batches`
+    permutation batches of `phenotypes` phenotypes: `target`
+    seconds, or the cost model estimate if that is longer.
+    """
+    estimate = phenotypes * QTLApplication.estimated_runtime(batches,
+                                                             permutations,
+                                                             imputations,
+                                                             trees,
+                                                             seconds_per_tree)
+    return Duration(int(math.ceil(max(target, estimate))), unit=seconds)
+
+
+def _get_batches(batches, batch_size):
+    """
+    Split `batches` permutation batches into jobs of at most
+    `batch_size` batches each, spreading the remainder so that
+    job sizes differ by at most one.
+    Yield tuples (offset, size) with offset of the first batch.
+    """
+    jobs = -(-batches // batch_size)
+    size, remainder = divmod(batches, jobs)
+    offset = 0
+    for job in range(jobs):
+        job_size = size + (1 if job < remainder else 0)
+        yield (offset, job_size)
+        offset += job_size
+
+
+def _get_packs(phenotypes, pack):
+    """
+    Group `phenotypes` in lists of at most `pack` elements.
+    """
+    return [phenotypes[index:index+pack] for index in range(0, len(phenotypes), pack)]
+
+
+def _get_pack_name(phenotypes):
+    """
+    Name a job after the first phenotype of the pack
+    and the number of remaining ones.
+    """
+    if len(phenotypes) == 1:
+        return phenotypes[0]
+    return "{0}+{1}".format(phenotypes[0], len(phenotypes) - 1)
+
+
+def _get_existing_permutations(data, phenotypes, pattern):
+    """
+    Return the names of the permutation files of `phenotypes`
+    already in the `data` directory. With copy staging, every job
+    returns a copy of them next to its own results.
+    """
+    existing = set()
+    for phenotype in phenotypes:
+        existing.update(os.path.basename(location)
+                        for location in glob.glob(os.path.join(data,
+                                                               pattern.format(phenotype=phenotype))))
+    return sorted(existing)
+
+
+def _ingest_permutations(task, store, pattern, existing=()):
+    """
+    Append permutation statistics produced by QTL `task`
+    to the null distribution store of each of its phenotypes
+    that completed, skipping the files named in `existing`
+    (see `_get_existing_permutations`). Return the list of
+    those phenotypes.
+    """
+    results = os.path.join(task.output_dir, task.results)
+    failed = getattr(task, 'failed_phenotypes', None)
+    if failed is None:
+        failed = [] if task.execution.returncode == 0 else task.phenotypes
+    phenotypes = [phenotype for phenotype in task.phenotypes if phenotype not in failed]
+    for phenotype in phenotypes:
+        null = NullDistributionStore(store, phenotype)
+        for location in sorted(glob.glob(os.path.join(results,
+                                                      pattern.format(phenotype=phenotype)))):
+            if os.path.basename(location) in existing:
+                continue
+            if null.append(location, read_statistics(location)):
+                gc3libs.log.debug("Ingested permutations from '{0}'".format(location))
+    return phenotypes
+
+
+def _read_observed(location):
+    """
+    Read observed statistics from a text file with one
+    `phenotype statistic` pair per line.
+    Return a dictionary phenotype -> statistic.
+    """
+    observed = dict()
+    with open(location) as fd:
+        for line in fd:
+            fields = line.replace(',', ' ').split()
+            try:
+                observed[fields[0]] = float(fields[-1])
+            except (IndexError, ValueError):
+                continue
+    return observed
+
+
+def _is_null(phenotype, store, observed, alpha, min_permutations):
+    """
+    Return True once the confidence interval of the empirical
+    p-value of `phenotype` lies entirely above `alpha`.
+    """
+    null = NullDistributionStore(store, phenotype).values()
+    if len(null) < min_permutations:
+        return False
+    pvalue, exceedances, permutations = empirical_pvalue(null, observed)
+    low, high = wilson_interval(exceedances, permutations)
+    gc3libs.log.debug("{0}: p-value {1} in [{2}, {3}] after {4} permutations".format(phenotype,
+                                                                                    pvalue,
+                                                                                    low,
+                                                                                    high,
+                                                                                    permutations))
+    return low > alpha
+
+
+#####################
+# Collections
+#
+
+class QTLBatchCollection(ParallelTaskCollection):
+    """
+    Run the QTL permutation batches in parallel and stream the
+    statistics of every successful batch into the null
+    distribution store as soon as it terminates.
+
+    If `observed` statistics are given, remaining batches are
+    cancelled once every phenotype is clearly not significant
+    at level `alpha` (sequential testing). A batch job computes all
+    phenotypes of a pack, so with packs of several phenotypes a
+    single significant one keeps all batches running: the
+    ``gqtl_pipeline`` command only stops early with ``--pack 1``.
+    """
+    def __init__(self, tasks, store, pattern, phenotypes=None, observed=None,
+                 alpha=0.05, min_permutations=0, existing=None, **extra_args):
+        self.store = store
+        self.pattern = pattern
+        self.existing = set(existing or [])
+        self.phenotypes = phenotypes or []
+        self.observed = observed or dict()
+        self.alpha = alpha
+        self.min_permutations = min_permutations
+        self.ingested = set()
+        self.cancelled = set()
+        ParallelTaskCollection.__init__(self, tasks, **extra_args)
+
+    def update_state(self, **extra_args):
+        ParallelTaskCollection.update_state(self, **extra_args)
+        ingested = False
+        for task in self.tasks:
+            if task.jobname in self.ingested \
+               or task.execution.state != Run.State.TERMINATED:
+                continue
+            if _ingest_permutations(task, self.store, self.pattern, self.existing):
+                ingested = True
+            self.ingested.add(task.jobname)
+        if ingested and not self.cancelled:
+            self._stop_early()
+
+    def _stop_early(self):
+        """
+        Cancel remaining batches if all phenotypes are decided.
+        """
+        if not self.phenotypes:
+            return
+        for phenotype in self.phenotypes:
+            if phenotype not in self.observed:
+                return
+            if not _is_null(phenotype, self.store, self.observed[phenotype],
+                            self.alpha, self.min_permutations):
+                return
+        for task in self.tasks:
+            if task.execution.state != Run.State.TERMINATED:
+                self.cancelled.add(task.jobname)
+                task.kill()
+        if self.cancelled:
+            gc3libs.log.info("{0} not significant at level {1}: cancelled {2} "
+                             "remaining batches.".format(', '.join(self.phenotypes),
+                                                         self.alpha,
+                                                         len(self.cancelled)))
+
+    def terminated(self):
+        """
+        Batches cancelled by early stopping are not failures.
+        """
+        ParallelTaskCollection.terminated(self)
+        if self.cancelled and all(task.execution.returncode == 0
+                                  for task in self.tasks
+                                  if task.jobname not in self.cancelled):
+            self.execution.returncode = (0, 0)
+
+
+class GQTLPipeline(StagedTaskCollection):
+    """
+    Staged collection:
+    Step0: run all permutation batches of a pack of phenotypes,
+           streaming the results into the null distribution store
+    Step1: ingest any batch missed while streaming and write
+           a summary of each null distribution
+    """
+    def __init__(self, phenotypes, tasks, store, pattern, observed=None,
+                 alpha=0.05, min_permutations=0, existing=None, **extra_args):
+        self.phenotypes = phenotypes
+        self.batches = tasks
+        self.store = store
+        self.pattern = pattern
+        # permutation files in the input data, not produced by the batches
+        self.existing = existing or []
+        self.observed = observed or dict()
+        self.alpha = alpha
+        self.min_permutations = min_permutations
+        self.extra = extra_args
+        StagedTaskCollection.__init__(self, **extra_args)
+
+    def stage0(self):
+        return QTLBatchCollection(self.batches,
+                                  self.store,
+                                  self.pattern,
+                                  self.phenotypes,
+                                  self.observed,
+                                  self.alpha,
+                                  self.min_permutations,
+                                  self.existing)
+
+    def stage1(self):
+        start = time.time()
+        for task in self.tasks[0].tasks:
+            if task.execution.state == Run.State.TERMINATED:
+                _ingest_permutations(task, self.store, self.pattern, self.existing)
+        for phenotype in self.phenotypes:
+            null = NullDistributionStore(self.store, phenotype)
+            summary = dict(permutations=len(null),
+                           early_stopped=bool(self.tasks[0].cancelled))
+            if phenotype in self.observed:
+                summary['pvalue'], summary['exceedances'], _ = \
+                    empirical_pvalue(null.values(), self.observed[phenotype])
+            with open(os.path.join(self.store, "{0}.json".format(phenotype)), 'w') as fd:
+                json.dump(summary, fd)
+            gc3libs.log.info("Null distribution of {0}: {1} permutations "
+                             "in '{2}'".format(phenotype, len(null), null.data))
+        self.merge_time = time.time() - start
+        return self.tasks[0].execution.returncode
+
+
+class GQTLScript(ProfileOptions, SubmissionOptions, SessionBasedScript):
     """
     The ``gqtl_pipeline`` command keeps a record of jobs (submitted, executed
     and pending) in a session file (set name with the ``-s`` option); at
@@ -104,6 +385,23 @@ class GQTLScript(SessionBasedScript):
                        help="Number of trees per imputation (forest). " \
                        "Default: '%(default)s'.")
 
+        self.add_param("--target-job-walltime", metavar="DURATION",
+                       type=Duration,
+                       dest="target_job_walltime", default=None,
+                       help="Size jobs so that each one is expected to run for " \
+                       "about this long, based on permutations x imputations x " \
+                       "trees. Default: {0} batches per job.".format(BATCH_THRESHOLD))
+
+        self.add_param("--seconds-per-tree", metavar="NUM",
+                       type=float,
+                       dest="seconds_per_tree",
+                       default=gc3apps.Default.QTL_SECONDS_PER_TREE,
+                       help="Calibration of the cost model used with " \
+                       "'--target-job-walltime': runtime of a single tree, " \
+                       "i.e. the run time of a finished job (see '--profile') " \
+                       "divided by its batches x permutations x imputations x " \
+                       "trees x packed phenotypes. Default: '%(default)s'.")
+
         self.add_param("--mafthres", metavar="NUM",
                        type=float,
                        dest="mafthres", default=0.9,
@@ -116,12 +414,75 @@ class GQTLScript(SessionBasedScript):
                        help="Last permutation batch number. " \
                        "Default: '%(default)s'.")
 
+        self.add_param("--pack", metavar="NUM",
+                       type=positive_int,
+                       dest="pack", default=1,
+                       help="Number of phenotypes processed within the same job; " \
+                       "they share data staging and run one after the other, " \
+                       "each in its own container: a failed phenotype does " \
+                       "not prevent the others from running. " \
+                       "Default: '%(default)s'.")
+
+        self.add_param("--staging", metavar="MODE",
+                       choices=gc3apps.Default.QTL_STAGING_MODES,
+                       dest="staging", default=gc3apps.Default.QTL_STAGING_COPY,
+                       help="How input data reaches the jobs: 'copy' stages the " \
+                       "whole data directory in and out of every job; 'mount' " \
+                       "mounts it read-only from a path shared with the " \
+                       "execution hosts; 'cache' copies it once per host from " \
+                       "that shared path. With 'mount' and 'cache' each job only " \
+                       "retrieves its own results in an 'output' folder. " \
+                       "Default: '%(default)s'.")
+
+        self.add_param("--null-store", metavar="DIRECTORY",
+                       type=str,
+                       dest="null_store", default=None,
+                       help="Stream the permutation statistics of each finished " \
+                       "batch into a binary null distribution per phenotype " \
+                       "within DIRECTORY. Default: keep the batch files only.")
+
+        self.add_param("--permutation-pattern", metavar="GLOB",
+                       type=str,
+                       dest="permutation_pattern",
+                       default=gc3apps.Default.QTL_PERMUTATION_PATTERN,
+                       help="Name of the permutation files of a phenotype " \
+                       "within the job results, used with '--null-store'. " \
+                       "With 'copy' staging, files of that name already in " \
+                       "'--data' are not ingested. Default: '%(default)s'.")
+
+        self.add_param("--observed", metavar="FILE",
+                       type=existing_file,
+                       dest="observed", default=None,
+                       help="Observed statistic of each phenotype, one " \
+                       "'phenotype statistic' pair per line. Together with " \
+                       "'--null-store', cancel the remaining batches of a " \
+                       "phenotype once its p-value is clearly above '--alpha'. " \
+                       "Not available with '--pack'.")
+
+        self.add_param("--alpha", metavar="NUM",
+                       type=float,
+                       dest="alpha", default=0.05,
+                       help="Significance threshold used with '--observed'. " \
+                       "Default: '%(default)s'.")
+
+        self.add_param("--min-permutations", metavar="NUM",
+                       type=nonnegative_int,
+                       dest="min_permutations", default=1000,
+                       help="Permutations to collect before a phenotype can " \
+                       "be stopped early. Default: '%(default)s'.")
+
         self.add_param("--version", metavar="VERSION",
                        type=str,
                        dest="version", default="1.1.0",
                        help="Docker version to be used. " \
                        "Default: '%(default)s'.")
 
+        # batches are session tasks of their own, or spread over one
+        # collection per pack: '--max-running' is their only limit
+        self.setup_submission_options(rate_limit=False)
+
+        self.setup_profile_options()
+
 
     def parse_args(self):
     #     assert self.params.last < self.params.batches, "Last {0} cannot be higher than the whole batch {1}.".format(self.params.last,
@@ -129,25 +490,76 @@ class GQTLScript(SessionBasedScript):
     #
     #     # if `last` provided, skip the first `last` from batches
     #     self.params.batches -= self.params.last
-        assert self.params.batches % BATCH_THRESHOLD == 0
+        if self.params.target_job_walltime:
+            self.params.batch_size = _get_batch_size(self.params.permutations,
+                                                     self.params.imputations,
+                                                     self.params.trees,
+                                                     # packed phenotypes share the job walltime
+                                                     self.params.target_job_walltime.amount(seconds) / self.params.pack,
+                                                     self.params.seconds_per_tree)
+        else:
+            self.params.batch_size = BATCH_THRESHOLD
+        gc3libs.log.info("Running up to {0} permutation batches per job.".format(self.params.batch_size))
+
+        if self.params.observed:
+            assert self.params.null_store, "'--observed' requires '--null-store'."
+            # batches are cancelled per pack, see `QTLBatchCollection`
+            assert self.params.pack == 1, "'--observed' cannot be used with '--pack'."
+            self.params.observed = _read_observed(self.params.observed)
 
     def new_tasks(self, extra):
         tasks = []
-        for phenotype in self.params.args:
-            for batch in range(0, (self.params.batches / BATCH_THRESHOLD)):
+        for phenotypes in _get_packs(self.params.args, self.params.pack):
+            batches = []
+            for batch, (offset, size) in enumerate(_get_batches(self.params.batches,
+                                                                self.params.batch_size)):
                 extra_args = extra.copy()
-                extra_args['jobname'] = "{0}_batch_{1}".format(phenotype,
+                extra_args['jobname'] = "{0}_batch_{1}".format(_get_pack_name(phenotypes),
                                                                batch)
                 extra_args['output_dir'] = os.path.abspath(self.params.output.replace('NAME',
                                                                                       extra_args['jobname']))
-                tasks.append(QTLApplication(phenotype,
-                                            os.path.abspath(self.params.data),
-                                            BATCH_THRESHOLD,
-                                            self.params.permutations,
-                                            self.params.imputations,
-                                            self.params.trees,
-                                            self.params.mafthres,
-                                            self.params.last + (batch * BATCH_THRESHOLD),
-                                            self.params.version,
-                                            **extra_args))
+                extra_args['staging'] = self.params.staging
+                extra_args['sample_resources'] = self.params.sample_resources
+                if self.params.target_job_walltime:
+                    extra_args['requested_walltime'] = _get_requested_walltime(
+                        size,
+                        len(phenotypes),
+                        self.params.permutations,
+                        self.params.imputations,
+                        self.params.trees,
+                        self.params.target_job_walltime.amount(seconds),
+                        self.params.seconds_per_tree)
+                batches.append(QTLApplication(phenotypes,
+                                               os.path.abspath(self.params.data),
+                                               size,
+                                               self.params.permutations,
+                                               self.params.imputations,
+                                               self.params.trees,
+                                               self.params.mafthres,
+                                               self.params.last + offset,
+                                               self.params.version,
+                                               **extra_args))
+            if self.params.null_store:
+                existing = []
+                if self.params.staging == gc3apps.Default.QTL_STAGING_COPY:
+                    existing = _get_existing_permutations(os.path.abspath(self.params.data),
+                                                          phenotypes,
+                                                          self.params.permutation_pattern)
+                    if existing:
+                        gc3libs.log.warning("{0} permutation files of {1} are already"
+                                            " in '{2}': they are not ingested."
+                                            .format(len(existing),
+                                                    _get_pack_name(phenotypes),
+                                                    self.params.data))
+                tasks.append(GQTLPipeline(phenotypes,
+                                          batches,
+                                          os.path.abspath(self.params.null_store),
+                                          self.params.permutation_pattern,
+                                          self.params.observed,
+                                          self.params.alpha,
+                                          self.params.min_permutations,
+                                          existing,
+                                          jobname=_get_pack_name(phenotypes)))
+            else:
+                tasks.extend(batches)
         return tasks
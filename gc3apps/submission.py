@@ -0,0 +1,138 @@
+"""
+Submission control for the gc3apps pipelines.
+
+GC3Pie's engine frees the resources of a terminated application in
+the same cycle it fetches its output; on OpenStack this deletes the
+VM it ran on as soon as the VM has nothing else to do, so the next
+chunk of a pipeline stage has to wait for a fresh VM to boot. The
+`VMReuseEngine` defers freeing by `vm_idle_time` seconds, so chunks
+released in the meantime land on the VMs that are already running.
+
+Submission rates are limited by the task collections themselves,
+see `gc3apps.utils.ratelimit.TokenBucket`.
+
+`SubmissionOptions` adds the command line options controlling both
+to the session-based scripts.
+"""
+
+import time
+
+import gc3libs
+from gc3libs import Application, Run
+from gc3libs.core import Engine
+from gc3libs.cmdline import positive_int, nonnegative_int
+
+from gc3apps.utils.ratelimit import TokenBucket
+
+
+class DeferredFreeCore(object):
+    """
+    Wrap a `gc3libs.core.Core` so that `free(app)` takes effect
+    `idle_time` seconds later (immediately if `idle_time` is 0).
+    All other methods are those of the wrapped core.
+    """
+
+    def __init__(self, core, idle_time):
+        self._wrapped = core
+        self.idle_time = idle_time
+        # (deadline, app) in order of deadline
+        self._deferred = []
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def free(self, app, **extra_args):
+        if not self.idle_time or not isinstance(app, Application):
+            return self._wrapped.free(app, **extra_args)
+        self._deferred.append((time.time() + self.idle_time, app))
+
+    def free_idle(self, now=None):
+        """
+        Free the applications whose idle time ended before `now`.
+        """
+        now = time.time() if now is None else now
+        pending = []
+        for deadline, app in self._deferred:
+            if deadline > now:
+                pending.append((deadline, app))
+            elif app.execution.state == Run.State.TERMINATED:
+                try:
+                    self._wrapped.free(app)
+                except Exception as err:
+                    gc3libs.log.warning("Could not free resources of task '%s': %s"
+                                        " (will retry)", app, err)
+                    pending.append((deadline, app))
+        self._deferred = pending
+
+    def close(self):
+        self.free_idle(float('inf'))
+        self._wrapped.close()
+
+
+class VMReuseEngine(Engine):
+    """
+    An `Engine` whose core keeps the resources of terminated
+    applications (and hence idle VMs) for `vm_idle_time` seconds.
+    """
+
+    def __init__(self, controller, tasks=list(), store=None, vm_idle_time=0,
+                 **extra_args):
+        Engine.__init__(self, DeferredFreeCore(controller, vm_idle_time),
+                        tasks, store, **extra_args)
+
+    def progress(self):
+        Engine.progress(self)
+        self._core.free_idle()
+
+
+class SubmissionOptions(object):
+    """
+    Mix-in for `SessionBasedScript` classes: call
+    `setup_submission_options` from `setup_options` to add
+    ``--vm-idle-time`` and, unless `rate_limit` is False,
+    ``--submit-rate``, ``--submit-burst`` and ``--ramp-up``.
+    The script's task collections take their limit from `_rate_limit`.
+    """
+
+    def setup_submission_options(self, rate_limit=True):
+        if rate_limit:
+            self.add_param("--submit-rate", metavar="[NUM]",
+                           type=float,
+                           dest="submit_rate", default=None,
+                           help="Submit at most this many chunks per minute."
+                           " Default: no limit.")
+
+            self.add_param("--submit-burst", metavar="[INT]",
+                           type=positive_int,
+                           dest="submit_burst", default=None,
+                           help="Number of chunks that may be submitted at once"
+                           " within '--submit-rate'. Default: one second's worth.")
+
+            self.add_param("--ramp-up", metavar="SECONDS",
+                           type=nonnegative_int,
+                           dest="ramp_up", default=0,
+                           help="Increase the submission rate linearly up to"
+                           " '--submit-rate' over this many seconds."
+                           " Default: '%(default)s'.")
+
+        self.add_param("--vm-idle-time", metavar="SECONDS",
+                       type=nonnegative_int,
+                       dest="vm_idle_time", default=0,
+                       help="Keep the resources of finished jobs, and"
+                       " hence idle cloud VMs, this long so that the"
+                       " following jobs can reuse them."
+                       " Default: '%(default)s' (free them at once).")
+
+    def _rate_limit(self):
+        if getattr(self.params, 'submit_rate', None):
+            return TokenBucket(self.params.submit_rate / 60.0,
+                               self.params.submit_burst,
+                               self.params.ramp_up)
+
+    def make_task_controller(self):
+        return VMReuseEngine(self._core,
+                             self.session,
+                             self.session.store,
+                             vm_idle_time=self.params.vm_idle_time,
+                             max_submitted=self.params.max_running,
+                             max_in_flight=self.params.max_running)
@@ -0,0 +1,76 @@
+"""
+Coalesce filesystem events per experiment folder.
+
+An upload into an inbox fires one event per file written (and many
+`modified` events for large files); the daemon only needs to react
+once per folder, after the upload has settled. Events are recorded
+here and a folder is released once it has been quiet for
+`quiet_window` seconds and its completion marker has been seen.
+Folders whose marker never shows up (stray files, aborted uploads)
+are forgotten after `max_age` seconds without events.
+"""
+
+import time
+
+
+class FolderEventCoalescer(object):
+    """
+    Collect events per folder; release each completed folder
+    once no event has touched it for `quiet_window` seconds, and
+    drop folders without a marker after `max_age` seconds without
+    events (never if None).
+    """
+
+    def __init__(self, quiet_window, max_age=None):
+        self.quiet_window = quiet_window
+        self.max_age = max_age
+        # folder -> [inbox, marker, last event time]
+        self._pending = dict()
+
+    def touch(self, folder, inbox, marker=None, now=None):
+        """
+        Record an event on `folder` of `inbox`; `marker` is the
+        location of the completion marker if the event was on it.
+        """
+        now = time.time() if now is None else now
+        entry = self._pending.setdefault(folder, [inbox, None, now])
+        if marker:
+            entry[1] = marker
+        entry[2] = now
+
+    def discard(self, folder):
+        self._pending.pop(folder, None)
+
+    def ready(self, now=None):
+        """
+        Remove and return the list of (folder, inbox, marker) tuples
+        of completed folders whose quiet window has elapsed.
+        """
+        now = time.time() if now is None else now
+        released = []
+        for folder, (inbox, marker, last) in list(self._pending.items()):
+            if marker and now - last >= self.quiet_window:
+                del self._pending[folder]
+                released.append((folder, inbox, marker))
+        return sorted(released)
+
+    def expire(self, now=None):
+        """
+        Remove and return the list of folders still waiting for their
+        completion marker whose last event is older than `max_age`.
+        """
+        if self.max_age is None:
+            return []
+        now = time.time() if now is None else now
+        expired = []
+        for folder, (inbox, marker, last) in list(self._pending.items()):
+            if not marker and now - last >= self.max_age:
+                del self._pending[folder]
+                expired.append(folder)
+        return sorted(expired)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, folder):
+        return folder in self._pending
@@ -0,0 +1,60 @@
+"""
+Weighted max-min fair sharing of a fixed number of slots.
+
+Each consumer asks for `demand` slots and has a `weight`; slots are
+handed out in proportion to the weights, and whatever a consumer
+cannot use (demand below its share) is redistributed among the
+others. Small demands are therefore served in full while large ones
+take up the remaining capacity.
+"""
+
+
+def water_fill(demands, capacity, weights=None):
+    """
+    Split `capacity` slots among the keys of `demands`.
+
+    :param demands: dictionary mapping keys to requested slots
+    :param capacity: number of slots to hand out
+    :param weights: dictionary mapping keys to weights (default 1)
+    :return: dictionary mapping keys to allocated slots (integers)
+    """
+    weights = weights or dict()
+    allocation = dict((key, 0) for key in demands)
+    active = set(key for key, demand in demands.items() if demand > 0)
+    left = capacity
+    while left > 0 and active:
+        total = float(sum(weights.get(key, 1) for key in active))
+        given = 0
+        # smallest shares first, so rounding favours small consumers
+        for key in sorted(active, key=lambda k: (demands[k] - allocation[k], k)):
+            share = int(left * weights.get(key, 1) / total)
+            share = min(max(share, 1), demands[key] - allocation[key],
+                        left - given)
+            allocation[key] += share
+            given += share
+            if allocation[key] >= demands[key]:
+                active.discard(key)
+            if given >= left:
+                break
+        left -= given
+        if given == 0:
+            break
+    return allocation
+
+
+def hierarchical_fill(groups, capacity, weights=None):
+    """
+    Split `capacity` first among groups (by `weights`),
+    then evenly among the members of each group.
+
+    :param groups: dictionary mapping a group key to a dictionary
+                   of member keys -> demand
+    :return: dictionary mapping member keys to allocated slots
+    """
+    group_demands = dict((key, sum(members.values()))
+                         for key, members in groups.items())
+    shares = water_fill(group_demands, capacity, weights)
+    allocation = dict()
+    for key, members in groups.items():
+        allocation.update(water_fill(members, shares[key]))
+    return allocation
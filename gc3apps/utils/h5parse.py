@@ -73,6 +73,23 @@ Paths to images: {2}
 	#								                 self.paths)
 
 
+    def image_files(self):
+        """
+        Return the image files of every image set, in image set
+        order: one list per image set with a path per channel.
+        """
+        group_image = os.path.join('/Measurements', self.date, 'Image')
+        with h5py.File(self.path, 'r') as obj:
+            channels = sorted(field[len('PathName_'):] for field in obj[group_image].keys()
+                              if field.startswith('PathName_'))
+            columns = []
+            for channel in channels:
+                paths = obj[os.path.join(group_image, 'PathName_' + channel, 'data')][:]
+                names_field = os.path.join(group_image, 'FileName_' + channel, 'data')
+                names = obj[names_field][:] if names_field in obj else [''] * len(paths)
+                columns.append([os.path.join(path, name) for path, name in zip(paths, names)])
+        return [list(files) for files in zip(*columns)]
+
     def _verify_version(self, h5version):
         """
         Return Cellprofiler version
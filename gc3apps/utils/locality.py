@@ -0,0 +1,52 @@
+"""
+Storage locality of the input images of a run.
+
+Images are keyed by where they are read from: their directory
+(usually one plate or acquisition), or the first group of a regular
+expression matched in their path, e.g. ``Plate_(\\d+)``. Chunks are
+planned so that they never span two keys; the number of chunks
+reading from the same key at a time can then be limited, see
+`gc3apps.workflow.LocalityTaskCollection`.
+"""
+
+import os
+import re
+
+
+def locality_key(path, pattern=None):
+    """
+    Return the storage key of image `path`: the first group (or the
+    whole match) of `pattern` in `path`, or else its directory.
+    """
+    if pattern:
+        match = re.search(pattern, path)
+        if match:
+            return match.group(1) if match.groups() else match.group(0)
+    return os.path.dirname(path)
+
+
+def split_runs(items, key):
+    """
+    Split `items` into runs of consecutive items with the same
+    `key(item)`; return a list of (key, items) pairs.
+    """
+    runs = []
+    for item in items:
+        value = key(item)
+        if not runs or runs[-1][0] != value:
+            runs.append((value, []))
+        runs[-1][1].append(item)
+    return runs
+
+
+def write_file_list(paths, location):
+    """
+    Write one path per line into `location` and return `location`.
+    """
+    folder = os.path.dirname(location)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(location, 'w') as fd:
+        for path in paths:
+            fd.write("{0}\n".format(path))
+    return location
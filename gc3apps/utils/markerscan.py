@@ -0,0 +1,164 @@
+"""
+Incremental scanner for completion markers below a set of folders.
+
+Meant for inboxes on network filesystems where inotify does not see
+remote writes. Each scan stats every known directory but only lists
+those whose mtime changed since the previous scan: creating, removing
+or renaming an entry updates the mtime of its parent directory, so
+unchanged directories cannot contain new markers.
+
+A marker is reported when it first appears and again whenever its
+size or mtime changes (e.g. while an archive is still being
+uploaded); it is re-checked on every scan until it has been seen
+unchanged once.
+
+The scan state is persisted as JSON, so a restarted daemon does not
+report the markers it has already seen. Reported markers stay pending
+until the caller is `done` with their folder; pending markers are
+reported again after a restart, so that folders still waiting to be
+processed are not lost.
+"""
+
+import os
+import json
+import stat
+
+import gc3apps
+
+
+def is_completion_marker(path):
+    """
+    Return True if `path` marks its folder as complete: either the
+    dataset archive itself (`Default.DEFAULT_EXPERIMENT_FILE_CHECK_MARKER`)
+    or a folder marker written after the upload
+    (`Default.DEFAULT_FILE_CHECK_MARKER`).
+    """
+    name = os.path.basename(path)
+    return name == gc3apps.Default.DEFAULT_FILE_CHECK_MARKER \
+        or name.endswith(gc3apps.Default.DEFAULT_EXPERIMENT_FILE_CHECK_MARKER)
+
+
+class MarkerScanner(object):
+    """
+    Scan `roots` for files accepted by `is_marker(path)`;
+    keep the scan state in `state_file`.
+    """
+
+    def __init__(self, roots, state_file, is_marker):
+        self.roots = list(roots)
+        self.state_file = state_file
+        self.is_marker = is_marker
+        # directory -> {'mtime': float, 'subdirs': [names],
+        #               'markers': {name: [size, mtime, settled]}}
+        self.dirs = dict()
+        # markers reported whose folder is not done yet
+        self.pending = set()
+        if os.path.isfile(state_file):
+            with open(state_file) as fd:
+                state = json.load(fd)
+            self.dirs = state['dirs']
+            self.pending = set(state['pending'])
+        # reported again by the first scan
+        self._restored = set(self.pending)
+        self._dirty = False
+
+    def save(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(dict(dirs=self.dirs, pending=sorted(self.pending)), fd)
+        os.rename(tmp, self.state_file)
+
+    def done(self, folder):
+        """
+        Forget the pending markers of `folder`, once it has been
+        processed. The state is saved by the next scan, i.e. after
+        the caller had a chance to record the processing.
+        """
+        for marker in [marker for marker in self.pending
+                       if os.path.dirname(marker) == folder]:
+            self.pending.discard(marker)
+            self._dirty = True
+
+    def _list(self, folder, mtime, previous):
+        subdirs = []
+        markers = dict()
+        changed = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # removed in the meantime
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(name)
+            elif stat.S_ISREG(st.st_mode) and self.is_marker(path):
+                known = previous.get(name)
+                if known and known[:2] == [st.st_size, st.st_mtime]:
+                    markers[name] = known
+                else:
+                    markers[name] = [st.st_size, st.st_mtime, False]
+                    changed.append(path)
+        self.dirs[folder] = dict(mtime=mtime, subdirs=subdirs, markers=markers)
+        self._dirty = True
+        return changed
+
+    def _recheck(self, folder, markers):
+        changed = []
+        for name, known in markers.items():
+            if known[2]:
+                continue
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known[:2] == [st.st_size, st.st_mtime]:
+                known[2] = True
+                self._dirty = True
+            else:
+                markers[name] = [st.st_size, st.st_mtime, False]
+                changed.append(path)
+                self._dirty = True
+        return changed
+
+    def scan(self):
+        """
+        Return the list of marker files created or modified
+        since the previous scan, and after a restart those that
+        were still pending.
+        """
+        changed = list(self._restored)
+        self._restored = set()
+        seen = set()
+        stack = list(self.roots)
+        while stack:
+            folder = stack.pop()
+            try:
+                mtime = os.stat(folder).st_mtime
+            except OSError:
+                continue
+            seen.add(folder)
+            entry = self.dirs.get(folder)
+            if entry is None or entry['mtime'] != mtime:
+                previous = entry['markers'] if entry else dict()
+                try:
+                    changed.extend(self._list(folder, mtime, previous))
+                except OSError:
+                    continue
+            else:
+                changed.extend(self._recheck(folder, entry['markers']))
+            stack.extend(os.path.join(folder, name)
+                         for name in self.dirs[folder]['subdirs'])
+        for folder in set(self.dirs) - seen:
+            del self.dirs[folder]
+            self._dirty = True
+        changed = sorted(set(changed))
+        for marker in changed:
+            if marker not in self.pending:
+                self.pending.add(marker)
+                self._dirty = True
+        if self._dirty:
+            self.save()
+            self._dirty = False
+        return changed
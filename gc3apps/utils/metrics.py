@@ -0,0 +1,153 @@
+"""
+Throughput and latency metrics of the data daemon.
+
+Each experiment goes through the stages listed in `STAGES`; the
+time at which it first reaches a stage is recorded, and the time
+between pairs of stages (`LATENCIES`) is accumulated into
+histograms. Counters, histograms and the experiments still in
+progress are saved as JSON (so they survive a restart and can be
+read by the XML-RPC server process) and exported in the Prometheus
+text format.
+"""
+
+import os
+import json
+import time
+
+DETECTED = 'detected'
+CLASSIFIED = 'classified'
+SUBMITTED = 'submitted'
+RUNNING = 'running'
+MERGED = 'merged'
+STAGES = [DETECTED, CLASSIFIED, SUBMITTED, RUNNING, MERGED]
+
+# (histogram name, from stage, to stage)
+LATENCIES = [
+    ('classification', DETECTED, CLASSIFIED),
+    ('submission', CLASSIFIED, SUBMITTED),
+    ('queueing', SUBMITTED, RUNNING),
+    ('processing', RUNNING, MERGED),
+    ('total', DETECTED, MERGED),
+]
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 21600, 86400]
+
+PREFIX = 'gc3apps_daemon'
+
+
+def _write_atomically(location, content):
+    tmp = location + '.tmp'
+    with open(tmp, 'w') as fd:
+        fd.write(content)
+    os.rename(tmp, location)
+
+
+class DaemonMetrics(object):
+    """
+    Per-experiment stage timestamps, counters and latency histograms.
+    """
+
+    def __init__(self):
+        # experiment -> {stage: timestamp}
+        self.experiments = dict()
+        self.counters = dict()
+        # name -> {'buckets': [count per bucket, +Inf], 'sum': s, 'count': n}
+        self.histograms = dict(
+            (name, dict(buckets=[0] * (len(BUCKETS) + 1), sum=0.0, count=0))
+            for name, _, _ in LATENCIES)
+
+    @classmethod
+    def load(cls, location):
+        """
+        Return the metrics saved in `location`, or empty ones.
+        """
+        metrics = cls()
+        if os.path.isfile(location):
+            with open(location) as fd:
+                data = json.load(fd)
+            metrics.experiments = data['experiments']
+            metrics.counters = data['counters']
+            metrics.histograms.update(data['histograms'])
+        return metrics
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms[name]
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            n = len(BUCKETS)
+        histogram['buckets'][n] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def mark(self, experiment, stage, when=None):
+        """
+        Record that `experiment` reached `stage`; only the first
+        occurrence counts. Once merged, the experiment is forgotten.
+        """
+        stages = self.experiments.setdefault(experiment, dict())
+        if stage in stages:
+            return
+        stages[stage] = time.time() if when is None else when
+        self.count("experiments_{0}".format(stage))
+        for name, start, end in LATENCIES:
+            if end == stage and start in stages:
+                self.observe(name, stages[end] - stages[start])
+        if stage == MERGED:
+            del self.experiments[experiment]
+
+    def reached(self, experiment, stage):
+        return stage in self.experiments.get(experiment, ())
+
+    def in_progress(self):
+        """
+        Return a dictionary mapping each stage to the number of
+        experiments whose latest stage it is.
+        """
+        counts = dict((stage, 0) for stage in STAGES)
+        for stages in self.experiments.values():
+            latest = max(stages, key=STAGES.index)
+            counts[latest] += 1
+        return counts
+
+    def snapshot(self):
+        return dict(experiments=self.experiments,
+                    counters=self.counters,
+                    histograms=self.histograms)
+
+    def save(self, location):
+        _write_atomically(location, json.dumps(self.snapshot()))
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name in sorted(self.counters):
+            metric = "{0}_{1}_total".format(PREFIX, name)
+            lines.append("# TYPE {0} counter".format(metric))
+            lines.append("{0} {1}".format(metric, self.counters[name]))
+        metric = "{0}_experiments_in_stage".format(PREFIX)
+        lines.append("# TYPE {0} gauge".format(metric))
+        for stage, value in sorted(self.in_progress().items()):
+            lines.append('{0}{{stage="{1}"}} {2}'.format(metric, stage, value))
+        for name, _, _ in LATENCIES:
+            histogram = self.histograms[name]
+            metric = "{0}_{1}_latency_seconds".format(PREFIX, name)
+            lines.append("# TYPE {0} histogram".format(metric))
+            cumulative = 0
+            for bound, value in zip(BUCKETS + ['+Inf'], histogram['buckets']):
+                cumulative += value
+                lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound,
+                                                                 cumulative))
+            lines.append("{0}_sum {1}".format(metric, histogram['sum']))
+            lines.append("{0}_count {1}".format(metric, histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, location):
+        _write_atomically(location, self.to_prometheus())
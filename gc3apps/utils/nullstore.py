@@ -0,0 +1,127 @@
+"""
+Append-only binary store of QTL permutation statistics.
+
+Each phenotype gets two files in the store folder:
+
+  <phenotype>.null   raw little-endian float64 values, one per permutation
+  <phenotype>.index  one line per ingested batch file:
+                     <source> <offset> <count>
+
+Values of a batch are appended before the batch is recorded in the
+index; on open, the data file is truncated back to the end of the
+last indexed batch, so an interrupted append is simply redone.
+Reading the null distribution is a memory-mapped read of the data file.
+"""
+
+import os
+import re
+import numpy
+
+DTYPE = numpy.dtype('<f8')
+_SEPARATORS = re.compile(r'[,;\s]+')
+
+# z-score of a two-sided 99% confidence interval
+CONFIDENCE_Z = 2.576
+
+
+def read_statistics(location, column=-1):
+    """
+    Return the numeric values found in `column` of text file
+    `location`. Lines whose value cannot be parsed (e.g. headers)
+    are skipped.
+    """
+    values = []
+    with open(location) as fd:
+        for line in fd:
+            fields = _SEPARATORS.split(line.strip())
+            try:
+                values.append(float(fields[column]))
+            except (IndexError, ValueError):
+                continue
+    return numpy.array(values, dtype=DTYPE)
+
+
+def empirical_pvalue(null, observed):
+    """
+    Return a tuple (pvalue, exceedances, permutations) where
+    `exceedances` is the number of values of the `null`
+    distribution at least as large as `observed`.
+    """
+    exceedances = int(numpy.count_nonzero(numpy.asarray(null) >= observed))
+    permutations = len(null)
+    return ((exceedances + 1.0) / (permutations + 1.0), exceedances, permutations)
+
+
+def wilson_interval(exceedances, permutations, z=CONFIDENCE_Z):
+    """
+    Return the Wilson score confidence interval (low, high) of
+    the p-value estimated from `exceedances` out of `permutations`.
+    """
+    if permutations == 0:
+        return (0.0, 1.0)
+    p = float(exceedances) / permutations
+    denominator = 1.0 + z * z / permutations
+    center = (p + z * z / (2.0 * permutations)) / denominator
+    spread = z * numpy.sqrt(p * (1.0 - p) / permutations
+                            + z * z / (4.0 * permutations * permutations)) / denominator
+    return (max(0.0, center - spread), min(1.0, center + spread))
+
+
+class NullDistributionStore(object):
+    """
+    Null distribution of one phenotype stored below `root`.
+    """
+
+    def __init__(self, root, phenotype):
+        self.root = root
+        self.phenotype = phenotype
+        self.data = os.path.join(root, "{0}.null".format(phenotype))
+        self.index = os.path.join(root, "{0}.index".format(phenotype))
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._sources = self._load_index()
+
+    def _load_index(self):
+        sources = dict()
+        end = 0
+        if os.path.isfile(self.index):
+            with open(self.index) as fd:
+                for line in fd:
+                    source, offset, count = line.rsplit(None, 2)
+                    sources[source] = (int(offset), int(count))
+                    end = max(end, int(offset) + int(count))
+        # drop values appended after the last indexed batch
+        with open(self.data, 'ab') as fd:
+            if fd.tell() > end * DTYPE.itemsize:
+                fd.truncate(end * DTYPE.itemsize)
+        return sources
+
+    def __len__(self):
+        return os.path.getsize(self.data) // DTYPE.itemsize
+
+    def __contains__(self, source):
+        return source in self._sources
+
+    def append(self, source, values):
+        """
+        Append `values` read from `source`.
+        Return False if `source` had already been ingested.
+        """
+        if source in self._sources:
+            return False
+        values = numpy.asarray(values, dtype=DTYPE)
+        offset = len(self)
+        with open(self.data, 'ab') as fd:
+            values.tofile(fd)
+        with open(self.index, 'a') as fd:
+            fd.write("{0} {1} {2}\n".format(source, offset, len(values)))
+        self._sources[source] = (offset, len(values))
+        return True
+
+    def values(self):
+        """
+        Return the whole null distribution as a read-only memory map.
+        """
+        if len(self) == 0:
+            return numpy.array([], dtype=DTYPE)
+        return numpy.memmap(self.data, dtype=DTYPE, mode='r')
@@ -0,0 +1,57 @@
+"""
+Prefix index over filesystem paths.
+
+Paths are split into their components and stored in a trie, so the
+longest registered path containing a given location is found by
+walking the location's components once, whatever the number of
+registered paths.
+"""
+
+import os
+
+_VALUE = object()
+
+
+def _components(path):
+    return [part for part in os.path.normpath(path).split(os.sep) if part]
+
+
+class PathPrefixIndex(object):
+    """
+    Map paths to values and look up the longest registered path
+    that is an ancestor of (or equal to) a given location.
+    """
+
+    def __init__(self, items=None):
+        self._root = dict()
+        self._size = 0
+        for path, value in (items or []):
+            self.add(path, value)
+
+    def add(self, path, value=None):
+        """
+        Register `path` with `value` (the path itself if None).
+        """
+        node = self._root
+        for part in _components(path):
+            node = node.setdefault(part, dict())
+        if _VALUE not in node:
+            self._size += 1
+        node[_VALUE] = path if value is None else value
+
+    def longest_prefix(self, location):
+        """
+        Return the value of the deepest registered path containing
+        `location`, or None if no registered path does.
+        """
+        node = self._root
+        found = node.get(_VALUE)
+        for part in _components(location):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(_VALUE, found)
+        return found
+
+    def __len__(self):
+        return self._size
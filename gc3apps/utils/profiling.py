@@ -0,0 +1,258 @@
+"""
+Per-task and per-stage timing and I/O report of a session.
+
+Timings come from the state transition timestamps GC3Pie records
+for every task (`Run.timestamp`):
+
+  queue_wait  SUBMITTED -> RUNNING
+  run_time    RUNNING -> TERMINATING, less pull_time
+  fetch_time  TERMINATING -> TERMINATED (output staging)
+  wall_time   SUBMITTED -> TERMINATED
+
+Bytes staged in are the sizes of the task's local input files;
+bytes staged out the size of its output directory. Pipelines can
+record the time spent merging results in a `merge_time` attribute.
+
+Jobs run with image pre-pull (see `_prepull` in `gc3apps`) report
+the time spent making sure their docker image is on the host as
+`pull_time`.
+
+Jobs run with resource sampling (see `_sample_resources` in
+`gc3apps`) also get the peak memory, CPU usage and block I/O of
+their containers; stages then carry a flavor and chunk size
+suggestion.
+
+The report is written as `<prefix>.json` (tasks and stages) and
+`<prefix>.csv` (tasks only), so that runs can be compared.
+
+`ProfileOptions` adds ``--profile`` and ``--sample-resources`` to the
+session-based scripts.
+"""
+
+import os
+import csv
+import json
+import time
+
+import gc3apps
+from gc3libs import Application, Run
+from gc3libs.workflow import TaskCollection, StagedTaskCollection
+from gc3libs.cmdline import positive_int
+from gc3apps.utils.resources import read_samples, summarize, suggest
+
+TASK_FIELDS = ['pipeline', 'stage', 'jobname', 'state', 'returncode',
+               'submitted', 'running', 'terminated',
+               'queue_wait', 'run_time', 'pull_time', 'fetch_time', 'wall_time',
+               'bytes_in', 'bytes_out',
+               'peak_memory', 'mean_cpu', 'max_cpu', 'read_bytes', 'write_bytes']
+
+
+def _size(location):
+    """
+    Return the size in bytes of file or directory `location`.
+    """
+    if os.path.isfile(location):
+        return os.path.getsize(location)
+    total = 0
+    for path, _, files in os.walk(location):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(path, name))
+            except OSError:
+                pass
+    return total
+
+
+def _elapsed(timestamps, start, end):
+    if start in timestamps and end in timestamps:
+        return max(0.0, timestamps[end] - timestamps[start])
+    return None
+
+
+def _pull_time(output_dir):
+    """
+    Return the seconds spent pulling the job's docker image,
+    or None if the job did not pre-pull it.
+    """
+    location = os.path.join(output_dir or '', gc3apps.Default.IMAGE_PULL_TIMES)
+    if not output_dir or not os.path.isfile(location):
+        return None
+    with open(location) as fd:
+        return float(sum(float(row['seconds'])
+                         for row in csv.DictReader(fd, delimiter='\t')))
+
+
+def _record(jobname, state, returncode, timestamps, inputs, output_dir,
+            pipeline=None, stage=None):
+    record = dict(pipeline=pipeline, stage=stage,
+                  jobname=jobname,
+                  state=state,
+                  returncode=returncode,
+                  submitted=timestamps.get(Run.State.SUBMITTED),
+                  running=timestamps.get(Run.State.RUNNING),
+                  terminated=timestamps.get(Run.State.TERMINATED),
+                  queue_wait=_elapsed(timestamps, Run.State.SUBMITTED,
+                                      Run.State.RUNNING),
+                  run_time=_elapsed(timestamps, Run.State.RUNNING,
+                                    Run.State.TERMINATING),
+                  fetch_time=_elapsed(timestamps, Run.State.TERMINATING,
+                                      Run.State.TERMINATED),
+                  wall_time=_elapsed(timestamps, Run.State.SUBMITTED,
+                                     Run.State.TERMINATED),
+                  pull_time=_pull_time(output_dir),
+                  bytes_in=0, bytes_out=0)
+    if record['run_time'] is not None and record['pull_time']:
+        record['run_time'] = max(0.0, record['run_time'] - record['pull_time'])
+    for url in inputs:
+        if url.scheme == 'file' and os.path.exists(url.path):
+            record['bytes_in'] += _size(url.path)
+    if state == Run.State.TERMINATED \
+            and output_dir and os.path.isdir(output_dir):
+        record['bytes_out'] = _size(output_dir)
+    samples = os.path.join(output_dir or '', gc3apps.Default.RESOURCE_SAMPLES)
+    if output_dir and os.path.isfile(samples):
+        record.update(summarize(read_samples(samples)))
+    else:
+        record.update(summarize([]))
+    return record
+
+
+def task_record(task, pipeline=None, stage=None):
+    """
+    Return a dictionary with the timings and I/O of `task`.
+    """
+    return _record(task.jobname, task.execution.state,
+                   task.execution.returncode, task.execution.timestamp,
+                   task.inputs, getattr(task, 'output_dir', None),
+                   pipeline, stage)
+
+
+def summary_record(summary, pipeline=None, stage=None):
+    """
+    Return the record of a task collapsed into a `TaskSummary`;
+    its inputs are not known anymore.
+    """
+    return _record(summary.jobname, Run.State.TERMINATED,
+                   summary.returncode, summary.timestamp,
+                   [], summary.output_dir, pipeline, stage)
+
+
+def iter_records(task, pipeline=None, stage=None):
+    """
+    Yield the records of all applications below `task`; children
+    of a `StagedTaskCollection` are labeled `stage0`, `stage1`, ...
+    """
+    if isinstance(task, Application):
+        yield task_record(task, pipeline, stage)
+    elif isinstance(task, TaskCollection):
+        pipeline = pipeline or task.jobname
+        for summary in getattr(task, 'summaries', []):
+            yield summary_record(summary, pipeline, stage)
+        for n, child in enumerate(task.tasks):
+            if isinstance(task, StagedTaskCollection):
+                stage = "stage{0}".format(n)
+            for record in iter_records(child, pipeline, stage):
+                yield record
+
+
+def stage_records(records):
+    """
+    Aggregate task records per (pipeline, stage).
+    """
+    stages = dict()
+    for record in records:
+        key = (record['pipeline'], record['stage'])
+        stage = stages.setdefault(key, dict(pipeline=key[0], stage=key[1],
+                                            tasks=0, start=None, end=None,
+                                            run_time=0.0, queue_wait=0.0,
+                                            pull_time=0.0,
+                                            bytes_in=0, bytes_out=0,
+                                            peak_memory=None, mean_cpu=None,
+                                            completed=0))
+        stage['tasks'] += 1
+        for field in ['run_time', 'queue_wait', 'pull_time', 'bytes_in', 'bytes_out']:
+            stage[field] += record[field] or 0
+        for field in ['peak_memory', 'mean_cpu']:
+            if record[field] is not None:
+                stage[field] = (record[field] if stage[field] is None
+                                else max(stage[field], record[field]))
+        if record['run_time'] is not None:
+            stage['completed'] += 1
+        if record['submitted'] is not None:
+            stage['start'] = (record['submitted'] if stage['start'] is None
+                              else min(stage['start'], record['submitted']))
+        if record['terminated'] is not None:
+            stage['end'] = (record['terminated'] if stage['end'] is None
+                            else max(stage['end'], record['terminated']))
+    for stage in stages.values():
+        stage['wall_time'] = (stage['end'] - stage['start']
+                              if None not in (stage['start'], stage['end'])
+                              else None)
+        stage['suggestion'] = suggest(stage['peak_memory'],
+                                      stage['mean_cpu'],
+                                      stage['run_time'] / max(stage['completed'], 1),
+                                      gc3apps.Default.RESOURCE_MEMORY_HEADROOM,
+                                      gc3apps.Default.RESOURCE_TARGET_RUNTIME)
+    return sorted(stages.values(),
+                  key=lambda s: (s['pipeline'] or '', s['stage'] or ''))
+
+
+def write_report(tasks, prefix, merge_time=None):
+    """
+    Write the timing and I/O report of `tasks` (and all their
+    descendants) to `<prefix>.json` and `<prefix>.csv`.
+    """
+    records = []
+    merges = dict()
+    for task in tasks:
+        records.extend(iter_records(task))
+        if getattr(task, 'merge_time', None) is not None:
+            merges[task.jobname] = task.merge_time
+    if merge_time is not None:
+        merges['session'] = merge_time
+
+    with open(prefix + '.json', 'w') as fd:
+        json.dump(dict(created=time.time(),
+                       stages=stage_records(records),
+                       merge_time=merges,
+                       tasks=records), fd, indent=2)
+    with open(prefix + '.csv', 'w') as fd:
+        writer = csv.DictWriter(fd, TASK_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+
+
+class ProfileOptions(object):
+    """
+    Mix-in for `SessionBasedScript` classes: call
+    `setup_profile_options` from `setup_options` to add ``--profile``
+    and ``--sample-resources``. The report is written to the session
+    directory after each main loop; scripts that merge results there
+    call `_write_profile` with the time spent instead.
+    """
+
+    def setup_profile_options(self):
+        self.add_param("--profile", action="store_true",
+                       dest="profile", default=False,
+                       help="Write a per-stage timing and I/O report"
+                       " ('{0}.json' and '{0}.csv') in the session"
+                       " directory.".format(gc3apps.Default.PROFILE_REPORT))
+
+        self.add_param("--sample-resources", metavar="SECONDS",
+                       type=positive_int,
+                       dest="sample_resources", default=None,
+                       help="Sample CPU, memory and block I/O of the job"
+                       " containers at this interval; samples are returned"
+                       " in '{0}' with the job outputs and summarized by"
+                       " '--profile'. Default: no sampling.".format(
+                           gc3apps.Default.RESOURCE_SAMPLES))
+
+    def after_main_loop(self):
+        if self.params.profile:
+            self._write_profile()
+
+    def _write_profile(self, merge_time=None):
+        write_report(self.session.tasks.values(),
+                     os.path.join(self.session.path,
+                                  gc3apps.Default.PROFILE_REPORT),
+                     merge_time)
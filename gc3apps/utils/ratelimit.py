@@ -0,0 +1,64 @@
+"""
+Token-bucket rate limiting.
+
+The bucket holds up to `burst` tokens and is refilled at `rate`
+tokens per second; each submission takes one token. With a ramp-up
+period the refill rate starts at zero and grows linearly to `rate`,
+so a large run starts slowly instead of hitting the cloud API with
+all of its chunks at once.
+"""
+
+import time
+
+
+class TokenBucket(object):
+    """
+    Allow on average `rate` events per second, with bursts of up to
+    `burst` events (default: one second's worth, at least 1).
+    The refill rate reaches `rate` `ramp_up` seconds after first use.
+    """
+
+    def __init__(self, rate, burst=None, ramp_up=0):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.ramp_up = float(ramp_up)
+        self.tokens = self.burst
+        self.started = None
+        self.updated = None
+
+    def _rate(self, now):
+        if self.ramp_up <= 0:
+            return self.rate
+        return self.rate * min(1.0, (now - self.started) / self.ramp_up)
+
+    def _refill(self, now=None):
+        now = time.time() if now is None else now
+        if self.started is None:
+            self.started = self.updated = now
+        if now > self.updated:
+            # rate is linear during the ramp-up, so the mean of both ends is exact
+            # except across its end, where it errs on the slow side
+            added = (now - self.updated) * (self._rate(self.updated) + self._rate(now)) / 2
+            self.tokens = min(self.burst, self.tokens + added)
+            self.updated = now
+
+    def __getstate__(self):
+        # restart the ramp-up when a session is resumed
+        state = self.__dict__.copy()
+        state.update(tokens=self.burst, started=None, updated=None)
+        return state
+
+    def available(self, now=None):
+        """
+        Return the number of whole tokens available at time `now`.
+        """
+        self._refill(now)
+        return max(int(self.tokens), 0)
+
+    def consume(self, count=1, now=None):
+        """
+        Take `count` tokens; the bucket may go into debt, which
+        delays the following events accordingly.
+        """
+        self._refill(now)
+        self.tokens -= count
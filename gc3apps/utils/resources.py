@@ -0,0 +1,87 @@
+"""
+Summarize the container resource samples written by
+`etc/resource_sampler.sh` and suggest a VM flavor and chunk size.
+
+Samples are `docker stats` lines: CPU as a percentage of one core,
+memory as "<usage> / <limit>" and block I/O as "<read> / <written>",
+with sizes in docker's human-readable units.
+"""
+
+import re
+import math
+
+_UNITS = {
+    'b': 1,
+    'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'tb': 1000 ** 4,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+_SIZE = re.compile(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$')
+
+
+def parse_size(text):
+    """
+    Return the number of bytes of a docker size like '1.5GiB'.
+    """
+    match = _SIZE.match(text)
+    if not match:
+        raise ValueError("Cannot parse size '{0}'".format(text))
+    value, unit = match.groups()
+    return int(float(value) * _UNITS[(unit or 'b').lower()])
+
+
+def read_samples(location):
+    """
+    Return the list of samples in `location` as dictionaries
+    with keys: timestamp, container, cpu, memory, read, write.
+    """
+    samples = []
+    with open(location) as fd:
+        for line in fd:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5 or fields[0] == 'timestamp':
+                continue
+            try:
+                read, write = fields[4].split('/')
+                samples.append(dict(timestamp=int(fields[0]),
+                                    container=fields[1],
+                                    cpu=float(fields[2].rstrip('%')),
+                                    memory=parse_size(fields[3].split('/')[0]),
+                                    read=parse_size(read),
+                                    write=parse_size(write)))
+            except (ValueError, KeyError):
+                continue
+    return samples
+
+
+def summarize(samples):
+    """
+    Return peak memory, mean/max CPU and total I/O of `samples`.
+    Block I/O counters are cumulative per container.
+    """
+    if not samples:
+        return dict(peak_memory=None, mean_cpu=None, max_cpu=None,
+                    read_bytes=None, write_bytes=None)
+    last = dict()
+    for sample in samples:
+        last[sample['container']] = sample
+    return dict(peak_memory=max(s['memory'] for s in samples),
+                mean_cpu=sum(s['cpu'] for s in samples) / len(samples),
+                max_cpu=max(s['cpu'] for s in samples),
+                read_bytes=sum(s['read'] for s in last.values()),
+                write_bytes=sum(s['write'] for s in last.values()))
+
+
+def suggest(peak_memory, mean_cpu, run_time, headroom, target_runtime):
+    """
+    Return a dictionary with the suggested cores and memory (bytes)
+    per job, and the factor to apply to the current chunk size so
+    that jobs last about `target_runtime` seconds.
+    """
+    suggestion = dict(cores=None, memory=None, chunk_scale=None)
+    if mean_cpu is not None:
+        suggestion['cores'] = max(1, int(math.ceil(mean_cpu / 100.0)))
+    if peak_memory is not None:
+        suggestion['memory'] = int(peak_memory * headroom)
+    if run_time:
+        suggestion['chunk_scale'] = round(float(target_runtime) / run_time, 2)
+    return suggestion
@@ -0,0 +1,283 @@
+"""
+Scale test harness for large pipeline sessions.
+
+Build a session of `RunCellprofiler` chunk tasks, the way
+`GCellprofilerPipeline.stage1` does, drive it with GC3Pie's `noop`
+backend (every progress cycle moves each job one state further:
+SUBMITTED, RUNNING, TERMINATING, TERMINATED) and measure:
+
+  build_time      seconds to create the tasks
+  memory_per_task resident memory growth per task, in bytes
+  cycles          progress cycles until all tasks terminated
+  cycle_mean      mean/max seconds of one `Engine.progress()` call
+  cycle_max
+  save_time       seconds to save the whole session
+  load_time       seconds to load it back
+  session_bytes   size of the session on disk
+
+Usage::
+
+  python -m gc3apps.utils.scale --tasks 1000 10000 100000 --cycle-budget 10
+
+All chunk tasks share one (empty) output folder, so that terminated
+tasks are cheap to post-process and only orchestration is measured.
+"""
+
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import gc3libs
+from gc3libs import Run
+from gc3libs.core import Core, Engine, MatchMaker
+from gc3libs.session import Session
+from gc3libs.quantity import GB, days
+from gc3libs.workflow import ParallelTaskCollection
+from gc3libs.backends.noop import NoOpLrms
+
+import gc3apps
+from gc3apps import RunCellprofiler, CellprofilerChunk, write_chunk_config
+from gc3apps.workflow import ThrottledParallelTaskCollection, GroupedTaskCollection
+
+COLLECTIONS = ['parallel', 'throttled', 'grouped']
+
+
+class ScaleLrms(NoOpLrms):
+    """
+    `noop` backend accepting the input and output files of the
+    chunk tasks; data staging is not simulated.
+    """
+
+    def validate_data(self, data_file_list=[]):
+        return True
+
+    def get_results(self, app, download_dir, overwrite=False,
+                    changed_only=True):
+        return
+
+
+class ScaleCore(Core):
+    """
+    A `Core` with a single `ScaleLrms` resource, which the
+    configuration file parser does not know about.
+    """
+
+    def __init__(self, slots):
+        self.auto_enable_auth = True
+        self.matchmaker = MatchMaker()
+        self.resources = dict(scale=ScaleLrms('scale',
+                                              architecture=set([Run.Arch.X86_64]),
+                                              max_cores=slots,
+                                              max_cores_per_job=1,
+                                              max_memory_per_core=1000 * GB,
+                                              max_walltime=1000 * days,
+                                              enabled=True))
+
+
+def rss():
+    """
+    Return the resident memory of this process, in bytes.
+    """
+    with open('/proc/self/statm') as fd:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def make_batch_file(location, images_path, image_sets):
+    """
+    Write a minimal CellProfiler `Batch_data.h5` readable by `CPparser`.
+    """
+    import h5py
+    import numpy
+    measurements = '/Measurements/2019-01-01-00-00-00'
+    with h5py.File(location, 'w') as fd:
+        fd.create_dataset(measurements + '/Experiment/CellProfiler_Version/data',
+                          data=numpy.array(['3.1.8'], dtype='S'))
+        fd.create_dataset(measurements + '/Image/PathName_Image/data',
+                          data=numpy.array([images_path] * image_sets, dtype='S'))
+    return location
+
+
+def make_tasks(root, tasks, chunk_size=100, compact=False):
+    """
+    Return `tasks` `RunCellprofiler` (or, if `compact`,
+    `CellprofilerChunk`) instances of `chunk_size` image sets
+    each, with the arguments `GCellprofilerPipeline` would use.
+    """
+    batch_file = os.path.join(root, 'Batch_data.h5')
+    if not os.path.exists(batch_file):
+        make_batch_file(batch_file, root, 1)
+    output_folder = os.path.join(root, 'output')
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    extra = dict(output_dir=os.path.join(root, '.compute'),
+                 docker_image=None)
+    if compact:
+        chunk_config = write_chunk_config(
+            os.path.join(extra['output_dir'], gc3apps.Default.CHUNK_CONFIG_FILE),
+            gc3apps.Default.CELLPROFILER_DOCKER_COMMAND,
+            {batch_file: os.path.basename(batch_file)},
+            output_folder,
+            batch_file="$PWD/{0}".format(os.path.basename(batch_file)),
+            data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+            docker_image=gc3apps.Default.DEFAULT_CELLPROFILER_DOCKER,
+            plugins='$HOME')
+    result = []
+    for n in range(tasks):
+        start = n * chunk_size + 1
+        end = start + chunk_size - 1
+        extra_args = extra.copy()
+        extra_args['jobname'] = "cp_run_{0}-{1}".format(start, end)
+        extra_args['output_dir'] = os.path.join(extra['output_dir'],
+                                                extra_args['jobname'])
+        if compact:
+            result.append(CellprofilerChunk(chunk_config, start, end, **extra_args))
+        else:
+            result.append(RunCellprofiler(batch_file, output_folder, start, end,
+                                          '$HOME', **extra_args))
+    return result
+
+
+def _size(location):
+    total = 0
+    for path, _, files in os.walk(location):
+        for name in files:
+            total += os.path.getsize(os.path.join(path, name))
+    return total
+
+
+def measure(tasks, root, collection='parallel', max_running=None,
+            slots=None, max_cycles=1000, compact=False, group_size=500):
+    """
+    Run the scale test with `tasks` chunk tasks below folder `root`
+    and return a dictionary with the measurements.
+    """
+    gc.collect()
+    memory = rss()
+    start = time.time()
+    children = make_tasks(root, tasks, compact=compact)
+    if collection == 'throttled':
+        top = ThrottledParallelTaskCollection(children, max_running=max_running)
+    elif collection == 'grouped':
+        top = GroupedTaskCollection(children, group_size, max_running=max_running)
+    else:
+        top = ParallelTaskCollection(children)
+    build_time = time.time() - start
+    gc.collect()
+    memory_per_task = float(rss() - memory) / tasks
+
+    engine = Engine(ScaleCore(slots or tasks))
+    engine.add(top)
+    latencies = []
+    while top.execution.state != Run.State.TERMINATED \
+            and len(latencies) < max_cycles:
+        start = time.time()
+        engine.progress()
+        latencies.append(time.time() - start)
+
+    session_path = os.path.join(root, 'session')
+    session = Session(session_path)
+    start = time.time()
+    # saves the collection and all of its tasks
+    session.add(top)
+    save_time = time.time() - start
+    session_bytes = _size(session_path)
+    del session, engine, top, children
+    gc.collect()
+
+    start = time.time()
+    loaded = Session(session_path)
+    load_time = time.time() - start
+    assert len(loaded.tasks) == 1
+    del loaded
+
+    return dict(tasks=tasks, collection=collection, compact=compact,
+                build_time=build_time,
+                memory_per_task=memory_per_task,
+                cycles=len(latencies),
+                cycle_mean=sum(latencies) / max(len(latencies), 1),
+                cycle_max=max(latencies or [0.0]),
+                save_time=save_time,
+                load_time=load_time,
+                session_bytes=session_bytes)
+
+
+def max_tasks(results, budget, field='cycle_mean'):
+    """
+    Extrapolate, from the worst per-task cost of `field` in
+    `results`, the number of tasks that fit within `budget`
+    seconds.
+    """
+    cost = max(result[field] / result['tasks'] for result in results)
+    if cost <= 0:
+        return None
+    return int(budget / cost)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure GC3Pie session"
+                                     " and progress-loop costs for large"
+                                     " numbers of CellProfiler chunks.")
+    parser.add_argument("--tasks", type=int, nargs='+',
+                        default=[1000, 10000],
+                        help="Session sizes to test. Default: %(default)s.")
+    parser.add_argument("--collection", choices=COLLECTIONS,
+                        default=COLLECTIONS[0],
+                        help="Collection holding the chunks."
+                        " Default: %(default)s.")
+    parser.add_argument("--max-running", type=int, default=None,
+                        help="Limit of the throttled collection.")
+    parser.add_argument("--compact-tasks", action="store_true",
+                        dest="compact", default=False,
+                        help="Use compact `CellprofilerChunk` tasks.")
+    parser.add_argument("--group-size", type=int, default=500,
+                        help="Tasks per group of the grouped collection."
+                        " Default: %(default)s.")
+    parser.add_argument("--slots", type=int, default=None,
+                        help="Concurrent jobs on the fake resource."
+                        " Default: all tasks at once.")
+    parser.add_argument("--cycle-budget", type=float, default=10.0,
+                        help="Acceptable seconds per progress cycle and"
+                        " session save. Default: %(default)s.")
+    parser.add_argument("--output", default=None,
+                        help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    gc3libs.configure_logger(level=40)
+    results = []
+    for tasks in args.tasks:
+        root = tempfile.mkdtemp(prefix='gc3apps_scale.')
+        try:
+            result = measure(tasks, root, args.collection,
+                             args.max_running, args.slots,
+                             compact=args.compact,
+                             group_size=args.group_size)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        results.append(result)
+        print("{tasks:>8} tasks: build {build_time:.2f}s,"
+              " {memory_per_task:.0f} B/task, {cycles} cycles"
+              " (mean {cycle_mean:.3f}s, max {cycle_max:.3f}s),"
+              " save {save_time:.2f}s, load {load_time:.2f}s,"
+              " {session_bytes} B on disk".format(**result))
+
+    limits = dict(
+        (field, max_tasks(results, args.cycle_budget, field))
+        for field in ['cycle_max', 'save_time'])
+    print("Max tasks within {0}s: {1} (progress cycle), {2} (session save)".format(
+        args.cycle_budget, limits['cycle_max'], limits['save_time']))
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(dict(results=results, budget=args.cycle_budget,
+                           max_tasks=limits), fd, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
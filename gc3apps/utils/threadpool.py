@@ -0,0 +1,82 @@
+"""
+Bounded pool of threads applying one function to queued work items.
+
+Used by the data daemon to run blocking inspections (e.g. reading
+zip archives over NFS) off its main loop: the loop submits items
+without blocking and collects finished results on each round.
+"""
+
+import threading
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+import gc3libs
+
+
+class BoundedThreadPool(object):
+    """
+    Run `function(*args)` for each submitted item in one of `workers`
+    threads; at most `maxsize` items wait for a free thread.
+    """
+
+    def __init__(self, function, workers=4, maxsize=16):
+        self.function = function
+        self.workers = workers
+        self._tasks = Queue(maxsize)
+        self._results = Queue()
+        self._threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name="{0}-{1}".format(
+                                          self.function.__name__, n))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                break
+            key, args = item
+            try:
+                result = self.function(*args)
+            except Exception as err:
+                gc3libs.log.error("Error processing {0}: {1}".format(key, err))
+                result = err
+            self._results.put((key, result))
+
+    def submit(self, key, *args):
+        """
+        Queue `args` for processing under `key`.
+        Return False if the queue is full.
+        """
+        try:
+            self._tasks.put_nowait((key, args))
+        except Full:
+            return False
+        return True
+
+    def results(self):
+        """
+        Return the list of (key, result) of the items processed since
+        the last call; `result` is the exception raised, if any.
+        """
+        done = []
+        while True:
+            try:
+                done.append(self._results.get_nowait())
+            except Empty:
+                return done
+
+    def stop(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
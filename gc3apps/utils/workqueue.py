@@ -0,0 +1,123 @@
+"""
+Minimal work queue backed by a (shared) directory.
+
+Each work item is a file; its state is given by the folder it lives in:
+
+  <root>/pending/<name>            waiting to be processed
+  <root>/running/<worker>/<name>   claimed by `worker`
+  <root>/done/<name>               successfully processed
+  <root>/failed/<name>             processing failed
+
+State transitions are plain `os.rename` calls, which are atomic
+within one filesystem (NFS included), so several workers on different
+hosts can safely pull from the same queue.
+
+This module only depends on the standard library: it is staged
+together with the worker scripts and imported within the containers.
+"""
+
+import os
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+_TMP = 'tmp'
+
+
+class FileWorkQueue(object):
+    """
+    Work queue whose items are text files (one entry per line)
+    stored below `root`.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for state in [PENDING, RUNNING, DONE, FAILED, _TMP]:
+            folder = os.path.join(root, state)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # created by a concurrent worker
+                    pass
+
+    def _path(self, state, name, worker=None):
+        if worker:
+            return os.path.join(self.root, state, worker, name)
+        return os.path.join(self.root, state, name)
+
+    def put(self, name, lines):
+        """
+        Add item `name` with content `lines` to the pending items.
+        """
+        tmp = self._path(_TMP, name)
+        with open(tmp, 'w') as fd:
+            for line in lines:
+                fd.write("{0}\n".format(line))
+        os.rename(tmp, self._path(PENDING, name))
+
+    def claim(self, worker):
+        """
+        Move the first pending item to `worker`.
+        Return a tuple (name, lines) or None if the queue is drained.
+        """
+        folder = os.path.join(self.root, RUNNING, worker)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for name in sorted(os.listdir(os.path.join(self.root, PENDING))):
+            try:
+                os.rename(self._path(PENDING, name),
+                          self._path(RUNNING, name, worker))
+            except OSError:
+                # somebody else got it first
+                continue
+            with open(self._path(RUNNING, name, worker)) as fd:
+                return (name, [line.strip() for line in fd if line.strip()])
+        return None
+
+    def complete(self, worker, name):
+        os.rename(self._path(RUNNING, name, worker),
+                  self._path(DONE, name))
+
+    def fail(self, worker, name):
+        os.rename(self._path(RUNNING, name, worker),
+                  self._path(FAILED, name))
+
+    def requeue(self, worker=None, failed=False):
+        """
+        Put items claimed by `worker` (all workers if None) back
+        into the pending items; with `failed`, also retry failed items.
+        Return the list of requeued item names.
+        """
+        requeued = []
+        running = os.path.join(self.root, RUNNING)
+        workers = [worker] if worker else os.listdir(running)
+        for owner in workers:
+            folder = os.path.join(running, owner)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                os.rename(self._path(RUNNING, name, owner),
+                          self._path(PENDING, name))
+                requeued.append(name)
+        if failed:
+            for name in os.listdir(os.path.join(self.root, FAILED)):
+                os.rename(self._path(FAILED, name),
+                          self._path(PENDING, name))
+                requeued.append(name)
+        return requeued
+
+    def status(self):
+        """
+        Return a dictionary mapping each item name to its state.
+        """
+        status = dict()
+        for state in [PENDING, DONE, FAILED]:
+            for name in os.listdir(os.path.join(self.root, state)):
+                status[name] = state
+        running = os.path.join(self.root, RUNNING)
+        for owner in os.listdir(running):
+            for name in os.listdir(os.path.join(running, owner)):
+                status[name] = RUNNING
+        return status
@@ -0,0 +1,70 @@
+"""
+Read the central directory of a zip archive record by record.
+
+`zipfile.ZipFile` parses the whole central directory into `ZipInfo`
+objects when the archive is opened; callers that only need to find
+one entry (e.g. the first `.mcd` file of a multi-GB IMC archive) can
+stop as soon as it shows up instead.
+"""
+
+import struct
+import zipfile
+
+_ZIP64_EXTRA = 0x0001
+_ZIP64_LIMIT = 0xffffffff
+_UTF8_FLAG = 0x800
+
+
+def _zip64_uncompressed_size(extra, size):
+    """
+    Return the 64-bit uncompressed size from a Zip64 `extra` field.
+    """
+    while len(extra) >= 4:
+        tag, length = struct.unpack('<HH', extra[:4])
+        if tag == _ZIP64_EXTRA and size == _ZIP64_LIMIT and length >= 8:
+            return struct.unpack('<Q', extra[4:12])[0]
+        extra = extra[4 + length:]
+    return size
+
+
+def read_entries_count(fd):
+    """
+    Return (total entries, central directory offset) of the open
+    archive `fd`, read from its end of central directory record.
+    """
+    endrec = zipfile._EndRecData(fd)
+    if endrec is None:
+        raise zipfile.BadZipfile("File is not a zip file")
+    size_cd = endrec[zipfile._ECD_SIZE]
+    offset_cd = endrec[zipfile._ECD_OFFSET]
+    # bytes prepended to the archive, e.g. a self-extractor
+    concat = endrec[zipfile._ECD_LOCATION] - size_cd - offset_cd
+    if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64:
+        concat -= (zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator)
+    return (endrec[zipfile._ECD_ENTRIES_TOTAL], offset_cd + concat)
+
+
+def iter_central_directory(fd):
+    """
+    Yield a tuple (filename, uncompressed size) for each entry
+    of the open archive `fd`, in central directory order.
+    """
+    entries, start = read_entries_count(fd)
+    fd.seek(start)
+    for n in range(entries):
+        header = fd.read(zipfile.sizeCentralDir)
+        if len(header) != zipfile.sizeCentralDir:
+            raise zipfile.BadZipfile("Truncated central directory")
+        record = struct.unpack(zipfile.structCentralDir, header)
+        if record[zipfile._CD_SIGNATURE] != zipfile.stringCentralDir:
+            raise zipfile.BadZipfile("Bad magic number for central directory")
+        filename = fd.read(record[zipfile._CD_FILENAME_LENGTH])
+        extra = fd.read(record[zipfile._CD_EXTRA_FIELD_LENGTH])
+        fd.seek(record[zipfile._CD_COMMENT_LENGTH], 1)
+        if record[zipfile._CD_FLAG_BITS] & _UTF8_FLAG:
+            filename = filename.decode('utf-8')
+        else:
+            filename = filename.decode('cp437')
+        yield (filename,
+               _zip64_uncompressed_size(extra,
+                                        record[zipfile._CD_UNCOMPRESSED_SIZE]))
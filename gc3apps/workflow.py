@@ -0,0 +1,300 @@
+"""
+Task collections shared by the gc3apps pipelines.
+"""
+
+from collections import namedtuple, OrderedDict
+
+import gc3libs
+import gc3libs.exceptions
+from gc3libs import Application, Run, Task
+from gc3libs.workflow import TaskCollection, ParallelTaskCollection, \
+    SequentialTaskCollection
+
+
+class ThrottledParallelTaskCollection(ParallelTaskCollection):
+    """
+    A `ParallelTaskCollection` that hands at most `max_running` of
+    its tasks to the engine at any time (no limit if None).
+
+    `max_running` may be changed while the collection runs, e.g. by
+    the data daemon's fair-share scheduler; tasks are released in
+    order as earlier ones terminate.
+
+    If `rate_limit` is a `gc3apps.utils.ratelimit.TokenBucket`, each
+    released task also takes one of its tokens, so that tasks reach
+    the backends at a bounded rate.
+    """
+
+    def __init__(self, tasks=None, max_running=None, rate_limit=None, **extra_args):
+        self.max_running = max_running
+        self.rate_limit = rate_limit
+        # tasks[:released] have been submitted
+        self.released = 0
+        ParallelTaskCollection.__init__(self, tasks, **extra_args)
+
+    def demand(self):
+        """
+        Return the number of tasks not yet terminated.
+        """
+        return len([task for task in self.tasks
+                    if task.execution.state != Run.State.TERMINATED])
+
+    def active(self):
+        """
+        Return the number of released tasks not yet terminated.
+        """
+        return len([task for task in self.tasks[:self.released]
+                    if task.execution.state != Run.State.TERMINATED])
+
+    def _allowance(self):
+        """
+        Return the number of tasks that may be released now.
+        """
+        allowance = len(self.tasks) - self.released
+        if self.max_running is not None:
+            allowance = min(allowance, self.max_running - self.active())
+        if self.rate_limit is not None:
+            allowance = min(allowance, self.rate_limit.available())
+        return max(allowance, 0)
+
+    def _weight(self, task):
+        """
+        Return the number of rate-limit tokens taken by releasing `task`.
+        """
+        return 1
+
+    def _release(self, resubmit=False, targets=None, **extra_args):
+        for task in self.tasks[self.released:self.released + self._allowance()]:
+            if self._attached and not task._attached:
+                task.attach(self._controller)
+            try:
+                task.submit(resubmit, targets, **extra_args)
+            except (gc3libs.exceptions.ResourceNotReady,
+                    gc3libs.exceptions.MaximumCapacityReached):
+                break
+            if self.rate_limit is not None:
+                self.rate_limit.consume(self._weight(task))
+            self.released += 1
+            self.changed = True
+
+    def attach(self, controller):
+        """
+        Attach only the released tasks to `controller`: an `Engine`
+        submits every new task attached to it, so the others are
+        attached as they are released.
+        """
+        for task in self.tasks[:self.released]:
+            if not task._attached:
+                task.attach(controller)
+        Task.attach(self, controller)
+
+    def add(self, task):
+        """
+        Add a task to the collection; it is attached when released.
+        """
+        task.detach()
+        self.tasks.append(task)
+
+    def kill(self, **extra_args):
+        """
+        Kill the released tasks; the others are never started.
+        """
+        for task in self.tasks[:self.released]:
+            task.kill(**extra_args)
+        self.execution.state = Run.State.TERMINATED
+        self.execution.returncode = (Run.Signals.Cancelled, -1)
+        self.changed = True
+
+    def submit(self, resubmit=False, targets=None, **extra_args):
+        """
+        Start the first `max_running` tasks of the collection.
+        """
+        if resubmit:
+            self.released = 0
+        self._release(resubmit, targets, **extra_args)
+        self.execution.state = self._state()
+
+    def update_state(self, **extra_args):
+        """
+        Update state of all tasks and release new ones
+        in place of those that terminated.
+        """
+        ParallelTaskCollection.update_state(self, **extra_args)
+        if self.released < len(self.tasks):
+            self._release()
+            self.execution.state = self._state()
+        return self.execution.state
+
+    def redo(self, *args, **kwargs):
+        self.released = 0
+        super(ThrottledParallelTaskCollection, self).redo(*args, **kwargs)
+
+
+TaskSummary = namedtuple('TaskSummary', ['jobname', 'returncode', 'timestamp',
+                                         'output_dir', 'output_folder'])
+
+
+def summarize(task):
+    """
+    Return the `TaskSummary` of `task`.
+    """
+    return TaskSummary(task.jobname,
+                       task.execution.returncode,
+                       dict(task.execution.timestamp),
+                       getattr(task, 'output_dir', None),
+                       getattr(task, 'output_folder', None))
+
+
+class TaskGroup(ParallelTaskCollection):
+    """
+    A group of tasks of a `GroupedTaskCollection`. Once all of
+    them have terminated, they are replaced by their `TaskSummary`
+    records in `self.summaries` and removed from the engine, so the
+    group is neither polled nor kept in memory any longer.
+    Finished groups cannot be resubmitted.
+    """
+
+    def __init__(self, tasks=None, **extra_args):
+        self.summaries = []
+        ParallelTaskCollection.__init__(self, tasks, **extra_args)
+
+    def terminated(self):
+        ParallelTaskCollection.terminated(self)
+        self.summaries.extend(summarize(task) for task in self.tasks)
+        for task in self.tasks:
+            task.detach()
+        self.tasks = []
+        self.changed = True
+
+
+class GroupedTaskCollection(ThrottledParallelTaskCollection):
+    """
+    A `ThrottledParallelTaskCollection` holding `tasks` in groups of
+    `group_size` (see `TaskGroup`), so that each progress cycle only
+    goes through the groups and the tasks of running groups.
+    `max_running` and `rate_limit` still count tasks: groups are
+    released as long as all of their tasks fit, and one at a time if
+    a group is larger (once nothing is running, resp. once the token
+    bucket is full).
+    """
+
+    def __init__(self, tasks=None, group_size=500, max_running=None,
+                 rate_limit=None, **extra_args):
+        self.group_size = group_size
+        tasks = list(tasks or [])
+        groups = [TaskGroup(tasks[index:index + group_size],
+                            jobname="{0}_group{1}".format(extra_args.get('jobname', 'tasks'),
+                                                          index // group_size))
+                  for index in range(0, len(tasks), group_size)]
+        ThrottledParallelTaskCollection.__init__(self, groups, max_running,
+                                                 rate_limit, **extra_args)
+
+    def demand(self):
+        return sum(len([task for task in group.tasks
+                        if task.execution.state != Run.State.TERMINATED])
+                   for group in self.tasks)
+
+    def active(self):
+        return sum(len([task for task in group.tasks
+                        if task.execution.state != Run.State.TERMINATED])
+                   for group in self.tasks[:self.released])
+
+    def _allowance(self):
+        if self.max_running is None and self.rate_limit is None:
+            return len(self.tasks) - self.released
+        active = self.active() if self.max_running is not None else 0
+        budget = self.max_running - active if self.max_running is not None else float('inf')
+        tokens = self.rate_limit.available() if self.rate_limit is not None else float('inf')
+        full = self.rate_limit is None or tokens >= self.rate_limit.burst
+        allowance = 0
+        for group in self.tasks[self.released:]:
+            size = len(group.tasks)
+            if budget <= 0 or (size > budget and (active or allowance)):
+                break
+            if tokens <= 0 or (size > tokens and (not full or allowance)):
+                break
+            budget -= size
+            tokens -= size
+            allowance += 1
+        return allowance
+
+    def _weight(self, group):
+        return len(group.tasks)
+
+
+class LocalityTaskCollection(ParallelTaskCollection):
+    """
+    Run `tasks` in one `ThrottledParallelTaskCollection` per storage
+    key (`keys[n]` is the key of `tasks[n]`, see
+    `gc3apps.utils.locality`), each running at most `max_readers`
+    tasks, so that no directory or export is read by too many jobs
+    at once while the others keep the remaining slots busy.
+    With `group_size`, each key gets a `GroupedTaskCollection`.
+    `rate_limit` is shared by all keys.
+    """
+
+    def __init__(self, tasks=None, keys=None, max_readers=None, group_size=None,
+                 rate_limit=None, **extra_args):
+        self.max_readers = max_readers
+        self.rate_limit = rate_limit
+        tasks = list(tasks or [])
+        if keys is None:
+            keys = [None] * len(tasks)
+        by_key = OrderedDict()
+        for task, key in zip(tasks, keys):
+            by_key.setdefault(key, []).append(task)
+        self.keys = list(by_key)
+        jobname = extra_args.get('jobname', 'tasks')
+        collections = []
+        for n, members in enumerate(by_key.values()):
+            name = "{0}_{1}".format(jobname, n)
+            if group_size:
+                collections.append(GroupedTaskCollection(members, group_size, max_readers,
+                                                         rate_limit, jobname=name))
+            else:
+                collections.append(ThrottledParallelTaskCollection(members, max_readers,
+                                                                   rate_limit, jobname=name))
+        ParallelTaskCollection.__init__(self, collections, **extra_args)
+
+    def _share_rate_limit(self):
+        # each collection loaded from a session has a copy of its own
+        for collection in self.tasks:
+            collection.rate_limit = self.rate_limit
+
+    def submit(self, resubmit=False, targets=None, **extra_args):
+        self._share_rate_limit()
+        return ParallelTaskCollection.submit(self, resubmit, targets, **extra_args)
+
+    def update_state(self, **extra_args):
+        self._share_rate_limit()
+        return ParallelTaskCollection.update_state(self, **extra_args)
+
+
+def iter_summaries(task):
+    """
+    Yield the `TaskSummary` of every application below `task`,
+    including those collapsed into finished `TaskGroup`s.
+    """
+    if isinstance(task, Application):
+        yield summarize(task)
+    elif isinstance(task, TaskCollection):
+        for summary in getattr(task, 'summaries', []):
+            yield summary
+        for child in task.tasks:
+            for summary in iter_summaries(child):
+                yield summary
+
+
+def with_preflight(preflight, task, **extra_args):
+    """
+    Return a `SequentialTaskCollection` that runs the `preflight`
+    tasks in parallel (e.g. image pulls warming up the execution
+    hosts) and then `task`; just `task` if there are none.
+    A failed pre-flight task does not stop `task`.
+    """
+    if not preflight:
+        return task
+    jobname = extra_args.get('jobname', 'tasks')
+    return SequentialTaskCollection([ParallelTaskCollection(preflight,
+                                                            jobname=jobname + "_preflight"),
+                                     task], **extra_args)
@@ -0,0 +1,183 @@
+"""
+Benchmarks of the chunking, merging and discovery hot paths,
+run on synthetic data (no docker or cloud access needed).
+
+Run with::
+
+  pytest tests/test_benchmark.py --benchmark-only
+
+and compare runs with ``--benchmark-autosave`` / ``--benchmark-compare``.
+"""
+
+import os
+import json
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+h5py = pytest.importorskip('h5py')
+
+from gc3apps.utils.h5parse import CPparser
+from gc3apps.pipelines import gcp_pipeline, gilk_pipeline
+
+GROUPS = 10 ** 5
+CHUNKS = 50
+ROWS = 200
+IMAGES = 5000
+
+
+def make_groups(location, groups=GROUPS):
+    """
+    Write a fake CellProfiler `--print-groups` JSON file:
+    one image set per group.
+    """
+    data = [[{"Metadata_Plate": "P{0}".format(n // 384),
+              "Metadata_Well": "W{0}".format(n % 384)},
+             [n + 1]]
+            for n in range(groups)]
+    with open(location, 'w') as fd:
+        json.dump(data, fd)
+    return location
+
+
+def make_chunk_outputs(root, chunks=CHUNKS, rows=ROWS):
+    """
+    Create `chunks` CellProfiler output folders, each with two
+    per-object CSV files and a few images in a subfolder.
+    """
+    folders = []
+    for chunk in range(chunks):
+        folder = os.path.join(root, "output_{0}-{1}".format(chunk * 10 + 1,
+                                                            chunk * 10 + 10))
+        os.makedirs(os.path.join(folder, 'masks'))
+        for name in ['Image.csv', 'cell.csv']:
+            with open(os.path.join(folder, name), 'w') as fd:
+                fd.write("ImageNumber,ObjectNumber,Area,Intensity\n")
+                for row in range(rows):
+                    fd.write("{0},{1},{2},{3}\n".format(chunk, row, row * 3, row * 0.5))
+        for image in range(5):
+            with open(os.path.join(folder, 'masks',
+                                   "mask_{0}_{1}.tiff".format(chunk, image)), 'wb') as fd:
+                fd.write(b'\0' * 1024)
+        folders.append(folder)
+    return folders
+
+
+def make_image_tree(root, images=IMAGES, per_folder=100):
+    """
+    Create `images` small files spread over plate/well folders,
+    plus one non-image file per folder.
+    """
+    for n in range(images):
+        folder = os.path.join(root, "plate_{0}".format(n // (per_folder * 10)),
+                              "well_{0}".format(n // per_folder))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'metadata.xml'), 'w') as fd:
+                fd.write('<xml/>')
+        with open(os.path.join(folder, "img_{0:06d}.tiff".format(n)), 'wb') as fd:
+            fd.write(b'\0' * 16)
+    return root
+
+
+def make_batch_data(location, images_path, version='3.1.8', channels=10):
+    """
+    Write a minimal CellProfiler Batch_data.h5 readable by CPparser.
+    """
+    date = '2019-01-14-12-01-59'
+    with h5py.File(location, 'w') as fd:
+        fd.create_dataset('/Measurements/{0}/Experiment/CellProfiler_Version/data'.format(date),
+                          data=[version])
+        for channel in range(channels):
+            fd.create_dataset('/Measurements/{0}/Image/PathName_ch{1}/data'.format(date, channel),
+                              data=[images_path])
+            fd.create_dataset('/Measurements/{0}/Image/FileName_ch{1}/data'.format(date, channel),
+                              data=["img_{0}.tiff".format(n) for n in range(1000)])
+    return location
+
+
+@pytest.fixture(scope='module')
+def groups(tmpdir_factory):
+    location = make_groups(str(tmpdir_factory.mktemp('groups').join('groups.json')))
+    with open(location) as fd:
+        return json.load(fd)
+
+
+@pytest.fixture(scope='module')
+def chunk_outputs(tmpdir_factory):
+    return make_chunk_outputs(str(tmpdir_factory.mktemp('chunks')))
+
+
+@pytest.fixture(scope='module')
+def image_tree(tmpdir_factory):
+    return make_image_tree(str(tmpdir_factory.mktemp('images')))
+
+
+@pytest.fixture(scope='module')
+def batch_data(tmpdir_factory):
+    folder = tmpdir_factory.mktemp('batch')
+    return make_batch_data(str(folder.join('Batch_data.h5')), str(folder))
+
+
+@pytest.mark.benchmark(group='chunking')
+def test_cp_get_chunks(benchmark, groups):
+    chunks = benchmark(lambda: list(gcp_pipeline._get_chunks(groups, 100)))
+    assert chunks[0] == (1, 100)
+
+
+@pytest.mark.benchmark(group='chunking')
+def test_ilastik_get_chunks(benchmark):
+    images = ["img_{0:06d}.tiff".format(n) for n in range(GROUPS)]
+    chunks = benchmark(lambda: list(gilk_pipeline._get_chunks(images, 100)))
+    assert len(chunks) == GROUPS // 100
+
+
+def _fresh_destination(tmpdir):
+    """
+    Return a benchmark setup function passing a new,
+    empty destination folder to every round.
+    """
+    rounds = iter(range(1000))
+
+    def setup():
+        destination = str(tmpdir.join("merged_{0}".format(next(rounds))))
+        os.makedirs(destination)
+        return (destination,), {}
+    return setup
+
+
+@pytest.mark.benchmark(group='merging')
+def test_cp_csv_handler(benchmark, chunk_outputs, tmpdir):
+    csv_handler = getattr(gcp_pipeline, '__csv_handler')
+
+    def merge(destination):
+        for folder in chunk_outputs:
+            csv_handler(folder, destination)
+    benchmark.pedantic(merge, setup=_fresh_destination(tmpdir), rounds=3)
+
+
+@pytest.mark.benchmark(group='merging')
+def test_cp_combine_directory(benchmark, chunk_outputs, tmpdir):
+    def merge(destination):
+        for folder in chunk_outputs:
+            gcp_pipeline._combine_cp_directory(folder, destination)
+    benchmark.pedantic(merge, setup=_fresh_destination(tmpdir), rounds=3)
+
+
+@pytest.mark.benchmark(group='merging')
+def test_ilastik_combine_directories(benchmark, chunk_outputs, tmpdir):
+    def merge(destination):
+        gilk_pipeline._combine_directories(chunk_outputs, destination)
+    benchmark.pedantic(merge, setup=_fresh_destination(tmpdir), rounds=3)
+
+
+@pytest.mark.benchmark(group='discovery')
+def test_ilastik_get_images(benchmark, image_tree):
+    images = benchmark(gilk_pipeline._get_images, image_tree, r'.*\.tiff$')
+    assert len(images) == IMAGES
+
+
+@pytest.mark.benchmark(group='discovery')
+def test_cpparser(benchmark, batch_data):
+    parser = benchmark(CPparser, batch_data)
+    assert parser.version == '3.1.8'
+    assert len(parser.paths) == 10
@@ -0,0 +1,115 @@
+import os
+import pickle
+import pytest
+
+import gc3apps
+from gc3apps import RunCellprofiler, RunIlastik, CellprofilerChunk, \
+    IlastikChunk, write_chunk_config
+
+h5py = pytest.importorskip('h5py')
+
+@pytest.fixture
+def batch_file(tmpdir):
+    from gc3apps.utils.scale import make_batch_file
+    return make_batch_file(str(tmpdir.join('Batch_data.h5')), str(tmpdir), 1)
+
+def test_cellprofiler_chunk(tmpdir, batch_file):
+    """
+    Test a compact chunk runs the same command as `RunCellprofiler`
+    and does not save it with the session
+    """
+    output = tmpdir.join('output_{start}-{end}')
+    config = write_chunk_config(str(tmpdir.join('chunks.json')),
+                                gc3apps.Default.CELLPROFILER_DOCKER_COMMAND,
+                                {batch_file: 'Batch_data.h5'},
+                                str(output),
+                                batch_file='$PWD/Batch_data.h5',
+                                data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                docker_image='cellprofiler',
+                                plugins='/plugins')
+    chunk = CellprofilerChunk(config, 11, 20, output_dir=str(tmpdir.join('out')),
+                              jobname='cp_run_11-20')
+    task = RunCellprofiler(batch_file, str(tmpdir.join('output_11-20')), 11, 20,
+                           '/plugins', output_dir=str(tmpdir.join('out')),
+                           docker_image='cellprofiler')
+    assert chunk.output_folder == task.output_folder
+    assert chunk.arguments == task.arguments
+    assert dict(chunk.inputs) == dict(task.inputs)
+
+    prepulled = CellprofilerChunk(write_chunk_config(str(tmpdir.join('prepull.json')),
+                                                     gc3apps.Default.CELLPROFILER_DOCKER_COMMAND,
+                                                     {batch_file: 'Batch_data.h5'},
+                                                     str(output),
+                                                     prepull=True,
+                                                     batch_file='$PWD/Batch_data.h5',
+                                                     data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                                     docker_image='cellprofiler',
+                                                     plugins='/plugins'),
+                                  11, 20, output_dir=str(tmpdir.join('out')))
+    assert prepulled.arguments == RunCellprofiler(batch_file, str(tmpdir.join('output_11-20')),
+                                                  11, 20, '/plugins', prepull=True,
+                                                  output_dir=str(tmpdir.join('out')),
+                                                  docker_image='cellprofiler').arguments
+    assert prepulled.arguments[:3] == ['./docker_prepull.sh', 'cellprofiler', 'pull.tsv']
+
+    packed = CellprofilerChunk(write_chunk_config(str(tmpdir.join('packed.json')),
+                                                  gc3apps.Default.CELLPROFILER_DOCKER_COMMAND,
+                                                  {batch_file: 'Batch_data.h5'},
+                                                  str(output),
+                                                  pack_outputs=True,
+                                                  batch_file='$PWD/Batch_data.h5',
+                                                  data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                                  docker_image='cellprofiler',
+                                                  plugins='/plugins'),
+                               11, 20, output_dir=str(tmpdir.join('out')))
+    assert packed.arguments == RunCellprofiler(batch_file, str(tmpdir.join('output_11-20')),
+                                               11, 20, '/plugins', pack_outputs=True,
+                                               output_dir=str(tmpdir.join('out')),
+                                               docker_image='cellprofiler').arguments
+    assert packed.arguments[:3] == ['./pack_outputs.sh', 'results', 'results.tar.gz']
+    assert '$PWD/results:/output' in packed.arguments
+    assert packed.output_folder == task.output_folder
+
+    saved = pickle.dumps(chunk, -1)
+    assert '--plugins-directory' not in saved
+    assert len(saved) < len(pickle.dumps(task, -1))
+    assert pickle.loads(saved).arguments == task.arguments
+
+def test_ilastik_chunk(tmpdir):
+    """
+    Test a compact chunk stages its own image list
+    """
+    project = tmpdir.join('project.ilp')
+    project.write('')
+    inputs = tmpdir.mkdir('inputs')
+    inputs.join('5-7.txt').write("a\nb\nc\n")
+    config = write_chunk_config(str(tmpdir.join('chunks.json')),
+                                gc3apps.Default.ILASTIK_DOCKER_FILELIST_COMMAND,
+                                {str(project): 'project.ilp',
+                                 str(inputs.join('{start}-{end}.txt')): gc3apps.Default.ILASTIK_INPUT_LIST},
+                                str(tmpdir),
+                                sample_resources=5,
+                                project_file='$PWD/project.ilp',
+                                project=gc3apps.Default.ILASTIK_PROJECT,
+                                data_mount_point=gc3apps.Default.DEFAULT_BBSERVER_MOUNT_POINT,
+                                docker_image='ilastik',
+                                input_list='$PWD/' + gc3apps.Default.ILASTIK_INPUT_LIST,
+                                export_source='Probabilities',
+                                export_dtype='uint16',
+                                output_filename='{nickname}.tiff')
+    chunk = IlastikChunk(config, 5, 7, output_dir=str(tmpdir.join('out')),
+                         jobname='ilastik_run_1')
+    task = RunIlastik(str(project), str(inputs.join('5-7.txt')), str(tmpdir),
+                      'Probabilities', 'uint16', '{nickname}.tiff',
+                      output_dir=str(tmpdir.join('out')), docker_image='ilastik',
+                      sample_resources=5)
+    assert chunk.arguments == task.arguments
+    assert dict(chunk.inputs) == dict(task.inputs)
+    assert chunk.executables == task.executables
+
+    # file lists from unicode paths (os.walk, JSON) are staged too
+    unicode_task = RunIlastik(unicode(project), unicode(inputs.join('5-7.txt')), str(tmpdir),
+                              'Probabilities', 'uint16', '{nickname}.tiff',
+                              output_dir=str(tmpdir.join('out')), docker_image='ilastik',
+                              sample_resources=5)
+    assert unicode_task.arguments == task.arguments
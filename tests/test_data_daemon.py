@@ -0,0 +1,177 @@
+import time
+import zipfile
+import argparse
+from collections import deque
+
+from gc3libs.core import Engine
+from gc3libs.session import Session
+
+import gc3apps
+import gc3apps.pipelines
+from gc3apps.data_daemon import InboxProcessingDaemon
+from gc3apps.pipelines import IMCPlaceholderPipeline, SMCPlaceholderPipeline, \
+    get_data_files
+from gc3apps.utils import zipscan
+from gc3apps.utils.events import FolderEventCoalescer
+from gc3apps.utils.markerscan import MarkerScanner
+from gc3apps.utils.pathindex import PathPrefixIndex
+from gc3apps.utils.threadpool import BoundedThreadPool
+from gc3apps.utils.scale import ScaleCore
+from gc3apps.utils.metrics import DaemonMetrics
+
+def _experiment(inbox, path, suffix, count):
+    folder = inbox.ensure(path, dir=True)
+    with zipfile.ZipFile(str(folder.join('data.zip')), 'w') as archive:
+        archive.writestr('readme.txt', 'x')
+        for n in range(count):
+            archive.writestr("acq{0}{1}".format(n, suffix), 'y')
+    return str(folder)
+
+def _daemon(tmpdir, max_running_chunks, share_weights=None, placeholders=True):
+    """Return a daemon set up as by `parse_args`, without its main loop"""
+    daemon = InboxProcessingDaemon.__new__(InboxProcessingDaemon)
+    daemon.params = argparse.Namespace(dryrun=False,
+                                       config_file=str(tmpdir.join('config')),
+                                       max_running_chunks=max_running_chunks)
+    daemon.session = Session(str(tmpdir.join('session')))
+    daemon._controller = Engine(ScaleCore(100))
+    daemon.extra = dict()
+    daemon.processed = set()
+    daemon.pipelines = dict()
+    daemon.pipeline_classes = dict(gc3apps.pipelines.PLACEHOLDER_PIPELINES
+                                   if placeholders else gc3apps.pipelines.DAEMON_PIPELINES)
+    daemon.metrics = DaemonMetrics()
+    daemon.share_weights = share_weights or dict()
+    return daemon
+
+def _dispatch(daemon, inbox, paths, monkeypatch):
+    """
+    Classify experiment folders as the classifier threads do, then
+    add their pipelines as `every_main_loop` does, without reading
+    any archive
+    """
+    results = []
+    for path in paths:
+        folder = str(inbox.join(path))
+        results.append((folder, daemon._classify(folder, daemon._get_dataset(
+            str(inbox.join(path, 'data.zip'))))))
+    with monkeypatch.context() as patch:
+        def fail(fd):
+            raise AssertionError("archive read on the main loop")
+        patch.setattr(zipscan, 'iter_central_directory', fail)
+        for folder, (dataset_info, data_files) in results:
+            daemon._check_folder_completion_file(folder, str(inbox),
+                                                 dataset_info, data_files)
+
+def test_placeholder_pipelines(tmpdir):
+    """
+    Test a placeholder pipeline runs one throttled task per data file
+    """
+    inbox = tmpdir.mkdir('inbox')
+    folder = _experiment(inbox, 'alice/exp1', '.mcd', 3)
+    data_files = get_data_files(folder, '.mcd')
+    assert [entry for archive, entry in data_files] == \
+        ['acq0.mcd', 'acq1.mcd', 'acq2.mcd']
+    imc = IMCPlaceholderPipeline(folder, data_files, 'config',
+                                 jobname='IMC_alice/exp1', output_dir=str(tmpdir.join('out')))
+    assert [task.jobname for task in imc.tasks] == \
+        ['IMC_alice/exp1_0', 'IMC_alice/exp1_1', 'IMC_alice/exp1_2']
+    folder = _experiment(inbox, 'bob/exp2', '.fcs', 2)
+    smc = SMCPlaceholderPipeline(folder, get_data_files(folder, '.fcs'), 'config',
+                                 jobname='sMC_bob/exp2', output_dir=str(tmpdir.join('out')))
+    assert len(smc.tasks) == 2
+
+def test_no_pipeline(tmpdir):
+    """
+    Test experiments are only classified unless placeholders are asked for
+    """
+    inbox = tmpdir.mkdir('inbox')
+    _experiment(inbox, 'alice/exp1', '.mcd', 3)
+    daemon = _daemon(tmpdir, 0, placeholders=False)
+    folder = str(inbox.join('alice/exp1'))
+    dataset_info, data_files = daemon._classify(folder, str(inbox.join('alice/exp1/data.zip')))
+    assert (dataset_info.analysis_type, data_files) == ('IMC', [])
+    daemon._check_folder_completion_file(folder, str(inbox), dataset_info, data_files)
+    assert daemon.pipelines == dict()
+    assert daemon.session.tasks == dict()
+    assert daemon.metrics.counters['experiments_unsupported'] == 1
+
+def test_share_chunks(tmpdir, monkeypatch):
+    """
+    Test the running chunks are split between share keys first,
+    then between the pipelines of each key
+    """
+    inbox = tmpdir.mkdir('inbox')
+    daemon = _daemon(tmpdir, 12)
+    experiments = [('alice/exp1', 'IMC', '.mcd', 20),
+                   ('alice/exp2', 'IMC', '.mcd', 20),
+                   ('bob/exp3', 'sMC', '.fcs', 20)]
+    for path, analysis_type, suffix, count in experiments:
+        _experiment(inbox, path, suffix, count)
+    _dispatch(daemon, inbox, [path for path, _, _, _ in experiments], monkeypatch)
+    pipelines = dict((path, daemon.pipelines[str(inbox.join(path))])
+                     for path, _, _, _ in experiments)
+    assert pipelines['bob/exp3'].share_key == 'bob'
+    daemon._share_chunks()
+    assert pipelines['bob/exp3'].max_running == 6
+    assert sorted([pipelines['alice/exp1'].max_running,
+                   pipelines['alice/exp2'].max_running]) == [3, 3]
+
+    for n in range(5):
+        daemon._controller.progress()
+        daemon._share_chunks()
+    running = [pipeline.active() for pipeline in pipelines.values()]
+    assert sum(running) <= 12
+    assert pipelines['bob/exp3'].active() <= 6
+
+    weighted = _daemon(tmpdir.mkdir('weighted'), 12, {'alice': 3})
+    _dispatch(weighted, inbox, [path for path, _, _, _ in experiments], monkeypatch)
+    weighted._share_chunks()
+    assert weighted.pipelines[str(inbox.join('bob/exp3'))].max_running == 3
+
+def _scanning_daemon(tmpdir, inbox):
+    """
+    Return a daemon scanning `inbox`, set up as by `parse_args`
+    and `before_main_loop`, on the session in `tmpdir`
+    """
+    daemon = _daemon(tmpdir, 0)
+    daemon.params.marker_timeout = None
+    daemon.params.metrics_file = str(tmpdir.join('metrics.prom'))
+    daemon.metrics_json = str(tmpdir.join('metrics.json'))
+    daemon.inbox_index = PathPrefixIndex([(str(inbox), str(inbox))])
+    daemon.events = FolderEventCoalescer(0)
+    daemon.backlog = deque()
+    daemon.classifying = dict()
+    daemon.classifier = BoundedThreadPool(daemon._classify, 1, 4)
+    daemon.classifier.start()
+    daemon.scanner = MarkerScanner([str(inbox)], str(tmpdir.join('scan.json')),
+                                   daemon._is_completion_marker)
+    return daemon
+
+def test_restart_keeps_pending_folders(tmpdir):
+    """
+    Test a folder whose marker was seen but which was not dispatched
+    yet is processed by a restarted daemon, and only once
+    """
+    inbox = tmpdir.mkdir('inbox')
+    _experiment(inbox, 'alice/exp1', '.mcd', 2)
+    daemon = _scanning_daemon(tmpdir, inbox)
+    # stops while the folder is being classified
+    daemon.classifier.stop()
+    daemon.every_main_loop()
+    assert daemon.classifying and not daemon.pipelines
+
+    restarted = _scanning_daemon(tmpdir, inbox)
+    for n in range(50):
+        restarted.every_main_loop()
+        if restarted.pipelines:
+            break
+        time.sleep(0.1)
+    restarted.classifier.stop()
+    assert list(restarted.pipelines) == [str(inbox.join('alice/exp1'))]
+    # the pipeline is recorded before the marker is forgotten
+    assert Session(str(tmpdir.join('session'))).list_names() == set(['IMC_alice/exp1'])
+    restarted.every_main_loop()
+    again = _scanning_daemon(tmpdir, inbox)
+    again.classifier.stop()
+    assert again.scanner.scan() == []
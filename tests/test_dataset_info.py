@@ -0,0 +1,48 @@
+import os
+import zipfile
+import pytest
+import gc3apps
+
+@pytest.fixture
+def imc_zip(tmpdir):
+    """Return an IMC archive placed in an instrument folder"""
+    location = str(tmpdir.mkdir('hyperion').join('exp1.zip'))
+    with zipfile.ZipFile(location, 'w') as archive:
+        archive.writestr('exp1/readme.txt', 'x' * 10)
+        archive.writestr('exp1/slide.mcd', 'y' * 100)
+        archive.writestr('exp1/panel.csv', 'z' * 1000)
+    return location
+
+def test_classify_imc(imc_zip):
+    """
+    Test that the archive is classified from its central directory
+    """
+    info = gc3apps.get_dataset_info(imc_zip)
+    assert info.analysis_type == 'IMC'
+    assert info.instrument == 'hyperion'
+    assert info.first_entry == 'exp1/readme.txt'
+    assert info.entries == 3
+
+def test_cache_invalidated_on_change(imc_zip):
+    """
+    Test that a rewritten archive is classified again
+    """
+    assert gc3apps.get_dataset_info(imc_zip).analysis_type == 'IMC'
+    with zipfile.ZipFile(imc_zip, 'w') as archive:
+        archive.writestr('exp1/sample.fcs', 'f' * 10)
+        archive.writestr('exp1/other.txt', 'o')
+    os.utime(imc_zip, (0, 0))
+    info = gc3apps.get_dataset_info(imc_zip)
+    assert info.analysis_type == 'sMC'
+    assert info.entries == 2
+
+def test_fcs_takes_precedence(tmpdir):
+    """
+    Test that an archive with both .mcd and .fcs files is sMC,
+    whatever the order of its entries
+    """
+    location = str(tmpdir.mkdir('fortessa').join('exp2.zip'))
+    with zipfile.ZipFile(location, 'w') as archive:
+        archive.writestr('exp2/slide.mcd', 'y')
+        archive.writestr('exp2/sample.fcs', 'f')
+    assert gc3apps.get_dataset_info(location).analysis_type == 'sMC'
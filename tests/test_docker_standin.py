@@ -0,0 +1,115 @@
+"""
+Tests for the `docker run` stand-in used to run pipelines locally.
+"""
+
+import os
+import imp
+import sys
+import json
+import pytest
+
+import gc3apps
+
+h5py = pytest.importorskip('h5py')
+
+standin = imp.load_source('docker_standin',
+                          os.path.join(gc3apps.whereami, 'etc', 'docker_standin.py'))
+
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    monkeypatch.setattr(standin, 'SECONDS', 0)
+    monkeypatch.setattr(standin, 'SIZE', 128)
+    monkeypatch.setattr(standin, 'ROWS', 3)
+
+
+@pytest.fixture
+def images(tmpdir):
+    folder = tmpdir.mkdir('images')
+    for n in range(5):
+        folder.join("img_{0}.tiff".format(n)).write('')
+    return folder
+
+
+def test_mounts():
+    mounts, image, args = standin.parse_docker_args(
+        ['-v', '/data/out:/output', '-v', '/data/in:/in:ro', '--rm',
+         'bblab/qtl:1.0', 'a', '/output/x', '--done-file=/in/y'])
+    assert image == 'bblab/qtl:1.0'
+    assert [standin.translate(arg, mounts) for arg in args] == \
+        ['a', '/data/out/x', '--done-file=/data/in/y']
+    assert standin.to_host('/outputs', mounts) == '/outputs'
+
+
+def test_cellprofiler_flow(tmpdir, images, capsys):
+    output = tmpdir.mkdir('output')
+    filelist = output.join('filelist.txt')
+    filelist.write("\n".join(str(image) for image in images.listdir()))
+    assert standin.main(['-v', '{0}:/output'.format(output),
+                         '-v', '{0}:/tmp/filelist.txt'.format(filelist),
+                         'bblab/cellprofiler:3.1.8', '-c', '-r',
+                         '--file-list=/tmp/filelist.txt', '-o', '/output']) == 0
+
+    batch_file = str(output.join('Batch_data.h5'))
+    parser = gc3apps.CPparser(batch_file)
+    assert parser.version == '3.1.8'
+    assert parser.paths == [str(images)]
+
+    capsys.readouterr()
+    standin.main(['-v', '{0}:/output'.format(output), 'bblab/cellprofiler:3.1.8',
+                  '-c', '--print-groups=/output/Batch_data.h5'])
+    groups = json.loads(capsys.readouterr()[0])
+    assert [group[1] for group in groups] == [[1], [2], [3], [4], [5]]
+
+    command = gc3apps.Default.CELLPROFILER_DOCKER_COMMAND.format(
+        batch_file=batch_file, data_mount_point='/mnt', data_source='/mnt',
+        docker_image='cellprofiler',
+        start=2, end=4, plugins='/plugins', output_folder=str(output)).split()
+    assert standin.main(command[len(gc3apps.Default.DOCKER_RUN.split()):]) == 0
+    assert len(output.join('cell.csv').readlines()) == 1 + 3 * 3
+    assert len(output.join('masks').listdir()) == 3
+    assert output.join(gc3apps.Default.CELLPROFILER_DONEFILE).check()
+
+
+def test_ilastik_file_list(tmpdir, images):
+    output = tmpdir.mkdir('output')
+    inputs = tmpdir.join('inputs.txt')
+    inputs.write("\n".join(str(image) for image in sorted(images.listdir())) + "\n")
+    script = "sed -n \"2,3p\" /tmp/inputs.txt | tr \"\\n\" \"\\0\" | " \
+             "xargs -0 -r ./run_ilastik.sh --headless " \
+             "--output_filename_format=/output/{nickname}_Probabilities.tiff " \
+             "--export_source Probabilities"
+    assert standin.main(['-v', '{0}:/output'.format(output),
+                         '-v', '{0}:/tmp/inputs.txt'.format(inputs),
+                         'ilastik/ilastik-from-binary:1.3.2b3',
+                         '/bin/sh', '-c', script]) == 0
+    assert sorted(output.listdir()) == [output.join('img_1_Probabilities.tiff'),
+                                        output.join('img_2_Probabilities.tiff')]
+
+
+def test_qtl(tmpdir):
+    output = tmpdir.mkdir('results')
+    assert standin.main(['-v', '/data:/data', '-v', '{0}:/output'.format(output),
+                         'bblab/qtl:0.1', 'pheno', '/data', '/output',
+                         '-b', '2', '-p', '4', '-l', '1']) == 0
+    files = sorted(output.listdir('pheno*perm*'))
+    assert len(files) == 2
+    assert len(files[0].readlines()) == 1 + 4
+
+
+def test_prepull(tmpdir, monkeypatch):
+    """
+    Test the image is pulled once per host and the pull time reported
+    """
+    import subprocess
+    monkeypatch.setenv('DOCKER', "{0} {1}".format(sys.executable, standin.__file__))
+    monkeypatch.setenv('GC3APPS_STANDIN_IMAGES', str(tmpdir.join('images')))
+    monkeypatch.setenv('PULL_LOCK', str(tmpdir.join('lock')))
+    script = os.path.join(gc3apps.whereami, 'etc', gc3apps.Default.IMAGE_PULL_FILE)
+    statuses = []
+    for n in range(2):
+        output = tmpdir.join("pull{0}.tsv".format(n))
+        assert subprocess.call([script, 'bblab/cellprofiler:3.1.8', str(output),
+                                'true']) == 0
+        statuses.append(output.readlines()[1].strip().split('\t')[-1])
+    assert statuses == ['pulled', 'present']
@@ -0,0 +1,33 @@
+from gc3apps.utils.events import FolderEventCoalescer
+
+def test_folder_released_once_after_quiet_window():
+    """
+    Test that a burst of events on one folder is released once,
+    only after the marker has been seen and the folder went quiet
+    """
+    events = FolderEventCoalescer(quiet_window=10)
+    events.touch('/inbox/exp1', '/inbox', now=0)
+    events.touch('/inbox/exp1', '/inbox', marker='/inbox/exp1/exp1.zip', now=5)
+    events.touch('/inbox/exp1', '/inbox', now=8)
+    events.touch('/inbox/exp2', '/inbox', now=8)
+    assert events.ready(now=12) == []
+    assert events.ready(now=18) == [('/inbox/exp1', '/inbox', '/inbox/exp1/exp1.zip')]
+    assert events.ready(now=100) == []
+    # folders without a completion marker are kept waiting
+    assert '/inbox/exp2' in events
+
+def test_folder_without_marker_expires():
+    """
+    Test that folders whose marker never shows up are forgotten
+    after `max_age` seconds without events
+    """
+    events = FolderEventCoalescer(quiet_window=10, max_age=100)
+    events.touch('/inbox/stray', '/inbox', now=0)
+    events.touch('/inbox/stray', '/inbox', now=50)
+    events.touch('/inbox/exp1', '/inbox', marker='/inbox/exp1/exp1.zip', now=0)
+    assert events.expire(now=120) == []
+    assert events.expire(now=150) == ['/inbox/stray']
+    assert '/inbox/stray' not in events
+    # completed folders are only released by `ready`
+    assert '/inbox/exp1' in events
+    assert FolderEventCoalescer(quiet_window=10).expire(now=10 ** 9) == []
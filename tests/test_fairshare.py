@@ -0,0 +1,24 @@
+from gc3apps.utils.fairshare import water_fill, hierarchical_fill
+
+def test_small_demands_served_in_full():
+    """
+    Test that capacity unused by small consumers goes to large ones
+    """
+    assert water_fill({'big': 5000, 'small': 3}, 100) == {'big': 97, 'small': 3}
+    assert water_fill({'a': 10, 'b': 10}, 100) == {'a': 10, 'b': 10}
+
+def test_weights():
+    """
+    Test that shares follow the weights
+    """
+    assert water_fill({'a': 100, 'b': 100}, 30, {'a': 2}) == {'a': 20, 'b': 10}
+
+def test_hierarchical_fill():
+    """
+    Test that a key with many collections gets no more than its share
+    """
+    groups = {'alice': {1: 50, 2: 50, 3: 50}, 'bob': {4: 5}}
+    allocation = hierarchical_fill(groups, 20)
+    assert allocation[4] == 5
+    assert sum(allocation[n] for n in [1, 2, 3]) == 15
+    assert max(allocation.values()) - min(allocation[n] for n in [1, 2, 3]) <= 1
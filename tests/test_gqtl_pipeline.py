@@ -0,0 +1,157 @@
+import pytest
+from gc3apps.pipelines.gqtl_pipeline import _get_batches, _get_batch_size
+
+def test_get_batches_even():
+    """
+    Test that batches are split in equally sized jobs
+    """
+    assert list(_get_batches(3000, 1000)) == [(0, 1000), (1000, 1000), (2000, 1000)]
+
+def test_get_batches_uneven():
+    """
+    Test that job sizes differ by at most one and cover all batches
+    """
+    jobs = list(_get_batches(10, 4))
+    assert jobs == [(0, 4), (4, 3), (7, 3)]
+    assert sum(size for offset, size in jobs) == 10
+
+def test_get_batch_size(caplog):
+    """
+    Test that the batch size follows the cost model
+    """
+    # one batch: 100 * 10 * 1000 trees at 0.01s = 10000s
+    assert _get_batch_size(100, 10, 1000, 36000, 0.01) == 3
+    # never less than one batch per job, but warn about the overrun
+    assert _get_batch_size(100, 10, 1000, 60, 0.01) == 1
+    assert 'overrun the target walltime' in caplog.text
+
+def test_requested_walltime():
+    """
+    Test jobs request the target walltime, or the estimate if longer
+    """
+    from gc3libs.quantity import seconds
+    from gc3apps.pipelines.gqtl_pipeline import _get_requested_walltime
+    assert _get_requested_walltime(3, 1, 100, 10, 1000, 36000, 0.01).amount(seconds) == 36000
+    # one batch of two packed phenotypes: 2 x 10000s
+    assert _get_requested_walltime(1, 2, 100, 10, 1000, 60, 0.01).amount(seconds) == 20000
+
+def test_pack_command(tmpdir):
+    """
+    Test a packed job runs every phenotype and records its status
+    """
+    import gc3apps
+    from gc3apps import QTLApplication
+    task = QTLApplication(['p1', 'p2'], str(tmpdir), 10, 100, 10, 1000, 0.9, 0, '1.1.0',
+                          output_dir=str(tmpdir.join('out')), staging='mount')
+    assert task.phenotypes == ['p1', 'p2']
+    assert gc3apps.Default.QTL_PHENOTYPE_STATUS in [str(url) for url in task.outputs]
+    assert task.arguments[:2] == ['/bin/sh', '-c']
+    command = task.arguments[2]
+    assert command.count('bblab/qtl:1.1.0') == 2
+    assert 'bblab/qtl:1.1.0 p1 /data /output -b 10' in command
+    assert 'echo "p1 \\$?" >> phenotypes.txt; ' in command
+    assert command.endswith('; } && ! grep -qv " 0$" phenotypes.txt')
+    single = QTLApplication(u'p1', str(tmpdir), 10, 100, 10, 1000, 0.9, 0, '1.1.0',
+                            output_dir=str(tmpdir.join('out')))
+    assert single.phenotypes == [u'p1']
+    assert 'phenotypes.txt' not in ' '.join(single.arguments)
+
+def test_pack_failure(tmpdir, monkeypatch):
+    """
+    Test a failed phenotype neither stops the others nor
+    discards their results
+    """
+    import subprocess
+    import gc3apps
+    from gc3libs.utils import sh_quote_unsafe
+    from gc3apps import QTLApplication
+    from gc3apps.pipelines.gqtl_pipeline import _ingest_permutations
+    fake = tmpdir.join('qtl')
+    fake.write('#!/bin/sh\ntest "$1" != bad && touch data/$1.perm\n')
+    fake.chmod(0o755)
+    monkeypatch.setattr(gc3apps.Default, 'QTL_COMMAND', './qtl {phenotype}')
+    tmpdir.mkdir('data')
+    task = QTLApplication(['p1', 'bad', 'p2'], str(tmpdir.join('data')),
+                          10, 100, 10, 1000, 0.9, 0, '1.1.0',
+                          output_dir=str(tmpdir), jobname='p1+2_batch_0')
+    # run the command line the way the backends write it into the job script
+    command = ' '.join(sh_quote_unsafe(arg) for arg in task.arguments)
+    assert subprocess.call(['/bin/sh', '-c', command], cwd=str(tmpdir)) != 0
+    assert tmpdir.join('phenotypes.txt').read() == "p1 0\nbad 1\np2 0\n"
+    task.execution.returncode = (0, 1)
+    task.terminated()
+    assert task.failed_phenotypes == ['bad']
+    assert _ingest_permutations(task, str(tmpdir.join('store')), '{phenotype}*perm*') == ['p1', 'p2']
+
+def _batch(tmpdir, name, phenotypes, state, values=None):
+    from gc3libs import Run
+    from gc3apps import QTLApplication
+    task = QTLApplication(phenotypes, str(tmpdir), 1, 100, 10, 1000, 0.9, 0, '1.1.0',
+                          output_dir=str(tmpdir.join(name)), jobname=name,
+                          staging='mount')
+    task.execution.state = state
+    if values is not None:
+        task.execution.returncode = (0, 0)
+        results = tmpdir.join(name, 'output')
+        results.ensure(dir=True)
+        for phenotype in phenotypes:
+            results.join("{0}_perm1.txt".format(phenotype)).write(
+                '\n'.join(str(value) for value in values))
+        task.terminated()
+    task.killed = False
+    def kill(**extra_args):
+        task.killed = True
+    task.kill = kill
+    return task
+
+def test_stop_early(tmpdir):
+    """
+    Test remaining batches are cancelled once all phenotypes are null,
+    and only then
+    """
+    from gc3libs import Run
+    from gc3apps.pipelines.gqtl_pipeline import QTLBatchCollection
+    store = str(tmpdir.join('store'))
+    # observed statistic 0.5 is exceeded by every permutation
+    tasks = [_batch(tmpdir, 'p1_batch_0', ['p1'], Run.State.TERMINATED, [1.0] * 50),
+             _batch(tmpdir, 'p1_batch_1', ['p1'], Run.State.NEW)]
+    collection = QTLBatchCollection(tasks, store, '{phenotype}*perm*', ['p1'],
+                                    {'p1': 0.5}, alpha=0.05, min_permutations=10)
+    collection.update_state()
+    assert collection.ingested == set(['p1_batch_0'])
+    assert collection.cancelled == set(['p1_batch_1'])
+    assert tasks[1].killed
+
+    # p2 is significant: its batches keep running
+    tasks = [_batch(tmpdir, 'p2_batch_0', ['p2'], Run.State.TERMINATED, [0.0] * 50),
+             _batch(tmpdir, 'p2_batch_1', ['p2'], Run.State.NEW)]
+    collection = QTLBatchCollection(tasks, store, '{phenotype}*perm*', ['p2'],
+                                    {'p2': 0.5}, alpha=0.05, min_permutations=10)
+    collection.update_state()
+    assert collection.ingested == set(['p2_batch_0'])
+    assert not collection.cancelled
+    assert not tasks[1].killed
+
+def test_copy_staging_existing_permutations(tmpdir):
+    """
+    Test permutation files already in the data directory, copied back
+    by every copy-staged job, are not ingested
+    """
+    from gc3apps import QTLApplication
+    from gc3apps.pipelines.gqtl_pipeline import _get_existing_permutations, \
+        _ingest_permutations
+    from gc3apps.utils.nullstore import NullDistributionStore
+    data = tmpdir.mkdir('data')
+    data.join('p1_perm_0_0.txt').write("0.1\n0.2\n")
+    existing = _get_existing_permutations(str(data), ['p1'], '{phenotype}_perm_*.txt')
+    assert existing == ['p1_perm_0_0.txt']
+    store = str(tmpdir.join('store'))
+    for n in range(2):
+        name = "p1+0_batch_{0}".format(n)
+        task = QTLApplication(['p1'], str(data), 1, 100, 10, 1000, 0.9, 10 * n, '1.1.0',
+                              output_dir=str(tmpdir.join(name)), jobname=name)
+        data.copy(tmpdir.join(name, task.results))
+        tmpdir.join(name, task.results, "p1_perm_{0}_0.txt".format(10 * n + 1)).write("0.3\n")
+        task.execution.returncode = (0, 0)
+        assert _ingest_permutations(task, store, '{phenotype}_perm_*.txt', existing) == ['p1']
+    assert len(NullDistributionStore(store, 'p1')) == 2
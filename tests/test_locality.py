@@ -0,0 +1,75 @@
+import os
+import subprocess
+
+import gc3apps
+from gc3apps.utils.locality import locality_key, split_runs, write_file_list
+
+def test_locality_key():
+    """
+    Test images are keyed by directory or by pattern
+    """
+    assert locality_key('/mnt/bbvolume/exp/Plate_2/a.tiff') == '/mnt/bbvolume/exp/Plate_2'
+    assert locality_key('/mnt/bbvolume/exp/Plate_2/a.tiff', r'Plate_(\d+)') == '2'
+    assert locality_key('/mnt/bbvolume/exp/a.tiff', r'^/mnt/bbvolume/[^/]+') == '/mnt/bbvolume/exp'
+    assert locality_key('/data/a.tiff', r'Plate_(\d+)') == '/data'
+
+def test_split_runs():
+    """
+    Test runs of consecutive items are split on key changes
+    """
+    assert split_runs([1, 3, 2, 4, 5], lambda n: n % 2) == \
+        [(1, [1, 3]), (0, [2, 4]), (1, [5])]
+    assert split_runs([], len) == []
+
+def test_prefetch(tmpdir):
+    """
+    Test the listed files are copied to scratch with their paths
+    """
+    source = tmpdir.mkdir('plate')
+    for name in ['a.tiff', 'b.tiff', 'c.tiff']:
+        source.join(name).write(name)
+    listed = [str(source.join('a.tiff')), str(source.join('c.tiff'))]
+    image_list = write_file_list(listed, str(tmpdir.join('inputs', 'list.txt')))
+    scratch = tmpdir.join('scratch')
+    script = os.path.join(gc3apps.whereami, 'etc', gc3apps.Default.PREFETCH_FILE)
+    assert subprocess.call([script, image_list, str(scratch), 'true']) == 0
+    assert scratch.join(listed[0]).read() == 'a.tiff'
+    assert scratch.join(listed[1]).check()
+    assert not scratch.join(str(source.join('b.tiff'))).check()
+
+def test_prefetch_failure(tmpdir):
+    """
+    Test a file that cannot be copied fails the job before the command runs
+    """
+    source = tmpdir.mkdir('plate')
+    source.join('a.tiff').write('a.tiff')
+    listed = [str(source.join('a.tiff')), str(source.join('missing.tiff'))]
+    image_list = write_file_list(listed, str(tmpdir.join('inputs', 'list.txt')))
+    marker = tmpdir.join('ran')
+    script = os.path.join(gc3apps.whereami, 'etc', gc3apps.Default.PREFETCH_FILE)
+    assert subprocess.call([script, image_list, str(tmpdir.join('scratch')),
+                            'touch', str(marker)]) == 1
+    assert not marker.check()
+
+def test_image_files(tmpdir):
+    """
+    Test the image files of every image set are read from a batch file
+    """
+    import pytest
+    h5py = pytest.importorskip('h5py')
+    import numpy
+    from gc3apps.utils.h5parse import CPparser
+    batch_file = str(tmpdir.join('Batch_data.h5'))
+    image = '/Measurements/2019-01-01-00-00-00/Image/'
+    with h5py.File(batch_file, 'w') as fd:
+        fd.create_dataset('/Measurements/2019-01-01-00-00-00/Experiment/CellProfiler_Version/data',
+                          data=numpy.array(['3.1.8'], dtype='S'))
+        for channel in ['DNA', 'Actin']:
+            fd.create_dataset(image + 'PathName_' + channel + '/data',
+                              data=numpy.array([str(tmpdir)] * 2, dtype='S'))
+            fd.create_dataset(image + 'FileName_' + channel + '/data',
+                              data=numpy.array(["{0}_{1}.tiff".format(channel, n)
+                                                for n in range(2)], dtype='S'))
+    assert CPparser(batch_file).image_files() == \
+        [[str(tmpdir.join('Actin_0.tiff')), str(tmpdir.join('DNA_0.tiff'))],
+         [str(tmpdir.join('Actin_1.tiff')), str(tmpdir.join('DNA_1.tiff'))]]
@@ -0,0 +1,79 @@
+import os
+import pytest
+from gc3apps.utils.markerscan import MarkerScanner
+
+def _is_zip(path):
+    return path.endswith('.zip')
+
+@pytest.fixture
+def inbox(tmpdir):
+    """Return an inbox with one experiment folder"""
+    inbox = tmpdir.mkdir('inbox')
+    inbox.mkdir('exp1').join('data.txt').write('x')
+    return inbox
+
+def test_scan_reports_new_markers_once(inbox, tmpdir):
+    """
+    Test that markers are reported when created or changed,
+    and that the persisted state survives a restart
+    """
+    state = str(tmpdir.join('scan.json'))
+    scanner = MarkerScanner([str(inbox)], state, _is_zip)
+    assert scanner.scan() == []
+
+    marker = inbox.join('exp1').join('exp1.zip')
+    marker.write('partial')
+    assert scanner.scan() == [str(marker)]
+    # still growing: reported again
+    marker.write('partial upload completed')
+    assert scanner.scan() == [str(marker)]
+    scanner.done(str(inbox.join('exp1')))
+    assert scanner.scan() == []
+
+    inbox.mkdir('exp2').mkdir('nested').join('exp2.zip').write('z')
+    restarted = MarkerScanner([str(inbox)], state, _is_zip)
+    assert restarted.scan() == [str(inbox.join('exp2', 'nested', 'exp2.zip'))]
+    assert restarted.scan() == []
+
+def test_scan_completion_markers(inbox, tmpdir):
+    """
+    Test that both the dataset archive and the folder
+    marker are reported as completion markers
+    """
+    from gc3apps.utils.markerscan import is_completion_marker
+    scanner = MarkerScanner([str(inbox)], str(tmpdir.join('scan.json')),
+                            is_completion_marker)
+    assert scanner.scan() == []
+    archive = inbox.join('exp1', 'exp1.zip')
+    archive.write('z')
+    assert scanner.scan() == [str(archive)]
+    done = inbox.mkdir('exp2').join('done.txt')
+    inbox.join('exp2', 'data.txt').write('x')
+    done.write('')
+    assert scanner.scan() == [str(done)]
+    assert not is_completion_marker(str(inbox.join('exp2', 'data.txt')))
+
+def test_scan_pending_markers(inbox, tmpdir):
+    """
+    Test that markers of folders not done yet are reported
+    again after a restart, and only those
+    """
+    state = str(tmpdir.join('scan.json'))
+    scanner = MarkerScanner([str(inbox)], state, _is_zip)
+    first = inbox.join('exp1', 'exp1.zip')
+    first.write('z')
+    second = inbox.mkdir('exp2').join('exp2.zip')
+    second.write('z')
+    assert scanner.scan() == [str(first), str(second)]
+    scanner.done(str(inbox.join('exp1')))
+    # saved by the next scan
+    assert MarkerScanner([str(inbox)], state, _is_zip).pending == \
+        set([str(first), str(second)])
+    assert scanner.scan() == []
+
+    restarted = MarkerScanner([str(inbox)], state, _is_zip)
+    assert restarted.scan() == [str(second)]
+    assert restarted.scan() == []
+    restarted.done(str(inbox.join('exp2')))
+    restarted.scan()
+    assert MarkerScanner([str(inbox)], state, _is_zip).scan() == []
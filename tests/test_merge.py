@@ -0,0 +1,35 @@
+"""
+Tests for merging the chunk outputs of ``gcp_pipeline`` (stage2).
+"""
+
+import csv
+import pytest
+
+pytest.importorskip('pandas')
+
+from gc3apps.pipelines.gcp_pipeline import _combine_cp_directory
+
+def _chunk(tmpdir, name, first):
+    folder = tmpdir.mkdir(name)
+    folder.join('Image.csv').write("ImageNumber,Count_Cells\n"
+                                   "{0},10\n{1},12\n".format(first, first + 1))
+    folder.mkdir('masks').join("mask_{0}.tiff".format(first)).write('x')
+    folder.join('Experiment.txt').write(name)
+    return str(folder)
+
+def test_combine_cp_directory(tmpdir):
+    """
+    Test CSV rows of every chunk are appended under the same columns
+    and other files are copied once
+    """
+    destination = tmpdir.mkdir('merged')
+    for n, name in enumerate(['output_1-2', 'output_3-4']):
+        _combine_cp_directory(_chunk(tmpdir, name, 2 * n + 1), str(destination))
+    with destination.join('Image.csv').open() as fd:
+        rows = list(csv.reader(fd))
+    assert rows == [['ImageNumber', 'Count_Cells'],
+                    ['1', '10'], ['2', '12'], ['3', '10'], ['4', '12']]
+    assert sorted(destination.join('masks').listdir()) == \
+        [destination.join('masks', 'mask_1.tiff'), destination.join('masks', 'mask_3.tiff')]
+    # first copy wins
+    assert destination.join('Experiment.txt').read() == 'output_1-2'
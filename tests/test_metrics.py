@@ -0,0 +1,29 @@
+from gc3apps.utils import metrics
+from gc3apps.utils.metrics import DaemonMetrics
+
+def test_stage_latencies(tmpdir):
+    """
+    Test that stage transitions feed the latency histograms
+    and that metrics survive a save/load cycle
+    """
+    m = DaemonMetrics()
+    m.mark('exp1', metrics.DETECTED, when=0)
+    m.mark('exp1', metrics.CLASSIFIED, when=3)
+    m.mark('exp1', metrics.DETECTED, when=10)
+    m.mark('exp1', metrics.SUBMITTED, when=4)
+    assert m.in_progress()[metrics.SUBMITTED] == 1
+    m.mark('exp1', metrics.RUNNING, when=100)
+    m.mark('exp1', metrics.MERGED, when=4000)
+    assert 'exp1' not in m.experiments
+    assert m.counters['experiments_detected'] == 1
+    assert m.histograms['classification']['buckets'][1] == 1
+    assert m.histograms['total']['sum'] == 4000
+
+    location = str(tmpdir.join('metrics.json'))
+    m.save(location)
+    assert DaemonMetrics.load(location).histograms == m.histograms
+
+    text = m.to_prometheus()
+    assert 'gc3apps_daemon_experiments_merged_total 1' in text
+    assert 'gc3apps_daemon_total_latency_seconds_bucket{le="7200"} 1' in text
+    assert 'gc3apps_daemon_total_latency_seconds_bucket{le="3600"} 0' in text
@@ -0,0 +1,54 @@
+import pytest
+from gc3apps.utils.nullstore import NullDistributionStore, read_statistics, \
+    empirical_pvalue, wilson_interval
+
+@pytest.fixture
+def batch_file(tmpdir):
+    """Return a permutation batch file with a header line"""
+    location = tmpdir.join('pheno_perm_0.txt')
+    location.write("permutation\tstatistic\n1\t0.5\n2\t1.5\n3\t2.5\n")
+    return str(location)
+
+def test_read_statistics(batch_file):
+    """
+    Test that the header is skipped and the last column is read
+    """
+    assert list(read_statistics(batch_file)) == [0.5, 1.5, 2.5]
+
+def test_append_is_idempotent(tmpdir, batch_file):
+    """
+    Test that a batch is only ingested once, also across reopening
+    """
+    store = NullDistributionStore(str(tmpdir.join('store')), 'pheno')
+    assert store.append(batch_file, read_statistics(batch_file))
+    assert not store.append(batch_file, read_statistics(batch_file))
+    store = NullDistributionStore(str(tmpdir.join('store')), 'pheno')
+    assert batch_file in store
+    assert list(store.values()) == [0.5, 1.5, 2.5]
+
+def test_interrupted_append_is_dropped(tmpdir, batch_file):
+    """
+    Test that values not recorded in the index are discarded on open
+    """
+    store = NullDistributionStore(str(tmpdir.join('store')), 'pheno')
+    store.append(batch_file, read_statistics(batch_file))
+    with open(store.data, 'ab') as fd:
+        fd.write(b'\0' * 8)
+    store = NullDistributionStore(str(tmpdir.join('store')), 'pheno')
+    assert len(store) == 3
+
+def test_empirical_pvalue():
+    """
+    Test that the p-value counts exceedances with a +1 correction
+    """
+    assert empirical_pvalue([0.5, 1.5, 2.5], 1.0) == (0.75, 2, 3)
+
+def test_wilson_interval():
+    """
+    Test that the interval contains the estimate and shrinks with more permutations
+    """
+    low, high = wilson_interval(500, 1000)
+    assert low < 0.5 < high
+    narrow_low, narrow_high = wilson_interval(5000, 10000)
+    assert low < narrow_low and narrow_high < high
+    assert wilson_interval(0, 0) == (0.0, 1.0)
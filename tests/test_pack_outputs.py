@@ -0,0 +1,26 @@
+import os
+import subprocess
+
+import gc3apps
+from gc3apps import unpack_results
+
+def test_pack_outputs(tmpdir):
+    """
+    Test results written to the local folder are returned as one
+    archive and unpacked once into the output folder
+    """
+    job = tmpdir.mkdir('job')
+    script = os.path.join(gc3apps.whereami, 'etc', gc3apps.Default.OUTPUT_PACK_FILE)
+    rc = subprocess.call([script, 'results', gc3apps.Default.OUTPUT_ARCHIVE,
+                          'sh', '-c', 'echo a > results/a.csv; mkdir results/b;'
+                          ' echo b > results/b/b.tiff; exit 3'],
+                         cwd=str(job))
+    assert rc == 3
+    assert job.join(gc3apps.Default.OUTPUT_ARCHIVE).check()
+
+    output = tmpdir.join('output')
+    assert unpack_results(str(job), str(output)) == 2
+    assert output.join('a.csv').read() == 'a\n'
+    assert output.join('b', 'b.tiff').read() == 'b\n'
+    assert not job.join(gc3apps.Default.OUTPUT_ARCHIVE).check()
+    assert unpack_results(str(job), str(output)) is None
@@ -0,0 +1,14 @@
+from gc3apps.utils.pathindex import PathPrefixIndex
+
+def test_longest_prefix_nested_inboxes():
+    """
+    Test that the innermost inbox wins and that sibling
+    paths sharing a string prefix do not match
+    """
+    index = PathPrefixIndex([('/data/inbox', 'outer'),
+                             ('/data/inbox/imc', 'inner')])
+    assert index.longest_prefix('/data/inbox/imc/exp1/done.txt') == 'inner'
+    assert index.longest_prefix('/data/inbox/smc/exp2.zip') == 'outer'
+    assert index.longest_prefix('/data/inbox2/exp3.zip') is None
+    assert index.longest_prefix('/data/inbox/') == 'outer'
+    assert len(index) == 2
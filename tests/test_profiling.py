@@ -0,0 +1,113 @@
+import csv
+import json
+import argparse
+from gc3libs import Application, Run
+from gc3libs.workflow import ParallelTaskCollection
+import gc3apps
+from gc3apps import _sample_resources, _sh_command
+from gc3apps.utils.profiling import write_report, ProfileOptions
+
+def _run(task, times):
+    for state, when in zip([Run.State.SUBMITTED, Run.State.RUNNING,
+                            Run.State.TERMINATING, Run.State.TERMINATED], times):
+        task.execution.state = state
+        task.execution.timestamp[state] = when
+
+def test_report(tmpdir):
+    """
+    Test per-task timings, I/O, resource samples
+    and per-stage aggregation
+    """
+    data = tmpdir.join('input.txt')
+    data.write('x' * 100)
+    tasks = []
+    for n in range(2):
+        output_dir = tmpdir.mkdir('out{0}'.format(n))
+        output_dir.join('result').write('y' * 10)
+        output_dir.join('resources.tsv').write(
+            'timestamp\tcontainer\tcpu_percent\tmemory_usage\tblock_io\n'
+            '1\tabc\t150.0%\t1GiB / 8GiB\t1MB / 0B\n'
+            '2\tabc\t250.0%\t2GiB / 8GiB\t3MB / 1kB\n')
+        tasks.append(Application(['true'], [str(data)], [], str(output_dir),
+                                 jobname='chunk{0}'.format(n)))
+    _run(tasks[0], [0, 10, 40, 45])
+    _run(tasks[1], [0, 20, 30, 31])
+    pipeline = ParallelTaskCollection(tasks, jobname='pipeline')
+    pipeline.merge_time = 2.5
+
+    prefix = str(tmpdir.join('profile'))
+    write_report([pipeline], prefix)
+    with open(prefix + '.json') as fd:
+        report = json.load(fd)
+    assert report['merge_time'] == {'pipeline': 2.5}
+    first = report['tasks'][0]
+    assert (first['queue_wait'], first['run_time'], first['fetch_time']) == (10, 30, 5)
+    assert first['bytes_in'] == 100
+    assert first['peak_memory'] == 2 * 1024 ** 3
+    assert (first['mean_cpu'], first['read_bytes']) == (200.0, 3000000)
+    [stage] = report['stages']
+    assert stage['tasks'] == 2 and stage['wall_time'] == 45
+    assert stage['suggestion']['cores'] == 2
+    assert stage['suggestion']['chunk_scale'] == 180.0
+    with open(prefix + '.csv') as fd:
+        assert len(list(csv.DictReader(fd))) == 2
+
+def test_pull_time(tmpdir):
+    """
+    Test image pull time is reported apart from the run time
+    """
+    output_dir = tmpdir.mkdir('out')
+    output_dir.join('pull.tsv').write('timestamp\thost\timage\tseconds\tstatus\n'
+                                      '12\tvm1\tbblab/cellprofiler:3.1.8\t8\tpulled\n')
+    task = Application(['true'], [], [], str(output_dir), jobname='chunk')
+    _run(task, [0, 2, 32, 33])
+    prefix = str(tmpdir.join('profile'))
+    write_report([ParallelTaskCollection([task], jobname='pipeline')], prefix)
+    with open(prefix + '.json') as fd:
+        report = json.load(fd)
+    assert (report['tasks'][0]['run_time'], report['tasks'][0]['pull_time']) == (22, 8)
+    assert report['stages'][0]['pull_time'] == 8
+
+def test_sample_resources(monkeypatch):
+    """
+    Test every container launch, and only those, writes a cid file
+    """
+    monkeypatch.setattr(gc3apps.Default, 'DOCKER_RUN', 'podman run')
+    command = _sh_command(['podman run -v /a:/a image echo "podman run x"',
+                           'podman run image true'])
+    inputs = dict()
+    outputs = []
+    sampled, executables = _sample_resources(command, inputs, outputs,
+                                             dict(sample_resources=5))
+    assert sampled == "./{0} 5 {1} /bin/sh -c 'podman run --cidfile $PWD/{2}0 " \
+        "-v /a:/a image echo \"podman run x\" && " \
+        "podman run --cidfile $PWD/{2}1 image true'".format(
+            gc3apps.Default.RESOURCE_SAMPLER_FILE,
+            gc3apps.Default.RESOURCE_SAMPLES,
+            gc3apps.Default.RESOURCE_CID_PREFIX)
+    assert outputs == [gc3apps.Default.RESOURCE_SAMPLES]
+    assert _sample_resources(command, dict(), [], dict()) == (command, [])
+
+class _Script(ProfileOptions):
+    """Stand-in for a `SessionBasedScript`"""
+    def __init__(self, session, argv):
+        self.session = session
+        parser = argparse.ArgumentParser()
+        self.add_param = parser.add_argument
+        self.setup_profile_options()
+        self.params = parser.parse_args(argv)
+
+def test_profile_options(tmpdir):
+    """
+    Test the report is written to the session directory only with '--profile'
+    """
+    task = Application(['true'], [], [], str(tmpdir.mkdir('out')), jobname='chunk')
+    _run(task, [0, 2, 32, 33])
+    session = argparse.Namespace(path=str(tmpdir), tasks={'chunk': task})
+    report = tmpdir.join(gc3apps.Default.PROFILE_REPORT + '.json')
+    _Script(session, ['--sample-resources', '5']).after_main_loop()
+    assert not report.check()
+    script = _Script(session, ['--profile', '--sample-resources', '5'])
+    assert script.params.sample_resources == 5
+    script.after_main_loop()
+    assert json.load(report.open())['tasks'][0]['jobname'] == 'chunk'
@@ -0,0 +1,37 @@
+import pickle
+
+from gc3apps.utils.ratelimit import TokenBucket
+
+def test_token_bucket():
+    """
+    Test tokens are refilled at `rate` up to `burst`
+    """
+    bucket = TokenBucket(2, burst=5)
+    assert bucket.available(now=0) == 5
+    bucket.consume(5, now=0)
+    assert bucket.available(now=0) == 0
+    assert bucket.available(now=1) == 2
+    assert bucket.available(now=100) == 5
+    bucket.consume(8, now=100)
+    assert bucket.available(now=101) == 0
+    assert bucket.available(now=102.5) == 2
+
+def test_ramp_up():
+    """
+    Test the refill rate grows linearly during the ramp-up
+    """
+    bucket = TokenBucket(10, burst=1000, ramp_up=10)
+    bucket.consume(1000, now=0)
+    # mean rate 5/s over the first 10s, then 10/s
+    assert bucket.available(now=10) == 50
+    assert bucket.available(now=20) == 150
+
+def test_resumed():
+    """
+    Test a bucket loaded from a session starts afresh
+    """
+    bucket = TokenBucket(1, burst=3, ramp_up=60)
+    bucket.consume(3, now=0)
+    bucket = pickle.loads(pickle.dumps(bucket))
+    assert bucket.available(now=1000) == 3
+    assert bucket.started == 1000
@@ -0,0 +1,28 @@
+import pytest
+from gc3apps.utils.scale import measure, max_tasks
+
+h5py = pytest.importorskip('h5py')
+
+def test_measure(tmpdir):
+    """
+    Test a small session runs to completion on the fake backend
+    """
+    result = measure(20, str(tmpdir.mkdir('parallel')))
+    assert result['tasks'] == 20
+    # SUBMITTED, RUNNING, TERMINATING, TERMINATED, collection
+    assert result['cycles'] <= 5
+    assert result['session_bytes'] > 0
+    assert result['memory_per_task'] >= 0
+
+def test_measure_throttled(tmpdir):
+    """
+    Test the throttled collection releases tasks in batches
+    """
+    parallel = measure(20, str(tmpdir.mkdir('parallel')))
+    throttled = measure(20, str(tmpdir.mkdir('throttled')),
+                        collection='throttled', max_running=5)
+    assert throttled['cycles'] >= 4 * parallel['cycles'] - 4
+
+def test_max_tasks():
+    results = [dict(tasks=100, cycle_max=1.0), dict(tasks=1000, cycle_max=20.0)]
+    assert max_tasks(results, 10, 'cycle_max') == 500
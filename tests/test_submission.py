@@ -0,0 +1,56 @@
+import argparse
+
+from gc3libs import Application, Run
+from gc3apps.submission import DeferredFreeCore, SubmissionOptions
+
+class _Core(object):
+    def __init__(self):
+        self.freed = []
+        self.closed = False
+
+    def free(self, app):
+        self.freed.append(app)
+
+    def close(self):
+        self.closed = True
+
+def test_deferred_free(tmpdir):
+    """
+    Test resources are freed only after the idle time
+    """
+    core = DeferredFreeCore(_Core(), 60)
+    apps = [Application(['true'], [], [], str(tmpdir.join(str(n)))) for n in range(2)]
+    for app in apps:
+        app.execution.state = Run.State.TERMINATED
+    core.free(apps[0])
+    assert core.freed == []
+    core.free_idle()
+    assert core.freed == []
+    core.free_idle(core._deferred[0][0])
+    assert core.freed == [apps[0]]
+    core.free(apps[1])
+    core.close()
+    assert core.freed == apps
+    assert core.closed
+
+class _Script(SubmissionOptions):
+    """Stand-in for a `SessionBasedScript`"""
+    def __init__(self, rate_limit, argv):
+        self.parser = argparse.ArgumentParser()
+        self.add_param = self.parser.add_argument
+        self.setup_submission_options(rate_limit)
+        self.params = self.parser.parse_args(argv)
+
+def test_submission_options():
+    """
+    Test the options add a rate limit only where the script supports it
+    """
+    script = _Script(True, ['--submit-rate', '120', '--ramp-up', '60',
+                            '--vm-idle-time', '300'])
+    bucket = script._rate_limit()
+    assert (bucket.rate, bucket.burst, bucket.ramp_up) == (2.0, 2.0, 60.0)
+    assert script.params.vm_idle_time == 300
+    assert _Script(True, [])._rate_limit() is None
+    script = _Script(False, ['--vm-idle-time', '300'])
+    assert not hasattr(script.params, 'submit_rate')
+    assert script._rate_limit() is None
@@ -0,0 +1,34 @@
+import time
+from gc3apps.utils.threadpool import BoundedThreadPool
+
+def _square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+def test_pool_results_and_errors():
+    """
+    Test that results and exceptions are handed back by key
+    """
+    pool = BoundedThreadPool(_square, workers=2, maxsize=4)
+    pool.start()
+    for x in [1, 2, -3]:
+        assert pool.submit(x, x)
+    results = dict()
+    deadline = time.time() + 10
+    while len(results) < 3 and time.time() < deadline:
+        results.update(pool.results())
+        time.sleep(0.01)
+    pool.stop()
+    assert results[1] == 1 and results[2] == 4
+    assert isinstance(results[-3], ValueError)
+
+def test_pool_is_bounded():
+    """
+    Test that submission fails once the queue is full
+    """
+    pool = BoundedThreadPool(_square, workers=1, maxsize=2)
+    # not started: nothing consumes the queue
+    assert pool.submit('a', 1)
+    assert pool.submit('b', 2)
+    assert not pool.submit('c', 3)
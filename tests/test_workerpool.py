@@ -0,0 +1,126 @@
+import os
+import imp
+import sys
+import types
+import argparse
+
+from gc3libs import Application, Run
+from gc3libs.core import Engine
+
+import gc3apps
+import gc3apps.utils.workqueue
+from gc3apps import RunIlastikWorker
+from gc3apps.utils.scale import ScaleCore
+from gc3apps.utils.workqueue import FileWorkQueue
+from gc3apps.pipelines.gilk_pipeline import GIlastikWorkerPool
+
+def _pool(tmpdir, max_retries):
+    queue = FileWorkQueue(str(tmpdir.join('queue')))
+    queue.put('chunk_000000', ['a.tiff'])
+    # worker0 dies while holding the chunk
+    queue.claim('worker0')
+    workers = [Application(['true'], [], [], str(tmpdir.join("worker{0}".format(n))),
+                           jobname="worker{0}".format(n))
+               for n in range(2)]
+    return queue, GIlastikWorkerPool(queue.root, workers, max_retries=max_retries,
+                                     jobname='ilastik_workers')
+
+def _run(pool, cycle=None):
+    engine = Engine(ScaleCore(10))
+    engine.add(pool)
+    for n in range(100):
+        if pool.execution.state == Run.State.TERMINATED:
+            break
+        engine.progress()
+        if cycle:
+            cycle()
+
+def test_worker_pool_resubmits(tmpdir, monkeypatch):
+    """
+    Test chunks of dead workers are requeued once per termination
+    and a worker is resubmitted when none is left to process them
+    """
+    calls = []
+    requeue = FileWorkQueue.requeue
+    def counting(self, *args, **kwargs):
+        calls.append(kwargs.get('worker'))
+        return requeue(self, *args, **kwargs)
+    monkeypatch.setattr(FileWorkQueue, 'requeue', counting)
+
+    queue, pool = _pool(tmpdir, 1)
+    def work():
+        # the resubmitted worker processes the chunk
+        if pool.retries and queue.claim('worker0'):
+            queue.complete('worker0', 'chunk_000000')
+    _run(pool, work)
+    assert pool.execution.state == Run.State.TERMINATED
+    assert pool.retries == 1
+    assert pool.chunks == {'chunk_000000': 'done'}
+    assert sorted(calls) == ['worker0', 'worker0', 'worker1']
+
+def test_worker_pool_retries(tmpdir):
+    """
+    Test the pool fails once `max_retries` resubmissions did not help
+    """
+    queue, pool = _pool(tmpdir, 2)
+    _run(pool)
+    assert pool.execution.state == Run.State.TERMINATED
+    assert pool.retries == 2
+    assert pool.execution.exitcode == 1
+    assert pool.chunks == {'chunk_000000': 'pending'}
+
+def test_worker_command(tmpdir):
+    """
+    Test the worker stages its script and mounts the queue
+    """
+    project = tmpdir.join('project.ilp')
+    project.write('')
+    task = RunIlastikWorker(str(project), str(tmpdir.join('queue')), str(tmpdir),
+                            'Probabilities', 'uint16', None,
+                            jobname='ilastik_worker_0', docker_image='ilastik',
+                            output_dir=str(tmpdir.join('out')))
+    assert sorted(os.path.basename(str(url.path)) for url in task.inputs) == \
+        ['ilastik_worker.py', 'project.ilp', 'workqueue.py']
+    command = ' '.join(task.arguments)
+    assert "-v {0}:/queue".format(tmpdir.join('queue')) in command
+    assert '--queue /queue --worker ilastik_worker_0' in command
+    assert '{nickname}_Probabilities.tiff' in command
+
+def _fake_ilastik(exported):
+    """Return a stand-in for Ilastik's `ilastik_main` module"""
+    def run_export(lanes, export_to_array):
+        images = lanes['Raw Data']
+        if 'bad.tiff' in images:
+            raise RuntimeError('cannot export')
+        exported.extend(images)
+    applet = argparse.Namespace(run_export=run_export)
+    workflow = argparse.Namespace(ROLE_NAMES=['Raw Data'],
+                                  batchProcessingApplet=applet)
+    shell = argparse.Namespace(projectManager=argparse.Namespace(workflow=workflow))
+    module = types.ModuleType('ilastik_main')
+    module.parser = argparse.ArgumentParser()
+    module.parser.add_argument('--project')
+    module.main = lambda parsed_args, workflow_args: shell
+    return module
+
+def test_ilastik_worker_drains_queue(tmpdir, monkeypatch):
+    """
+    Test the worker script processes every chunk once
+    and reports failed chunks
+    """
+    exported = []
+    monkeypatch.setitem(sys.modules, 'ilastik_main', _fake_ilastik(exported))
+    monkeypatch.setitem(sys.modules, 'workqueue', gc3apps.utils.workqueue)
+    worker = imp.load_source('ilastik_worker',
+                             os.path.join(gc3apps.whereami, 'etc',
+                                          gc3apps.Default.ILASTIK_WORKER_FILE))
+    queue = FileWorkQueue(str(tmpdir.join('queue')))
+    queue.put('chunk_000000', ['a.tiff', 'b.tiff'])
+    queue.put('chunk_000001', ['bad.tiff'])
+    queue.put('chunk_000002', ['c.tiff'])
+    assert worker.main(['--queue', queue.root, '--worker', 'w1', '--',
+                        '--project', '/tmp/project.ilp']) == 1
+    assert exported == ['a.tiff', 'b.tiff', 'c.tiff']
+    assert queue.status() == {'chunk_000000': 'done',
+                              'chunk_000001': 'failed',
+                              'chunk_000002': 'done'}
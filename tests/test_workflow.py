@@ -0,0 +1,91 @@
+from gc3libs import Application, Run
+from gc3libs.core import Engine
+from gc3apps.utils.scale import ScaleCore
+from gc3apps.utils.ratelimit import TokenBucket
+from gc3apps.workflow import ThrottledParallelTaskCollection, \
+    GroupedTaskCollection, LocalityTaskCollection, iter_summaries
+
+def _tasks(tmpdir, count):
+    return [Application(['true'], [], [], str(tmpdir.join("out{0}".format(n))),
+                        jobname="chunk{0}".format(n))
+            for n in range(count)]
+
+def _run(collection):
+    engine = Engine(ScaleCore(100))
+    engine.add(collection)
+    running = []
+    while collection.execution.state != Run.State.TERMINATED \
+            and len(running) < 100:
+        engine.progress()
+        running.append(len([task for task in engine.iter_tasks(Application)
+                            if task.execution.state in [Run.State.SUBMITTED,
+                                                        Run.State.RUNNING]]))
+    return running
+
+def test_throttled(tmpdir):
+    """
+    Test unreleased tasks are not handed to the engine
+    """
+    collection = ThrottledParallelTaskCollection(_tasks(tmpdir, 30), max_running=10)
+    running = _run(collection)
+    assert collection.execution.state == Run.State.TERMINATED
+    assert max(running) == 10
+
+def test_grouped(tmpdir):
+    """
+    Test groups are released within `max_running`
+    and collapsed into summaries once finished
+    """
+    collection = GroupedTaskCollection(_tasks(tmpdir, 23), 5,
+                                       max_running=10, jobname='chunks')
+    assert [len(group.tasks) for group in collection.tasks] == [5, 5, 5, 5, 3]
+    running = _run(collection)
+    assert collection.execution.state == Run.State.TERMINATED
+    assert max(running) == 10
+    assert [group.tasks for group in collection.tasks] == [[]] * 5
+    summaries = list(iter_summaries(collection))
+    assert [summary.jobname for summary in summaries] == \
+        ["chunk{0}".format(n) for n in range(23)]
+    assert all(Run.State.TERMINATED in summary.timestamp for summary in summaries)
+
+def test_grouped_large_group(tmpdir):
+    """
+    Test a group larger than `max_running` is still released
+    """
+    collection = GroupedTaskCollection(_tasks(tmpdir, 8), 4, max_running=3)
+    assert collection._allowance() == 1
+    collection.max_running = 0
+    assert collection._allowance() == 0
+
+def test_rate_limit(tmpdir):
+    """
+    Test tasks and groups are released within the token bucket
+    """
+    collection = ThrottledParallelTaskCollection(_tasks(tmpdir, 10),
+                                                 rate_limit=TokenBucket(0.001, 4))
+    Engine(ScaleCore(100)).add(collection)
+    collection.submit()
+    assert collection.released == 4
+    grouped = GroupedTaskCollection(_tasks(tmpdir, 10), 5,
+                                    rate_limit=TokenBucket(0.001, 3))
+    # a group larger than the bucket goes once the bucket is full
+    assert grouped._allowance() == 1
+    grouped.rate_limit.consume(5)
+    assert grouped._allowance() == 0
+
+def test_locality(tmpdir):
+    """
+    Test at most `max_readers` tasks per key run at a time
+    """
+    tasks = _tasks(tmpdir, 12)
+    keys = ['plate1'] * 8 + ['plate2'] * 4
+    collection = LocalityTaskCollection(tasks, keys, max_readers=2, jobname='chunks')
+    assert collection.keys == ['plate1', 'plate2']
+    assert [len(child.tasks) for child in collection.tasks] == [8, 4]
+    running = _run(collection)
+    assert collection.execution.state == Run.State.TERMINATED
+    assert max(running) == 4
+    grouped = LocalityTaskCollection(tasks, keys, 2, group_size=3,
+                                     rate_limit=TokenBucket(0.001, 5))
+    assert [len(child.tasks) for child in grouped.tasks] == [3, 2]
+    assert all(child.rate_limit is grouped.rate_limit for child in grouped.tasks)
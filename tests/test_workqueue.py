@@ -0,0 +1,31 @@
+import pytest
+from gc3apps.utils.workqueue import FileWorkQueue
+
+@pytest.fixture
+def queue(tmpdir):
+    """Return a work queue with two pending chunks"""
+    queue = FileWorkQueue(str(tmpdir.join('queue')))
+    queue.put('chunk_000000', ['a.tiff', 'b.tiff'])
+    queue.put('chunk_000001', ['c.tiff'])
+    return queue
+
+def test_claim_drains_queue(queue):
+    """
+    Test that each chunk is handed out exactly once
+    """
+    assert queue.claim('w1') == ('chunk_000000', ['a.tiff', 'b.tiff'])
+    assert queue.claim('w2') == ('chunk_000001', ['c.tiff'])
+    assert queue.claim('w1') is None
+    queue.complete('w1', 'chunk_000000')
+    queue.fail('w2', 'chunk_000001')
+    assert queue.status() == {'chunk_000000': 'done',
+                              'chunk_000001': 'failed'}
+
+def test_requeue_worker(queue):
+    """
+    Test that chunks held by a dead worker go back to pending
+    """
+    queue.claim('w1')
+    assert queue.requeue(worker='w1') == ['chunk_000000']
+    assert queue.status() == {'chunk_000000': 'pending',
+                              'chunk_000001': 'pending'}